@@ -0,0 +1,706 @@
+#!/usr/bin/env python
+
+# bench.py
+# Copyright (C) 2014 Andrada, Vicente
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks the programs in this repo on synthetic data. The inputs--sorted and
+indexed BAM files, a multi-sample VCF file, and Excel files in the layout that
+tovcf reads--are generated at the requested scale, and stand-ins for
+`samtools`, `java -jar VarScan.jar`, and `vcf-concat` are put on the PATH so
+that nothing but pysam is needed. The stand-ins are deterministic: `samtools`
+runs the samtools bundled with pysam and `java` calls a variant at a fixed set
+of covered positions, so every run does the same work and gives the same
+output. The wall time, CPU time, peak memory, and throughput of every run are
+written as JSON.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import threading
+import subprocess
+import multiprocessing
+try:
+    import pysam
+    from argparse import ArgumentParser
+except ImportError:
+    print "please install the needed Python modules"
+    sys.exit()
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASES = "ACGT"
+READ_LENGTH = 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+# how often the memory of a running benchmark is sampled, in seconds
+SAMPLE_INTERVAL = 0.05
+
+# the stand-ins for the external programs; %(python)s is replaced with the
+# interpreter running the benchmark so they can import pysam
+FAKE_SAMTOOLS = """#!%(python)s
+# samtools, run with the samtools bundled with pysam
+import os
+import sys
+import shutil
+import tempfile
+import pysam
+
+args = sys.argv[1:]
+if args[0] == "view":
+    os.write(1, pysam.view(*args[1:]))
+elif args[0] == "mpileup":
+    args = args[1:]
+    if "-o" in args:
+        # always to stdout
+        del args[args.index("-o"):args.index("-o") + 2]
+    temp = None
+    if "-" in args:
+        # the BAM file is piped in
+        temp = tempfile.NamedTemporaryFile(suffix=".bam", delete=False)
+        shutil.copyfileobj(sys.stdin, temp)
+        temp.close()
+        args[args.index("-")] = temp.name
+    sys.stdout.write(pysam.mpileup(*args))
+    if temp is not None:
+        os.remove(temp.name)
+elif args[0] == "index":
+    pysam.index(*args[1:])
+elif args[0] == "sort":
+    pysam.sort(*args[1:])
+else:
+    sys.exit("samtools %%s isn't faked" %% (args[0]))
+"""
+
+FAKE_JAVA = """#!%(python)s
+# java -jar VarScan.jar action [pileup]: calls a SNP at every position divisible
+# by 10 that some sample covers, with a genotype for every sample
+import sys
+
+args = sys.argv[1:]
+pileup = open(args[3]) if len(args) > 3 and not args[3].startswith("-") \\
+    else sys.stdin
+n_samples = 1
+records = []
+for line in pileup:
+    fields = line.rstrip("\\n").split("\\t")
+    n_samples = (len(fields) - 3) // 3
+    position = int(fields[1])
+    if position %% 10:
+        continue
+    depths = [int(fields[3 + 3 * n]) for n in range(n_samples)]
+    ref = fields[2].upper()
+    alt = "ACGT"[("ACGT".find(ref) + 1 + position %% 3) %% 4]
+    samples = ["%%s:%%d:%%d:%%d" %% ("0/1" if depth else "./.", 30 + depth %% 60,
+                                 depth, depth // 2) for depth in depths]
+    records.append("\\t".join(
+        [fields[0], fields[1], ".", ref, alt, ".", "PASS",
+         "ADP=%%d;WT=0;HET=%%d;HOM=0;NC=%%d" %% (
+             sum(depths) // n_samples, sum(1 for d in depths if d),
+             sum(1 for d in depths if not d)), "GT:GQ:SDP:AD"] + samples))
+sys.stdout.write("##fileformat=VCFv4.1\\n##source=VarScan2\\n")
+sys.stdout.write("\\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL",
+                            "FILTER", "INFO", "FORMAT"] +
+                           ["Sample%%d" %% (n + 1) for n in range(n_samples)]))
+sys.stdout.write("\\n")
+sys.stdout.write("".join(record + "\\n" for record in records))
+"""
+
+FAKE_VCF_CONCAT = """#!%(python)s
+# vcf-concat: the header of the first file and the records of every file
+import sys
+
+for (n, name) in enumerate(sys.argv[1:]):
+    with open(name) as vcf_file:
+        for line in vcf_file:
+            if n == 0 or not line.startswith("#"):
+                sys.stdout.write(line)
+"""
+
+
+def b_print(mes):
+    """
+    Prints a progress message to stderr so stdout can be used for the report
+    :param mes: the message to print
+    """
+    sys.stderr.write("> %s %s\n" % (time.strftime("%H:%M:%S"), mes))
+
+
+def random_sequence(rand, length):
+    """
+    :param rand: the random.Random to use
+    :param length: the length of the sequence
+    :return: a random sequence of bases
+    """
+    return ''.join(rand.choice(BASES) for _ in xrange(length))
+
+
+def contig_names(n_contigs):
+    """
+    :param n_contigs: the number of contigs
+    :return: the names of the contigs, chr1 to chrN
+    """
+    return ["chr%d" % (n + 1) for n in range(n_contigs)]
+
+
+def make_reference(name, contigs, length, rand):
+    """
+    Writes a FASTA file with a random sequence for every contig and indexes it
+    :param name: the name of the FASTA file
+    :param contigs: the names of the contigs
+    :param length: the length of every contig
+    :param rand: the random.Random to use
+    :return: a dict mapping each contig to its sequence
+    """
+    sequences = {}
+    with open(name, "w") as fasta:
+        for contig in contigs:
+            sequences[contig] = random_sequence(rand, length)
+            fasta.write(">%s\n" % (contig))
+            for start in xrange(0, length, 60):
+                fasta.write(sequences[contig][start:start + 60] + "\n")
+    pysam.faidx(name)
+    return sequences
+
+
+def make_bam(name, contigs, sequences, n_reads, rand):
+    """
+    Writes a coordinate sorted BAM file with reads taken from the reference,
+    with a few mismatches, and indexes it
+    :param name: the name of the BAM file
+    :param contigs: the names of the contigs
+    :param sequences: a dict mapping each contig to its sequence
+    :param n_reads: the number of reads on every contig
+    :param rand: the random.Random to use
+    """
+    header = {"HD": {"VN": "1.0", "SO": "coordinate"},
+              "SQ": [{"SN": contig, "LN": len(sequences[contig])}
+                     for contig in contigs]}
+    quality = pysam.qualitystring_to_array("I" * READ_LENGTH)
+    bam = pysam.AlignmentFile(name, "wb", header=header)
+    for (tid, contig) in enumerate(contigs):
+        sequence = sequences[contig]
+        starts = sorted(rand.randint(0, len(sequence) - READ_LENGTH)
+                        for _ in xrange(n_reads))
+        for (n, start) in enumerate(starts):
+            bases = list(sequence[start:start + READ_LENGTH])
+            for _ in range(2):
+                bases[rand.randint(0, READ_LENGTH - 1)] = rand.choice(BASES)
+            read = pysam.AlignedSegment()
+            read.query_name = "%s_%d" % (contig, n)
+            read.flag = 16 if n % 2 else 0
+            read.reference_id = tid
+            read.reference_start = start
+            read.mapping_quality = 60
+            read.cigartuples = [(0, READ_LENGTH)]
+            read.query_sequence = ''.join(bases)
+            read.query_qualities = quality
+            bam.write(read)
+    bam.close()
+    pysam.index(name)
+
+
+def make_vcf(name, contigs, length, n_records, n_samples, rand):
+    """
+    Writes a multi-sample VCF file with the FORMAT fields VarScan writes
+    :param name: the name of the VCF file
+    :param contigs: the names of the contigs
+    :param length: the length of every contig
+    :param n_records: the number of records
+    :param n_samples: the number of samples
+    :param rand: the random.Random to use
+    """
+    per_contig = max(1, n_records // len(contigs))
+    with open(name, "w") as vcf_file:
+        vcf_file.write(
+            "##fileformat=VCFv4.1\n##source=bench\n"
+            '##INFO=<ID=ADP,Number=1,Type=Integer,Description="Depth">\n'
+            '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n'
+            '##FORMAT=<ID=GQ,Number=1,Type=Integer,Description="Quality">\n'
+            '##FORMAT=<ID=SDP,Number=1,Type=Integer,Description="Depth">\n'
+            '##FORMAT=<ID=AD,Number=1,Type=Integer,Description="Depth">\n')
+        vcf_file.write('\t'.join(
+            ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO",
+             "FORMAT"] + ["Sample%d" % (n + 1) for n in range(n_samples)]) +
+            '\n')
+        for contig in contigs:
+            positions = sorted(rand.sample(xrange(1, length + 1),
+                                           min(per_contig, length)))
+            for position in positions:
+                ref = rand.choice(BASES)
+                alt = BASES[(BASES.index(ref) + rand.randint(1, 3)) % 4]
+                samples = []
+                for _ in range(n_samples):
+                    depth = rand.randint(0, 60)
+                    if depth == 0:
+                        samples.append("./.:.:.:.")
+                    else:
+                        samples.append("%s:%d:%d:%d" % (
+                            rand.choice(["0/0", "0/1", "1/1"]),
+                            rand.randint(1, 99), depth, depth // 2))
+                vcf_file.write('\t'.join(
+                    [contig, str(position), ".", ref, alt, ".", "PASS",
+                     "ADP=%d" % (rand.randint(1, 60)), "GT:GQ:SDP:AD"] +
+                    samples) + '\n')
+
+
+def spreadsheet_rows(contigs, length, n_rows, rand):
+    """
+    Creates the rows of a spreadsheet in the layout tovcf reads
+    :param contigs: the names of the contigs
+    :param length: the length of every contig
+    :param n_rows: the number of rows, not counting the header
+    :param rand: the random.Random to use
+    :return: a list of rows, the first of which is the header
+    """
+    rows = [["CHR", "CO", "REF", "VAR", "COV", "QS", "ZYG", "GENE", "TRANS",
+             "CM", "PM", "DB", "OAS", "EAS"]]
+    for n in xrange(n_rows):
+        ref = rand.choice(BASES)
+        alt = BASES[(BASES.index(ref) + rand.randint(1, 3)) % 4]
+        rows.append([contigs[n % len(contigs)], str(rand.randint(1, length)),
+                     ref, ref + alt, str(rand.randint(1, 200)),
+                     str(rand.randint(1, 40)), "HET", "GENE%d" % (n % 50),
+                     "NM_%06d" % (n % 1000), "c.%d%s>%s" % (n, ref, alt),
+                     "NULL", "rs%d" % (n), "NULL", "NULL"])
+    return rows
+
+
+def make_xls(name, rows):
+    """
+    Writes the rows to an xls file with xlwt
+    :param name: the name of the xls file
+    :param rows: the rows to write
+    :return: True if the file was written and False if xlwt isn't installed
+    """
+    try:
+        import xlwt
+    except ImportError:
+        return False
+    book = xlwt.Workbook()
+    sheet = book.add_sheet("Sheet1")
+    for (r, row) in enumerate(rows):
+        for (c, value) in enumerate(row):
+            sheet.write(r, c, value)
+    book.save(name)
+    return True
+
+
+def make_xlsx(name, rows):
+    """
+    Writes the rows to an xlsx file with openpyxl
+    :param name: the name of the xlsx file
+    :param rows: the rows to write
+    :return: True if the file was written and False if openpyxl isn't
+    installed
+    """
+    try:
+        import openpyxl
+    except ImportError:
+        return False
+    book = openpyxl.Workbook(write_only=True)
+    sheet = book.create_sheet()
+    for row in rows:
+        sheet.append(row)
+    book.save(name)
+    return True
+
+
+def install_fakes(bin_dir, python):
+    """
+    Writes the stand-ins for samtools, java, and vcf-concat to a directory
+    :param bin_dir: the directory, which is put first on the PATH
+    :param python: the interpreter the stand-ins are run with
+    """
+    for (name, source) in (("samtools", FAKE_SAMTOOLS), ("java", FAKE_JAVA),
+                           ("vcf-concat", FAKE_VCF_CONCAT)):
+        path = os.path.join(bin_dir, name)
+        with open(path, "w") as fake:
+            fake.write(source % {"python": python})
+        os.chmod(path, 0755)
+
+
+def generate(work, rand):
+    """
+    Generates the inputs of every benchmark
+    :param work: the directory to generate them in
+    :param rand: the random.Random to use
+    :return: a dict describing the inputs
+    """
+    data = os.path.join(work, "data")
+    os.mkdir(data)
+    contigs = contig_names(args.contigs)
+    n_reads = args.depth * args.contig_length // READ_LENGTH
+
+    b_print("generating the reference and %d BAM files" % (args.samples))
+    sequences = make_reference(os.path.join(data, "ref.fa"), contigs,
+                               args.contig_length, rand)
+    bams = []
+    for n in range(args.samples):
+        bams.append(os.path.join(data, "sample%d.bam" % (n + 1)))
+        make_bam(bams[-1], contigs, sequences, n_reads, rand)
+    # stands in for the jar; only its existence is checked
+    open(os.path.join(data, "VarScan.jar"), "w").close()
+
+    b_print("generating a VCF file with %d records" % (args.vcf_records))
+    vcf_name = os.path.join(data, "cohort.vcf")
+    make_vcf(vcf_name, contigs, args.contig_length, args.vcf_records,
+             args.vcf_samples, rand)
+    names = os.path.join(data, "names.txt")
+    with open(names, "w") as names_file:
+        for n in range(args.vcf_samples):
+            names_file.write("renamed%d\n" % (n + 1))
+
+    b_print("generating spreadsheets with %d rows" % (args.xls_rows))
+    rows = spreadsheet_rows(contigs, args.contig_length, args.xls_rows, rand)
+    xls = os.path.join(data, "variants.xls")
+    xlsx = os.path.join(data, "variants.xlsx")
+    if not make_xls(xls, rows):
+        xls = None
+    if not make_xlsx(xlsx, rows):
+        xlsx = None
+
+    return {"bams": bams, "reads": n_reads * len(contigs) * args.samples,
+            "bam_bytes": sum(os.path.getsize(bam) for bam in bams),
+            "reference": os.path.join(data, "ref.fa"),
+            "jar": os.path.join(data, "VarScan.jar"), "vcf": vcf_name,
+            "vcf_bytes": os.path.getsize(vcf_name), "names": names,
+            "xls": xls, "xlsx": xlsx}
+
+
+def has_module(python, module):
+    """
+    :param python: the interpreter the programs are run with
+    :param module: the name of a module
+    :return: True if the interpreter can import the module
+    """
+    with open(os.devnull, "w") as devnull:
+        return subprocess.call([python, "-c", "import " + module],
+                               stdout=devnull, stderr=devnull) == 0
+
+
+def cases(inputs, python):
+    """
+    Lists the benchmarks
+    :param inputs: the inputs from generate
+    :param python: the interpreter the programs are run with
+    :return: a list of dicts with the tool, the name of the case, the command,
+    the amount of work done as (units, count, input bytes), the contents of
+    its configuration files, and, if the case can't be run, why
+    """
+    chromoprocessor = [python, os.path.join(REPO, "chromoprocessor",
+                                            "chromoprocessor.py"),
+                       inputs["jar"], "mpileup2snp", "--n-region",
+                       str(args.jobs), "--list"] + inputs["bams"]
+    chromosplit = [python, os.path.join(REPO, "parallel", "chromosplit.py"),
+                   inputs["bams"][0], "mpileup2snp", inputs["jar"],
+                   "--n-procs", str(args.jobs)]
+    vcfparse = [python, os.path.join(REPO, "vcfparse", "vcfparse.py"),
+                inputs["vcf"], "GT", "SDP"]
+    vcfrename = [python, os.path.join(REPO, "vcfrename", "vcfrename.py"),
+                 inputs["vcf"], inputs["names"]]
+    tovcf = [python, os.path.join(REPO, "tovcf", "tovcf.py")]
+    single_reads = inputs["reads"] // args.samples
+    single_bytes = os.path.getsize(inputs["bams"][0])
+    have_numpy = has_module(python, "numpy")
+    have_vcf = has_module(python, "vcf")
+    have_xlrd = has_module(python, "xlrd")
+
+    listed = [
+        {"tool": "chromoprocessor", "case": "default", "cmd": chromoprocessor,
+         "work": ("reads", inputs["reads"], inputs["bam_bytes"])},
+        {"tool": "chromoprocessor", "case": "no-intermediate",
+         "cmd": chromoprocessor + ["--no-intermediate"],
+         "work": ("reads", inputs["reads"], inputs["bam_bytes"])},
+        {"tool": "chromoprocessor", "case": "bgzip",
+         "cmd": chromoprocessor + ["--out", "run.vcf.gz"],
+         "work": ("reads", inputs["reads"], inputs["bam_bytes"])},
+        {"tool": "chromoprocessor", "case": "native",
+         "cmd": chromoprocessor + ["--engine", "native"],
+         "confs": {"samtools.conf": "-f\n%s\n-B\n" % (inputs["reference"])},
+         "work": ("reads", inputs["reads"], inputs["bam_bytes"]),
+         "skip": None if have_numpy else "NumPy isn't installed"},
+        {"tool": "chromosplit", "case": "files", "cmd": chromosplit,
+         "work": ("reads", single_reads, single_bytes)},
+        {"tool": "chromosplit", "case": "pipe",
+         "cmd": chromosplit + ["--with-pipe"],
+         "work": ("reads", single_reads, single_bytes)},
+        {"tool": "vcfparse", "case": "GT,SDP", "cmd": vcfparse,
+         "work": ("records", args.vcf_records, inputs["vcf_bytes"]),
+         "skip": None if have_vcf else "PyVCF isn't installed"},
+        {"tool": "vcfparse", "case": "GT,SDP raw",
+         "cmd": vcfparse + ["--engine", "raw"],
+         "work": ("records", args.vcf_records, inputs["vcf_bytes"]),
+         "skip": None if have_vcf else "PyVCF isn't installed"},
+        {"tool": "vcfparse", "case": "GT,SDP raw jobs",
+         "cmd": vcfparse + ["--engine", "raw", "--jobs", str(args.jobs)],
+         "work": ("records", args.vcf_records, inputs["vcf_bytes"]),
+         "skip": None if have_vcf else "PyVCF isn't installed"},
+        {"tool": "vcfparse", "case": "GT,SDP columnar",
+         "cmd": vcfparse + ["--columnar"],
+         "work": ("records", args.vcf_records, inputs["vcf_bytes"]),
+         "skip": (None if have_vcf and have_numpy else
+                  "PyVCF or NumPy isn't installed")},
+        {"tool": "vcfrename", "case": "default", "cmd": vcfrename,
+         "work": ("records", args.vcf_records, inputs["vcf_bytes"])},
+        {"tool": "tovcf", "case": "xls", "cmd": tovcf + [inputs["xls"] or ""],
+         "work": ("rows", args.xls_rows,
+                  inputs["xls"] and os.path.getsize(inputs["xls"])),
+         "skip": (None if have_xlrd and inputs["xls"] else
+                  "xlrd or xlwt isn't installed")},
+        {"tool": "tovcf", "case": "xlsx",
+         "cmd": tovcf + [inputs["xlsx"] or ""],
+         "work": ("rows", args.xls_rows,
+                  inputs["xlsx"] and os.path.getsize(inputs["xlsx"])),
+         "skip": (None if have_xlrd and inputs["xlsx"] else
+                  "xlrd or openpyxl isn't installed")},
+    ]
+    return [case for case in listed
+            if not args.tools or case["tool"] in args.tools]
+
+
+def tree_rss(pid):
+    """
+    Sums the resident memory of a process and all of its descendants
+    :param pid: the pid of the process
+    :return: the resident memory in bytes
+    """
+    children = {}
+    rss = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(os.path.join('/proc', entry, 'stat')) as f:
+                # the command name can contain spaces, but not a ')'
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            with open(os.path.join('/proc', entry, 'statm')) as f:
+                pages = int(f.read().split()[1])
+        except (IOError, OSError, IndexError, ValueError):
+            # the process exited while being read
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+        rss[int(entry)] = pages * PAGE_SIZE
+    total = 0
+    stack = [pid]
+    while stack:
+        pid = stack.pop()
+        total += rss.get(pid, 0)
+        stack.extend(children.get(pid, []))
+    return total
+
+
+def sample_memory(pid, peak, done):
+    """
+    Samples the resident memory of a process tree until it's done
+    :param pid: the pid of the process
+    :param peak: a list holding the highest sample
+    :param done: a threading.Event that is set once the process exits
+    """
+    while not done.is_set():
+        peak[0] = max(peak[0], tree_rss(pid))
+        done.wait(SAMPLE_INTERVAL)
+
+
+def measure(cmd, run_dir, env, confs):
+    """
+    Runs a command and measures it
+    :param cmd: the command list
+    :param run_dir: the directory to run it in; it's emptied first
+    :param env: the environment to run it with
+    :param confs: a dict mapping the names of configuration files to their
+    contents
+    :return: a dict with the exit code, the wall and CPU time in seconds, and
+    the peak resident memory of the command and its children in bytes
+    """
+    if os.path.isdir(run_dir):
+        shutil.rmtree(run_dir)
+    os.mkdir(run_dir)
+    # chromosplit reads both from the working directory
+    for conf in ("samtools.conf", "varscan.conf"):
+        with open(os.path.join(run_dir, conf), "w") as conf_file:
+            conf_file.write(confs.get(conf, ""))
+    with open(os.path.join(run_dir, "stdout.txt"), "w") as out, \
+            open(os.path.join(run_dir, "stderr.txt"), "w") as err:
+        started = time.time()
+        process = subprocess.Popen(cmd, cwd=run_dir, env=env, stdout=out,
+                                   stderr=err)
+        # ru_maxrss survives exec, so it would be at least the size of this
+        # process; the memory of the whole tree is sampled instead
+        peak = [0]
+        done = threading.Event()
+        sampler = threading.Thread(target=sample_memory,
+                                   args=(process.pid, peak, done))
+        sampler.start()
+        # wait4 reports the CPU time of the command and of every process it
+        # waited on
+        (_, status, usage) = os.wait4(process.pid, 0)
+        wall = time.time() - started
+        done.set()
+        sampler.join()
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    return {"returncode": returncode, "wall_seconds": wall,
+            "user_seconds": usage.ru_utime, "sys_seconds": usage.ru_stime,
+            "peak_rss_bytes": peak[0]}
+
+
+def median(values):
+    """
+    :param values: a list of numbers
+    :return: the median of the numbers
+    """
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run_case(case, work, env):
+    """
+    Runs a benchmark --repeat times and summarizes the runs
+    :param case: a case from cases
+    :param work: the working directory of the benchmark
+    :param env: the environment to run it with
+    :return: a dict for the report
+    """
+    (units, count, input_bytes) = case["work"]
+    result = {"tool": case["tool"], "case": case["case"], "units": units,
+              "count": count, "input_bytes": input_bytes}
+    if case.get("skip"):
+        b_print("skipping %s %s: %s" % (case["tool"], case["case"],
+                                        case["skip"]))
+        result["skipped"] = case["skip"]
+        return result
+    runs = []
+    run_dir = os.path.join(work, "runs", "%s-%s" % (case["tool"],
+                                                    case["case"]))
+    for n in range(args.repeat):
+        b_print("running %s %s (%d of %d)" % (case["tool"], case["case"],
+                                               n + 1, args.repeat))
+        runs.append(measure(case["cmd"], run_dir, env,
+                            case.get("confs", {})))
+        if runs[-1]["returncode"] != 0:
+            b_print("%s %s exited with %d; see %s" % (
+                case["tool"], case["case"], runs[-1]["returncode"],
+                os.path.join(run_dir, "stderr.txt")))
+            break
+    wall = median([run["wall_seconds"] for run in runs])
+    result.update({
+        "returncode": max(runs, key=lambda run: abs(run["returncode"]))[
+            "returncode"],
+        "runs": runs,
+        "wall_seconds": wall,
+        "cpu_seconds": median([run["user_seconds"] + run["sys_seconds"]
+                               for run in runs]),
+        "peak_rss_bytes": max(run["peak_rss_bytes"] for run in runs),
+        "throughput": {units + "_per_second": count / wall if wall else None,
+                       "bytes_per_second": (input_bytes / wall
+                                            if wall else None)}})
+    return result
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="benchmarks the programs in this repo "
+                                        "on synthetic data")
+    parser.add_argument(
+        "--work", dest="work", default="bench_work",
+        help="the directory to generate the data and run the programs in; "
+             "it's replaced")
+    parser.add_argument(
+        "--out", dest="out", default=None,
+        help="the file to write the JSON report to instead of stdout")
+    parser.add_argument(
+        "--tools", nargs='+', default=[],
+        choices=["chromoprocessor", "chromosplit", "vcfparse", "vcfrename",
+                 "tovcf"],
+        help="only benchmark these programs")
+    parser.add_argument(
+        "--samples", type=int, default=4,
+        help="the number of BAM files")
+    parser.add_argument(
+        "--contigs", type=int, default=4,
+        help="the number of contigs in every BAM file")
+    parser.add_argument(
+        "--contig-length", type=int, dest="contig_length", default=20000,
+        help="the length of every contig")
+    parser.add_argument(
+        "--depth", type=int, default=10,
+        help="the average depth of the reads")
+    parser.add_argument(
+        "--vcf-records", type=int, dest="vcf_records", default=20000,
+        help="the number of records in the VCF file")
+    parser.add_argument(
+        "--vcf-samples", type=int, dest="vcf_samples", default=8,
+        help="the number of samples in the VCF file")
+    parser.add_argument(
+        "--xls-rows", type=int, dest="xls_rows", default=5000,
+        help="the number of rows in the spreadsheets")
+    parser.add_argument(
+        "--jobs", type=int, default=2,
+        help="the number of regions chromoprocessor and chromosplit process "
+             "in parallel, and of the processes of vcfparse --jobs")
+    parser.add_argument(
+        "--repeat", type=int, default=1,
+        help="run every benchmark this many times and report the median")
+    parser.add_argument(
+        "--seed", type=int, default=2014,
+        help="the seed for the synthetic data")
+    parser.add_argument(
+        "--python", default=sys.executable,
+        help="the interpreter to run the programs with")
+    args = parser.parse_args()
+
+    work = os.path.abspath(args.work)
+    if os.path.isdir(work):
+        shutil.rmtree(work)
+    os.makedirs(os.path.join(work, "bin"))
+    os.mkdir(os.path.join(work, "runs"))
+    install_fakes(os.path.join(work, "bin"), args.python)
+    env = dict(os.environ)
+    env["PATH"] = os.path.join(work, "bin") + os.pathsep + env.get("PATH", "")
+    # chromosplit only checks that it's set
+    env.setdefault("PERL5LIB", "")
+
+    started = time.time()
+    inputs = generate(work, random.Random(args.seed))
+    generated = time.time() - started
+
+    results = [run_case(case, work, env) for case in cases(inputs, args.python)]
+    report = {
+        "config": dict((key, value) for (key, value) in vars(args).items()
+                       if key not in ("out", "work")),
+        "machine": {"platform": platform.platform(),
+                    "python": platform.python_version(),
+                    "cpus": multiprocessing.cpu_count()},
+        "generate_seconds": generated,
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as out:
+            json.dump(report, out, indent=2, sort_keys=True)
+            out.write('\n')
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    if any(result.get("returncode") for result in results):
+        sys.exit(1)
@@ -23,15 +23,37 @@ Processes multiple BAM files in parallel by splitting them into regions.
 import re
 import os
 import sys
+import json
+import math
 import time
+import zlib
+import errno
+import atexit
+import heapq
+import bisect
+import shutil
+import signal
+import socket
+import struct
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import collections
 import subprocess
 import multiprocessing
 try:
     import pysam
-    from concurrent.futures import ThreadPoolExecutor
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED
+    from concurrent.futures import wait as wait_futures
     from argparse import ArgumentParser
 except ImportError:
     print "please install the needed Python modules"
+try:
+    # only needed for the native engine
+    import numpy
+except ImportError:
+    numpy = None
 
 
 def s_print(mes, newline=True, pro='*'):
@@ -52,13 +74,371 @@ def s_print(mes, newline=True, pro='*'):
 
 def extract_header(samfile):
     """
-    Extracts the regions from the BAM file
-    :param samfile: the BAM file to extract the headers from
+    Extracts the regions from the BAM file. The file is only open while its
+    header is read.
+    :param samfile: the name of the BAM file to extract the headers from
     """
-    sections = [SQ['SN'] for SQ in samfile.header['SQ']]
+    bam = pysam.Samfile(samfile, "rb")
+    sections = [SQ['SN'] for SQ in bam.header['SQ']]
+    bam.close()
     return sections
 
 
+def extract_lengths(samfile):
+    """
+    Extracts the length of each region from the BAM file
+    :param samfile: the name of the BAM file to extract the lengths from
+    :return: a dict mapping each region to its length
+    """
+    bam = pysam.Samfile(samfile, "rb")
+    lengths = dict((SQ['SN'], SQ['LN']) for SQ in bam.header['SQ'])
+    bam.close()
+    return lengths
+
+
+def parse_size(size, binary=False):
+    """
+    Parses a size such as '5M' or '250k' into a number of bases, or a size
+    such as '64G' into a number of bytes
+    :param size: the size to parse
+    :param binary: whether the size is in bytes, where K, M and G are powers of
+    1024 like in chromosplit, instead of powers of 1000
+    :return: the size as an int
+    """
+    step = 2 ** 10 if binary else 10 ** 3
+    units = {'K': step, 'M': step ** 2, 'G': step ** 3}
+    size = size.strip().upper()
+    try:
+        if size[-1] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(size)
+    except (ValueError, IndexError):
+        s_print("invalid size: %s" % (size), pro=ERR)
+        sys.exit()
+
+
+def split_regions(sections, lengths, window):
+    """
+    Splits each section into windows of at most `window` bases. The windows are
+    returned in coordinate order as samtools regions, i.e. 'chr1:1-5000000'. If
+    window is None, or the section is not longer than a window, the section is
+    returned whole.
+    :param sections: the sections from the header, in the order to process them
+    :param lengths: a dict with the length of each section
+    :param window: the size of each window
+    :return: a list of regions
+    """
+    regions = []
+    for section in sections:
+        length = lengths[section]
+        if window is None or length <= window:
+            regions.append(section)
+            continue
+        for start in xrange(1, length + 1, window):
+            end = min(start + window - 1, length)
+            regions.append("%s:%d-%d" % (section, start, end))
+    return regions
+
+
+def bin_regions(regions, counts, bin_size, bin_reads):
+    """
+    Packs the sections that are smaller than `bin_size` bases and have fewer
+    than `bin_reads` reads into bins, so that each bin is called by a single
+    VarScan instead of one per section. Only neighbouring sections are packed
+    together, which keeps the regions in coordinate order. A bin is named after
+    its first and last section, i.e. 'chrUn_1..chrUn_9'.
+    :param regions: the regions in coordinate order
+    :param counts: a dict with the number of mapped reads in each section
+    :param bin_size: the most bases in a bin or None for no limit
+    :param bin_reads: the most reads in a bin or None for no limit
+    :return: a list of the regions where the small sections are replaced by
+    their bins, and a dict mapping each bin to its sections
+    """
+    fits = lambda length, reads: ((bin_size is None or length <= bin_size) and
+                                  (bin_reads is None or reads <= bin_reads))
+    binned = []
+    bins = {}
+    current = []
+
+    def close_bin():
+        if len(current) == 1:
+            binned.append(current[0])
+        elif current:
+            name = "%s..%s" % (current[0], current[-1])
+            bins[name] = list(current)
+            binned.append(name)
+        del current[:]
+
+    for region in regions:
+        reads = counts.get(region, 0)
+        if region not in LENGTHS or not fits(LENGTHS[region], reads):
+            close_bin()
+            binned.append(region)
+            continue
+        if reads == 0:
+            # nothing to call
+            continue
+        if not fits(sum(LENGTHS[r] for r in current) + LENGTHS[region],
+                    sum(counts.get(r, 0) for r in current) + reads):
+            close_bin()
+        current.append(region)
+    close_bin()
+    return (binned, bins)
+
+
+def read_targets(bed_name):
+    """
+    Reads the intervals of a BED file, skipping its header lines and the
+    intervals on sections that aren't in the BAM files.
+    :param bed_name: the name of the BED file
+    :return: a list of (section, start, end) tuples with one-based, inclusive
+    coordinates
+    """
+    targets = []
+    missing = set()
+    with open(bed_name, "r") as bed:
+        for line in bed:
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            fields = line.split()
+            try:
+                (section, start, end) = (fields[0], int(fields[1]),
+                                         int(fields[2]))
+            except (IndexError, ValueError):
+                s_print("invalid BED line: %s" % (line.rstrip('\n')),
+                        pro=ERR)
+                sys.exit()
+            if section not in LENGTHS:
+                missing.add(section)
+                continue
+            end = min(end, LENGTHS[section])
+            if end > start:
+                targets.append((section, start + 1, end))
+    if missing:
+        missing = list(missing)
+        natural_sort(missing)
+        s_print("skipping the targets on sections that aren't in the BAM "
+                "files: %s" % (', '.join(missing)), pro=ERR)
+    return targets
+
+
+def merge_targets(targets, gap):
+    """
+    Sorts the targets into coordinate order and merges the ones that overlap or
+    are at most `gap` bases apart, so that reads spanning neighbouring targets
+    are only extracted and piled up once.
+    :param targets: a list of (section, start, end) tuples
+    :param gap: the most bases between two targets that are merged
+    :return: a list of the merged targets as samtools regions, i.e.
+    'chr1:1001-1200'
+    """
+    merged = []
+    for (section, start, end) in sorted(
+            targets, key=lambda target: (SECTION_ORDER[target[0]],
+                                         target[1])):
+        if merged and merged[-1][0] == section and \
+                start - merged[-1][2] - 1 <= gap:
+            merged[-1][2] = max(merged[-1][2], end)
+        else:
+            merged.append([section, start, end])
+    return ["%s:%d-%d" % tuple(target) for target in merged]
+
+
+def pack_targets(intervals, counts, units):
+    """
+    Packs the merged targets into about `units` work units with the same
+    estimated number of reads. Only neighbouring targets are packed together,
+    which keeps the units in coordinate order, and a unit of more than one
+    target is named like a bin, i.e. 'chr1:1001-1200..chr2:5001-5400'.
+    :param intervals: the merged targets in coordinate order
+    :param counts: a dict with the number of mapped reads in each section
+    :param units: the number of work units to aim for
+    :return: a list of the units, and a dict mapping each unit of more than one
+    target to its targets
+    """
+    costs = estimate_costs(intervals, counts)
+    share = sum(costs.values()) / float(max(1, units))
+    packed = []
+    bins = {}
+    current = []
+    total = 0.0
+    for interval in intervals:
+        current.append(interval)
+        total += costs[interval]
+        # close the unit once the reads so far reach its share of the total,
+        # so an expensive unit doesn't shift the boundaries of the rest
+        if total >= share * (len(packed) + 1):
+            packed.append(current[0] if len(current) == 1 else
+                          "%s..%s" % (current[0], current[-1]))
+            if len(current) > 1:
+                bins[packed[-1]] = current
+            current = []
+    if current:
+        packed.append(current[0] if len(current) == 1 else
+                      "%s..%s" % (current[0], current[-1]))
+        if len(current) > 1:
+            bins[packed[-1]] = current
+    return (packed, bins)
+
+
+def region_spans(region):
+    """
+    Returns one samtools region per section of a region, spanning its intervals
+    on that section, so a bin of targets can be piled up straight from an
+    indexed BAM file with one `samtools mpileup -r` per section.
+    :param region: the region
+    :return: a list of samtools regions
+    """
+    spans = []
+    for interval in region_intervals(region):
+        section = parse_region(interval)[0]
+        if spans and parse_region(spans[-1][0])[0] == section:
+            spans[-1].append(interval)
+        else:
+            spans.append([interval])
+    return [span[0] if len(span) == 1 else
+            "%s:%d-%d" % (parse_region(span[0])[0], parse_region(span[0])[1],
+                          parse_region(span[-1])[2]) for span in spans]
+
+
+def region_intervals(region):
+    """
+    Returns the samtools regions that make up a region: the sections of a bin,
+    or the region itself.
+    :param region: the region
+    :return: a list of samtools regions
+    """
+    return BINS.get(region, [region])
+
+
+def region_dir(region):
+    """
+    Returns a name for a region that is safe to use for files and directories,
+    i.e 'chr1:1-5000000' -> 'chr1_1-5000000'
+    :param region: the region
+    :return: the name for the region
+    """
+    return region.replace(':', '_')
+
+
+def region_file(region):
+    """
+    Returns the name for the files a run writes for a region. A worker adds its
+    claim on the region, so a worker that lost its lease never writes over the
+    files of the worker that claimed the region after it; see WorkQueue.finish.
+    :param region: the region
+    :return: the name, i.e. 'chr1_1-5000000' or 'chr1_1-5000000.node1_4242_2'
+    """
+    if region not in CLAIMS:
+        return region_dir(region)
+    return "%s.%s_%d" % (region_dir(region), OWNER.replace(':', '_'),
+                         CLAIMS[region])
+
+
+def work_dir(region):
+    """
+    :param region: a region
+    :return: the directory for the BAM files extracted for the region, which is
+    in the scratch directory with --scratch
+    """
+    if SCRATCH is not None:
+        return SCRATCH.path(region)
+    return region_file(region)
+
+
+def region_bed(region):
+    """
+    Writes a BED file covering a windowed region or the targets of a region so
+    that `samtools mpileup` only reports the positions inside of them; reads
+    that overlap the edges of a window would otherwise be reported twice. Whole
+    sections don't need one.
+    :param region: the region to write the BED file for
+    :return: the name of the BED file or None if one isn't needed
+    """
+    intervals = [interval for interval in region_intervals(region)
+                 if interval not in LENGTHS]
+    if not intervals:
+        return None
+    # there is no directory for the region with --no-intermediate
+    bed_dir = vcf_dir_name if args.no_intermediate else work_dir(region)
+    bed_name = os.path.join(bed_dir, region_file(region) + ".bed")
+    with open(bed_name, "w+") as bed:
+        for interval in intervals:
+            (section, start, end) = parse_region(interval)
+            bed.write("%s\t%d\t%d\n" % (section, start - 1, end))
+    return bed_name
+
+
+def parse_region(region):
+    """
+    Parses a region into its section and its one-based, inclusive coordinates,
+    i.e. 'chr1:1-5000000' -> ('chr1', 1, 5000000)
+    :param region: the region to parse
+    :return: a tuple of the section, the start, and the end of the region
+    """
+    if region in LENGTHS:
+        return (region, 1, LENGTHS[region])
+    (section, span) = region.rsplit(':', 1)
+    (start, end) = span.split('-')
+    return (section, int(start), int(end))
+
+
+def count_reads(bamfiles):
+    """
+    Counts the mapped reads in each section from the index of every BAM file,
+    i.e. `samtools idxstats`, and sums them across the BAM files.
+    :param bamfiles: a list of BAM files
+    :return: a dict mapping each section to its number of mapped reads
+    """
+    counts = {}
+    for bamfile in bamfiles:
+        stats = pysam.idxstats(bamfile)
+        # older versions of pysam return a list of lines
+        if not isinstance(stats, basestring):
+            stats = ''.join(stats)
+        for line in stats.splitlines():
+            fields = line.split('\t')
+            if len(fields) < 4 or fields[0] == '*':
+                continue
+            counts[fields[0]] = counts.get(fields[0], 0) + int(fields[2])
+    return counts
+
+
+def estimate_costs(regions, counts):
+    """
+    Estimates the cost of each region as the number of mapped reads in it. The
+    reads of a windowed region are assumed to be spread evenly over its section,
+    and with --targets, evenly over the targets of its section.
+    :param regions: the regions to estimate
+    :param counts: a dict with the number of mapped reads in each section
+    :return: a dict mapping each region to its estimated cost
+    """
+    costs = {}
+    for region in regions:
+        costs[region] = 0.0
+        for interval in region_intervals(region):
+            (section, start, end) = parse_region(interval)
+            costs[region] += (counts.get(section, 0) * (end - start + 1) /
+                              float(TARGET_BASES.get(section,
+                                                     LENGTHS[section])))
+    return costs
+
+
+def print_plan(regions, costs):
+    """
+    Prints the order the regions will be processed in with their relative
+    estimated costs.
+    :param regions: the regions in the order they will be processed
+    :param costs: a dict with the estimated cost of each region
+    """
+    total = sum(costs[region] for region in regions) or 1
+    s_print("%d regions, %d estimated reads" % (len(regions), total))
+    for (n, region) in enumerate(regions):
+        s_print("%6d  %-30s %14d reads %7.2f%%" %
+                (n + 1, region, costs[region], 100 * costs[region] / total),
+                pro=' ')
+
+
 def get_filename(samfile):
     """
     Extracts the name of the file
@@ -68,17 +448,60 @@ def get_filename(samfile):
     return samfile.split('/')[-1].split('.')[0]
 
 
-def natural_sort(l):
+def natural_sort(l, key=None):
     """
     Sorts a list naturally--the way that a human will sort it--in place.
     From http://blog.codinghorror.com/sorting-for-humans-natural-sort-order
     :param l: the list to sort
+    :param key: a function to get the string to sort on from each element. The
+    default is None, which sorts on the elements themselves.
     """
     convert = lambda text: int(text) if text.isdigit() else text
-    alphanum_key = lambda key: [convert(c) for c in re.split('([0-9]+)', key)]
+    alphanum_key = lambda item: [convert(c) for c in
+                                 re.split('([0-9]+)', key(item) if key
+                                          else item)]
     l.sort(key=alphanum_key)
 
 
+def sorted_filenames(bamfiles):
+    """
+    Returns the names of the BAM files in the same order as the BAM files that
+    are created for each region, so that the samples in the VCF files are in the
+    same order whether or not the intermediate BAM files are used.
+    :param bamfiles: a list of BAM files
+    :return: a list of the names of the BAM files
+    """
+    filenames = list(bamfiles)
+    natural_sort(filenames, key=get_filename)
+    return filenames
+
+
+def find_index(bamfile):
+    """
+    Finds the index of a BAM file, i.e. 'sample.bam.bai' or 'sample.bai'
+    :param bamfile: the name of the BAM file
+    :return: the name of the index or None if there is no index
+    """
+    for index in [bamfile + ".bai", os.path.splitext(bamfile)[0] + ".bai",
+                  bamfile + ".csi"]:
+        if os.path.exists(index):
+            return index
+    return None
+
+
+def check_indexes(bamfiles):
+    """
+    Ensures that every BAM file is indexed so that `samtools mpileup` can jump
+    straight to a region.
+    :param bamfiles: a list of the names of the BAM files
+    """
+    missing = [bam for bam in bamfiles if find_index(bam) is None]
+    if missing:
+        s_print("the following BAM files are not indexed: %s" %
+                (', '.join(missing)), pro=ERR)
+        sys.exit()
+
+
 def check_input(args):
     """
     Ensures that input is entered and only one input source is specified.
@@ -106,7 +529,7 @@ def check_command(prog):
     :param prog: the command to check for
     """
     try:
-        with open(os.devnull) as out:
+        with open(os.devnull, "w") as out:
             subprocess.check_call(['which', prog], stdout=out)
     except subprocess.CalledProcessError:
         s_print("%s not found in path" % prog, pro=ERR)
@@ -118,19 +541,12 @@ def check_external_commands():
     Ensures that all programs that are needed are in the path or, in the case
     of VarScan, that the passed in location is valid.
     """
-    # check for PERL5LIB in path
-    try:
-        os.environ['PERL5LIB']
-    except KeyError:
-        s_print("Please set your PERL5LIB environment variable", pro=ERR)
-        sys.exit()
-
-    # check for samtools and vcf-concat
-    check_command('samtools')
-    check_command('vcf-concat')
+    # check for samtools, which the native engine doesn't run
+    if args.engine == "varscan":
+        check_command('samtools')
 
     # make sure the VarScan location is valid
-    if not os.path.exists(args.location):
+    if args.engine == "varscan" and not os.path.exists(args.location):
         s_print("VarScan location (%s) not valid" % (args.location), pro=ERR)
         sys.exit()
 
@@ -184,18 +600,224 @@ def make_dirs(sections):
     Attempts to make the dirs that are needed throughout the course of the
     program. In order to keep the working directory relatively clean this
     program creates a directory for each region in the BAM files and one for
-    the VCF files.
+    the VCF files. The region directories aren't needed when the regions are
+    called directly on the source BAM files, and are made as each region starts
+    with --scratch or by the workers with --queue.
     :param sections: a list containing the names of the directories
     """
     try:
-        for section in sections:
-            os.mkdir(section)
-        os.mkdir(vcf_dir_name)
+        if not args.no_intermediate and not args.scratch and not args.queue:
+            for section in sections:
+                make_dir(region_dir(section))
+        make_dir(vcf_dir_name)
     except OSError:
-        s_print("please remove the directories", pro=ERR)
+        s_print("please remove the directories or pass --resume", pro=ERR)
         sys.exit()
 
 
+def make_dir(dirname):
+    """
+    Makes a directory. When resuming, a directory left behind by the previous
+    run is reused, minus any files that were only partially written--the
+    exception is the VCF directory, whose files are checked against the
+    manifest instead.
+    :param dirname: the name of the directory to make
+    """
+    if args.resume and os.path.isdir(dirname):
+        if dirname != vcf_dir_name:
+            for leftover in os.listdir(dirname):
+                os.remove(os.path.join(dirname, leftover))
+        return
+    os.mkdir(dirname)
+
+
+def verify_vcf(vcf_name):
+    """
+    Checks that a VCF file was completely written: it has a header line and
+    ends with a newline.
+    :param vcf_name: the name of the VCF file
+    :return: True if the VCF file is complete and False otherwise
+    """
+    try:
+        with open(vcf_name, "rb") as vcf_file:
+            found_header = False
+            last = ''
+            for line in vcf_file:
+                if line.startswith('#CHROM'):
+                    found_header = True
+                last = line
+            return found_header and last.endswith('\n')
+    except IOError:
+        return False
+
+
+def read_manifest(manifest):
+    """
+    Reads the manifest of a previous run and returns the regions whose VCF
+    files are still complete and unchanged.
+    :param manifest: the name of the manifest
+    :return: a set of the completed regions
+    """
+    completed = set()
+    try:
+        with open(manifest, "r") as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 2:
+                    # a partially written line
+                    continue
+                (region, size) = fields
+                vcf_name = os.path.join(vcf_dir_name,
+                                        region_dir(region) + ".vcf")
+                if (os.path.exists(vcf_name) and
+                        os.path.getsize(vcf_name) == int(size) and
+                        verify_vcf(vcf_name)):
+                    completed.add(region)
+    except IOError:
+        pass
+    return completed
+
+
+def record_region(region):
+    """
+    Records a region in the manifest once its VCF file has been verified, so
+    the region can be skipped with --resume.
+    :param region: the region that finished
+    :return: True if the VCF file was verified and False otherwise
+    """
+    vcf_name = os.path.join(vcf_dir_name, region_dir(region) + ".vcf")
+    if not verify_vcf(vcf_name):
+        s_print("%s is incomplete" % (vcf_name), pro=ERR)
+        return False
+    lock.acquire()
+    with open(manifest_name, "a") as manifest:
+        manifest.write("%s\t%d\n" % (region, os.path.getsize(vcf_name)))
+        manifest.flush()
+        os.fsync(manifest.fileno())
+    lock.release()
+    return True
+
+
+def file_identity(name):
+    """
+    Identifies a file by its path, size, and modification time
+    :param name: the name of the file
+    :return: the identity as a string
+    """
+    info = os.stat(name)
+    return "%s:%d:%d" % (os.path.realpath(name), info.st_size,
+                         int(info.st_mtime))
+
+
+def file_checksum(name):
+    """
+    The MD5 checksum of a file
+    :param name: the name of the file
+    :return: the checksum as a hex string
+    """
+    md5 = hashlib.md5()
+    with open(name, "rb") as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def inputs_fingerprint(bamfiles):
+    """
+    Fingerprints everything other than the region that goes into a region's VCF
+    file: the BAM files and the checksums of their indexes, VarScan, the action,
+    the engine, the batch size, and the contents of samtools.conf and
+    varscan.conf.
+    :param bamfiles: the BAM files
+    :return: the fingerprint as a hex string
+    """
+    sha1 = hashlib.sha1()
+    for bamfile in sorted_filenames(bamfiles):
+        index = find_index(bamfile)
+        sha1.update(file_identity(bamfile) + '\n')
+        sha1.update((file_checksum(index) if index else '-') + '\n')
+    if args.engine == "varscan":
+        sha1.update(file_identity(args.location) + '\n')
+    sha1.update("%s\n%s\n%s\n" % (args.action, args.engine, args.batch_size))
+    sha1.update(''.join(SAMTOOLS_CONF) + '\0' + ''.join(VARSCAN_CONF))
+    return sha1.hexdigest()
+
+
+def cache_entry(region):
+    """
+    Returns the name of a region's entry in the cache, which is keyed by the
+    region and the fingerprint of the inputs.
+    :param region: the region
+    :return: the name of the cache entry
+    """
+    key = hashlib.sha1(FINGERPRINT + '\n' + region + '\n' +
+                       ','.join(region_intervals(region))).hexdigest()
+    return os.path.join(args.cache_dir, key[:2], key + ".vcf")
+
+
+def restore_cached(region):
+    """
+    Copies the cached VCF file of a region into the VCF directory and marks the
+    entry as recently used.
+    :param region: the region
+    """
+    entry = cache_entry(region)
+    shutil.copyfile(entry, os.path.join(vcf_dir_name,
+                                        region_dir(region) + ".vcf"))
+    os.utime(entry, None)
+    if args.verbose:
+        s_print("using the cached VCF file for %s" % (region))
+
+
+def store_cached(region):
+    """
+    Adds the VCF file of a region to the cache, then evicts the least recently
+    used entries until the cache fits in --cache-size.
+    :param region: the region
+    """
+    entry = cache_entry(region)
+    if not os.path.isdir(os.path.dirname(entry)):
+        try:
+            os.makedirs(os.path.dirname(entry))
+        except OSError:
+            # made by another region in the meantime
+            pass
+    # copy then rename so a partial entry is never seen
+    partial = "%s.%d.%s" % (entry, os.getpid(), threading.current_thread().ident)
+    shutil.copyfile(os.path.join(vcf_dir_name, region_file(region) + ".vcf"),
+                    partial)
+    os.rename(partial, entry)
+    with cache_lock:
+        evict_cached(parse_size(args.cache_size, binary=True))
+
+
+def evict_cached(size):
+    """
+    Removes the least recently used entries of the cache until it fits in size
+    :param size: the most bytes the cache can hold
+    """
+    entries = []
+    for (root, _, files) in os.walk(args.cache_dir):
+        for name in files:
+            if not name.endswith(".vcf"):
+                continue
+            try:
+                info = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            entries.append((info.st_mtime, info.st_size,
+                            os.path.join(root, name)))
+    total = sum(entry_size for (_, entry_size, _) in entries)
+    for (_, entry_size, name) in sorted(entries):
+        if total <= size:
+            break
+        try:
+            os.remove(name)
+            total -= entry_size
+        except OSError:
+            pass
+
+
 def read_conf_file(conf):
     """
     Reads a conf file and returns the contents.
@@ -237,16 +859,23 @@ def append_arguments(cmd, conf):
         lock.release()
 
 
-def build_samtools_args(bamfiles):
+def build_samtools_args(bamfiles, bed=None, region=None):
     """
     Parses a file containing the arguments for `samtools mpileup` and returns a
     list for subprocess.open.
     :param bamfiles: a list of the BAM files to add to the command.
+    :param bed: a BED file to restrict the positions to. The default is None.
+    :param region: the region to restrict the positions to; the BAM files must
+    be indexed. The default is None.
     :return: a list of arguments for the `samtools mpileup` command.
     """
     cmd = ["samtools", "mpileup"]
     cmd.extend(bamfiles)
     cmd.extend(["-o", "-"])
+    if bed is not None:
+        cmd.extend(["-l", bed])
+    if region is not None:
+        cmd.extend(["-r", region])
 
     append_arguments(cmd, SAMTOOLS_CONF)
 
@@ -267,6 +896,154 @@ def build_varscan_args():
     return cmd
 
 
+def spawn(region, stage, cmd, **kwargs):
+    """
+    Starts a command for a region and keeps track of it so the memory that the
+    region uses can be measured. Commands started with spawn are waited on with
+    wait.
+    :param region: the region the command is run for
+    :param stage: the name of the stage, i.e. 'mpileup'
+    :param cmd: the command list
+    :param kwargs: the keyword arguments for subprocess.Popen
+    :return: the subprocess.Popen object
+    """
+    # the commands of other regions must not inherit the ends of this region's
+    # pipes, or VarScan won't see the end of its input until they exit
+    kwargs.setdefault("close_fds", True)
+    # each command gets its own process group so that it can be killed along
+    # with anything it started, i.e. the JVM's children
+    kwargs.setdefault("preexec_fn", os.setpgrp)
+    started = time.time()
+    process = subprocess.Popen(cmd, **kwargs)
+    process.region = region
+    process.stage = stage
+    process.started = started
+    with process_lock:
+        PROCESSES.setdefault(region, []).append(process)
+        if ABORTED.is_set() or (region, CLAIMS.get(region)) in LOST:
+            # started after the run was cancelled or the region was lost
+            terminate(process)
+    return process
+
+
+def wait(process):
+    """
+    Waits for a command started with spawn to finish and traces how long it
+    took, its exit code, its peak memory, and how much it read and wrote.
+    :param process: the subprocess.Popen object
+    :return: the exit code of the command
+    """
+    while True:
+        try:
+            (_, status, usage) = os.wait4(process.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                # already waited on
+                return process.wait()
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    # ru_maxrss is in kilobytes and the blocks are 512 bytes
+    trace(process.region, process.stage, process.started, time.time(),
+          returncode=process.returncode, peak_rss=usage.ru_maxrss * 1024,
+          read_bytes=usage.ru_inblock * 512,
+          write_bytes=usage.ru_oublock * 512)
+    return process.returncode
+
+
+def check(process):
+    """
+    Waits for a command started with spawn to finish and raises CommandFailed
+    if it didn't exit cleanly
+    :param process: the subprocess.Popen object
+    """
+    if wait(process) != 0:
+        raise CommandFailed(process)
+
+
+def terminate(process):
+    """
+    Kills the process group of a command started with spawn
+    :param process: the subprocess.Popen object
+    """
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        # already exited
+        pass
+
+
+def forget_processes(region):
+    """
+    Stops keeping track of the commands of a region once it has finished.
+    :param region: the region that finished
+    """
+    with process_lock:
+        PROCESSES.pop(region, None)
+
+
+def read_proc_table():
+    """
+    Reads the parent and the resident memory of every process from /proc.
+    :return: a tuple of a dict mapping each pid to the pids of its children and
+    a dict mapping each pid to its resident memory in bytes
+    """
+    children = {}
+    rss = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(os.path.join('/proc', entry, 'stat')) as f:
+                # the command name can contain spaces, but not a ')'
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            with open(os.path.join('/proc', entry, 'statm')) as f:
+                pages = int(f.read().split()[1])
+        except (IOError, OSError, IndexError, ValueError):
+            # the process exited while being read
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+        rss[int(entry)] = pages * PAGE_SIZE
+    return (children, rss)
+
+
+def tree_rss(pids, children, rss):
+    """
+    Sums the resident memory of processes and all of their descendants.
+    :param pids: the pids of the processes
+    :param children: a dict mapping each pid to the pids of its children
+    :param rss: a dict mapping each pid to its resident memory in bytes
+    :return: the resident memory of the process trees in bytes
+    """
+    total = 0
+    seen = set()
+    stack = list(pids)
+    while stack:
+        pid = stack.pop()
+        if pid in seen:
+            continue
+        seen.add(pid)
+        total += rss.get(pid, 0)
+        stack.extend(children.get(pid, []))
+    return total
+
+
+def region_memory():
+    """
+    Measures the resident memory of the running commands of every region.
+    :return: a dict mapping each region to its resident memory in bytes
+    """
+    (children, rss) = read_proc_table()
+    with process_lock:
+        running = dict((region, [p.pid for p in processes
+                                 if p.returncode is None])
+                       for (region, processes) in PROCESSES.items())
+    return dict((region, tree_rss(pids, children, rss))
+                for (region, pids) in running.items())
+
+
 def create_bam(bamfile, region):
     """
     Creates the BAM file for each region. File names will have a form similar
@@ -274,63 +1051,1320 @@ def create_bam(bamfile, region):
     :param bamfile: the BAM file to extract the region from
     :param region: the region to extract from the BAM file from.
     """
-    outfile_name = os.path.join(region, region + "_" +
-                                get_filename(bamfile.filename) + ".bam")
+    outfile_name = os.path.join(work_dir(region), region_dir(region) + "_" +
+                                get_filename(bamfile) + ".bam")
     s_print("creating %s" % (outfile_name))
-    outfile = open(outfile_name, "w+b")
-    subprocess.call(["samtools", "view", "-b", bamfile.filename, region],
-                    stdout=outfile)
+    # the targets of a region can be close enough for a read to overlap more
+    # than one of them, and -M keeps it from being extracted twice
+    multi = ["-M"] if args.targets else []
+    with open(outfile_name, "w+b") as outfile:
+        check(spawn(region, "extract",
+                    SAMTOOLS + ["view", "-b"] + multi + [bamfile] +
+                    region_intervals(region), stdout=outfile))
 
 
-def create_vcf(region):
+def region_bamfiles(region):
     """
-    Calls `samtools mpileup` on all the files in a region and pipes the output
-    to VarScan. File names will have a form similar to 'vcf/chr1.vcf'.
-    :param region: the region to process
+    Returns the BAM files that were created for a region, in sample order
+    :param region: the region
+    :return: a list of the names of the BAM files
     """
-    # get all the BAM files first
-    input_files = os.listdir(region)
+    input_files = [bamf for bamf in os.listdir(work_dir(region))
+                   if bamf.split('.')[-1] == 'bam']
     natural_sort(input_files)
-    bamfiles = [os.path.join(region, bamf) for bamf in input_files]
+    return [os.path.join(work_dir(region), bamf) for bamf in input_files]
 
-    samtools_cmd = build_samtools_args(bamfiles)
-    varscan_cmd = build_varscan_args()
-    outfile_name = os.path.join(vcf_dir_name, region + ".vcf")
-    varscan_file = open(outfile_name, "w+b")
-
-    if args.verbose:
-        s_print("calling: \n%s | %s > %s" % (' '.join(samtools_cmd),
-                ' '.join(varscan_cmd), varscan_file.name))
-
-    mpileup = subprocess.Popen(samtools_cmd, stdout=subprocess.PIPE)
-    subprocess.call(varscan_cmd, stdin=mpileup.stdout, stdout=varscan_file)
 
+def clean_region(region, bamfiles):
+    """
+    Removes the BAM files that were created for a region and its directory
+    :param region: the region
+    :param bamfiles: the BAM files that were created for the region
+    """
     # remove the BAM files
     for bamfile in bamfiles:
         os.remove(bamfile)
 
     # and finally remove the directory
     try:
-        os.rmdir(region)
+        os.rmdir(work_dir(region))
     except OSError:
-        s_print("%s not empty" % (region), pro=ERR)
+        s_print("%s not empty" % (work_dir(region)), pro=ERR)
 
 
-def concat_vcfs(vcf_dir):
+def call_batches(region, bamfiles):
     """
-    Concatenates all the VCF files in a directory
-    :param vcf_dir: the directory with the VCF files
+    Creates the VCF file of a region. With --batch-size, the samples are called
+    in batches of that many samples and the VCF files of the batches are merged
+    column by column, so no single command opens every BAM file.
+    :param region: the region to process
+    :param bamfiles: the BAM files to call, in sample order
     """
-    arglist = ["vcf-concat"]
-    for vcf in os.listdir(vcf_dir):
-        arglist.append(os.path.join(vcf_dir, vcf))
+    outfile_name = os.path.join(vcf_dir_name, region_file(region) + ".vcf")
+    bed = None
+    if not args.no_intermediate or args.targets:
+        bed = region_bed(region)
+    size = args.batch_size
+    if not size or len(bamfiles) <= size:
+        create_vcf(region, bamfiles, outfile_name, bed)
+    else:
+        batch_names = []
+        for (n, start) in enumerate(xrange(0, len(bamfiles), size)):
+            batch_names.append(os.path.join(
+                vcf_dir_name, "%s.batch%d" % (region_file(region), n + 1)))
+            create_vcf(region, bamfiles[start:start + size], batch_names[-1],
+                       bed)
+        started = time.time()
+        with open(outfile_name, "w+") as out:
+            merge_batches(batch_names, out)
+        trace(region, "batch-merge", started, time.time())
+        for batch_name in batch_names:
+            os.remove(batch_name)
+    if bed is not None:
+        os.remove(bed)
+
+
+def create_vcf(region, bamfiles, outfile_name, bed=None):
+    """
+    Calls `samtools mpileup` on the BAM files of a region and pipes the output
+    to VarScan, or calls the region with the native engine. File names will
+    have a form similar to 'vcf/chr1.vcf'.
+    :param region: the region to process
+    :param bamfiles: a list of the BAM files to call, in sample order. These are
+    either the BAM files created for the region or, with --no-intermediate, the
+    indexed source BAM files.
+    :param outfile_name: the name of the VCF file to write
+    :param bed: a BED file to restrict the positions to. The default is None.
+    """
+    if not args.no_intermediate:
+        samtools_cmds = [build_samtools_args(bamfiles, bed=bed)]
+    else:
+        # mpileup only takes one region, so the sections of a bin are piled
+        # up one after the other into the same VarScan, and the targets on a
+        # section are piled up from the span covering them
+        samtools_cmds = [build_samtools_args(bamfiles, bed=bed, region=span)
+                         for span in region_spans(region)]
+
+    if args.engine == "native":
+        if args.verbose:
+            s_print("calling %s with the native engine" % (region))
+        with open(outfile_name, "w+b") as vcf_file:
+            call_native(region, bamfiles, vcf_file, args.no_intermediate)
+    else:
+        call_varscan(region, samtools_cmds, outfile_name)
+
+
+def call_varscan(region, samtools_cmds, outfile_name):
+    """
+    Pipes the output of the `samtools mpileup` commands of a region to VarScan
+    :param region: the region to call
+    :param samtools_cmds: the `samtools mpileup` commands, run one at a time
+    :param outfile_name: the name of the VCF file to write
+    """
+    varscan_cmd = build_varscan_args()
+
     if args.verbose:
-        s_print("running vcf-concat on the files in %s" % vcf_dir)
+        s_print("calling: \n%s | %s > %s" %
+                ('; '.join(' '.join(cmd) for cmd in samtools_cmds),
+                 ' '.join(varscan_cmd), outfile_name))
+
+    with open(outfile_name, "w+b") as varscan_file:
+        varscan = spawn(region, "varscan", varscan_cmd, stdin=subprocess.PIPE,
+                        stdout=varscan_file)
+        try:
+            for samtools_cmd in samtools_cmds:
+                check(spawn(region, "mpileup", samtools_cmd,
+                            stdout=varscan.stdin))
+        except:
+            # VarScan would call the truncated pileup as if it were complete
+            terminate(varscan)
+            raise
+        finally:
+            varscan.stdin.close()
+            wait(varscan)
+    if varscan.returncode != 0:
+        raise CommandFailed(varscan)
+
+
+def parse_options(conf):
+    """
+    Parses the options in a conf file into a dict, i.e. ['--p-value', '0.2'] ->
+    {'--p-value': '0.2'}. Switches without a value map to None.
+    :param conf: the lines of the conf file
+    :return: a dict mapping each option to its value
+    """
+    tokens = []
+    for line in conf:
+        tokens.extend(line.strip('\n').split())
+    options = {}
+    for (n, token) in enumerate(tokens):
+        if not token.startswith('-'):
+            continue
+        following = tokens[n + 1] if n + 1 < len(tokens) else None
+        if following is not None and following.startswith('-'):
+            # a negative number is still a value
+            try:
+                float(following)
+            except ValueError:
+                following = None
+        options[token] = following
+    return options
+
+
+def native_settings():
+    """
+    Reads the settings for the native engine from samtools.conf and varscan.conf
+    so that it calls the same SNPs as `samtools mpileup | VarScan mpileup2snp`.
+    The defaults are the ones of samtools and VarScan.
+    :return: a dict with the settings
+    """
+    samtools = parse_options(SAMTOOLS_CONF)
+    varscan = parse_options(VARSCAN_CONF)
+    first = lambda options, names, default: next(
+        (options[name] for name in names if options.get(name) is not None),
+        default)
+    return {
+        "reference": first(samtools, ["-f", "--fasta-ref"], None),
+        "min_base_quality": int(first(samtools, ["-Q", "--min-BQ"], 13)),
+        "min_mapping_quality": int(first(samtools, ["-q", "--min-MQ"], 0)),
+        "max_depth": int(first(samtools, ["-d", "--max-depth"], 8000)),
+        "compute_baq": not ("-B" in samtools or "--no-BAQ" in samtools),
+        "min_coverage": int(first(varscan, ["--min-coverage"], 8)),
+        "min_reads2": int(first(varscan, ["--min-reads2"], 2)),
+        "min_avg_qual": int(first(varscan, ["--min-avg-qual"], 15)),
+        "min_var_freq": float(first(varscan, ["--min-var-freq"], 0.01)),
+        "min_freq_for_hom": float(first(varscan, ["--min-freq-for-hom"],
+                                        0.75)),
+        "p_value": float(first(varscan, ["--p-value"], 0.99)),
+        "strand_filter": int(first(varscan, ["--strand-filter"], 1)) == 1,
+    }
+
+
+def check_native_engine():
+    """
+    Ensures that the native engine can be used: NumPy is installed, the action
+    is mpileup2snp, and samtools.conf names the reference.
+    """
+    if numpy is None:
+        s_print("the native engine needs NumPy", pro=ERR)
+        sys.exit()
+    if args.action != "mpileup2snp":
+        s_print("the native engine only implements mpileup2snp", pro=ERR)
+        sys.exit()
+    if NATIVE["reference"] is None:
+        s_print("the native engine needs the reference; pass it with -f in "
+                "samtools.conf", pro=ERR)
+        sys.exit()
+
+
+def log_choose(n, k):
+    """
+    The natural log of n choose k
+    """
+    return (math.lgamma(n + 1) - math.lgamma(k + 1) -
+            math.lgamma(n - k + 1))
+
+
+def fisher_right_tailed(a, b, c, d):
+    """
+    The right-tailed p-value of Fisher's exact test on the 2x2 table
+    [[a, b], [c, d]], the same test VarScan uses.
+    :return: the p-value
+    """
+    row1 = a + b
+    col1 = a + c
+    n = a + b + c + d
+    total = log_choose(n, col1)
+    p_value = 0.0
+    # every table with the same margins where d, the bottom right cell, is at
+    # least as large; d grows with a
+    for x in xrange(a, min(row1, col1) + 1):
+        p_value += math.exp(log_choose(row1, x) +
+                            log_choose(n - row1, col1 - x) - total)
+    return min(1.0, p_value)
+
+
+def variant_p_value(reads1, reads2):
+    """
+    VarScan's p-value for a variant: the observed reads compared against the
+    reads expected from a 0.1% sequencing error rate.
+    :param reads1: the number of reference-supporting reads
+    :param reads2: the number of variant-supporting reads
+    :return: the p-value
+    """
+    total = reads1 + reads2
+    expected1 = int(total * (1.0 - 0.001))
+    expected2 = total - expected1
+    return fisher_right_tailed(expected1, expected2, reads1, reads2)
+
+
+def format_p_value(p_value):
+    """
+    Formats a p-value the way VarScan does, i.e. 1.2345E-8
+    """
+    if p_value >= 0.0001:
+        return ("%.4f" % p_value).rstrip('0').rstrip('.') or '0'
+    (mantissa, exponent) = ("%.4E" % p_value).split('E')
+    return "%sE%d" % (mantissa.rstrip('0').rstrip('.'), int(exponent))
+
+
+def native_header(n_samples):
+    """
+    The header that VarScan writes for mpileup2snp --output-vcf 1
+    :param n_samples: the number of samples
+    :return: the header as a string
+    """
+    meta = [
+        'fileformat=VCFv4.1',
+        'source=VarScan2',
+        'INFO=<ID=ADP,Number=1,Type=Integer,Description="Average per-sample '
+        'depth of bases with Phred score >= %d">' % (NATIVE["min_avg_qual"]),
+        'INFO=<ID=WT,Number=1,Type=Integer,Description="Number of samples '
+        'called reference (wild-type)">',
+        'INFO=<ID=HET,Number=1,Type=Integer,Description="Number of samples '
+        'called heterozygous-variant">',
+        'INFO=<ID=HOM,Number=1,Type=Integer,Description="Number of samples '
+        'called homozygous-variant">',
+        'INFO=<ID=NC,Number=1,Type=Integer,Description="Number of samples not '
+        'called">',
+        'FILTER=<ID=str10,Description="Less than 10% or more than 90% of '
+        'variant supporting reads on one strand">',
+        'FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+        'FORMAT=<ID=GQ,Number=1,Type=Integer,Description="Genotype Quality">',
+        'FORMAT=<ID=SDP,Number=1,Type=Integer,Description="Raw Read Depth as '
+        'reported by SAMtools">',
+        'FORMAT=<ID=DP,Number=1,Type=Integer,Description="Quality Read Depth '
+        'of bases with Phred score >= %d">' % (NATIVE["min_avg_qual"]),
+        'FORMAT=<ID=RD,Number=1,Type=Integer,Description="Depth of '
+        'reference-supporting bases (reads1)">',
+        'FORMAT=<ID=AD,Number=1,Type=Integer,Description="Depth of '
+        'variant-supporting bases (reads2)">',
+        'FORMAT=<ID=FREQ,Number=1,Type=String,Description="Variant allele '
+        'frequency">',
+        'FORMAT=<ID=PVAL,Number=1,Type=String,Description="P-value from '
+        'Fisher\'s Exact Test">',
+        'FORMAT=<ID=RBQ,Number=1,Type=Integer,Description="Average quality of '
+        'reference-supporting bases (qual1)">',
+        'FORMAT=<ID=ABQ,Number=1,Type=Integer,Description="Average quality of '
+        'variant-supporting bases (qual2)">',
+        'FORMAT=<ID=RDF,Number=1,Type=Integer,Description="Depth of '
+        'reference-supporting bases on forward strand (reads1plus)">',
+        'FORMAT=<ID=RDR,Number=1,Type=Integer,Description="Depth of '
+        'reference-supporting bases on reverse strand (reads1minus)">',
+        'FORMAT=<ID=ADF,Number=1,Type=Integer,Description="Depth of '
+        'variant-supporting bases on forward strand (reads2plus)">',
+        'FORMAT=<ID=ADR,Number=1,Type=Integer,Description="Depth of '
+        'variant-supporting bases on reverse strand (reads2minus)">',
+    ]
+    head = ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO",
+            "FORMAT"] + ["Sample%d" % (n + 1) for n in range(n_samples)]
+    return ''.join("##" + line + "\n" for line in meta) + '\t'.join(head) + '\n'
+
+
+def count_column(column):
+    """
+    Counts the bases of a pileup column with NumPy. Only bases with at least
+    --min-avg-qual are counted, like VarScan does.
+    :param column: the pysam pileup column
+    :return: a tuple of the raw depth, an array with the number of each base
+    (ACGT) on each strand--shape (2, 4), forward first--and an array with the
+    sum of the qualities of each base
+    """
+    bases = []
+    strands = []
+    quals = []
+    depth = 0
+    for read in column.pileups:
+        depth += 1
+        if read.is_del or read.is_refskip:
+            continue
+        base = BASES.get(read.alignment.query_sequence[read.query_position])
+        if base is None:
+            continue
+        bases.append(base)
+        strands.append(1 if read.alignment.is_reverse else 0)
+        quals.append(read.alignment.query_qualities[read.query_position])
+    bases = numpy.array(bases, dtype=numpy.intp)
+    strands = numpy.array(strands, dtype=numpy.intp)
+    quals = numpy.array(quals, dtype=numpy.intp)
+    good = quals >= NATIVE["min_avg_qual"]
+    index = strands[good] * 4 + bases[good]
+    counts = numpy.bincount(index, minlength=8).reshape(2, 4)
+    qual_sums = numpy.bincount(bases[good], weights=quals[good], minlength=4)
+    return (depth, counts, qual_sums)
+
+
+def sample_columns(n, bamfile, intervals, indexed, reference):
+    """
+    Generates the counted pileup columns of a sample in the order of the
+    intervals.
+    :param n: the index of the sample
+    :param bamfile: the name of the BAM file
+    :param intervals: the samtools regions to pile up
+    :param indexed: whether the BAM file can be fetched from by region
+    :param reference: the pysam.FastaFile of the reference, shared by the
+    samples of the region
+    :return: a generator of tuples of ((interval index, position), sample
+    index, (depth, counts, quality sums))
+    """
+    samfile = pysam.Samfile(bamfile, "rb")
+    kwargs = {"stepper": "samtools", "truncate": True,
+              "min_base_quality": NATIVE["min_base_quality"],
+              "min_mapping_quality": NATIVE["min_mapping_quality"],
+              "max_depth": NATIVE["max_depth"],
+              "compute_baq": NATIVE["compute_baq"],
+              "fastafile": reference}
+    spans = [parse_region(interval) for interval in intervals]
+    try:
+        if indexed:
+            for (i, (section, start, end)) in enumerate(spans):
+                for column in samfile.pileup(section, start - 1, end,
+                                             **kwargs):
+                    yield ((i, column.reference_pos), n, count_column(column))
+        else:
+            # a BAM file that was extracted for the region; read it whole and
+            # drop the positions outside of the region
+            kwargs["truncate"] = False
+            starts = {}
+            for (i, (section, start, end)) in enumerate(spans):
+                starts.setdefault(section, []).append((start, end, i))
+            for column in samfile.pileup(**kwargs):
+                position = column.reference_pos + 1
+                candidates = starts.get(column.reference_name, [])
+                k = bisect.bisect_right(candidates, (position, float('inf')))
+                if k and candidates[k - 1][1] >= position:
+                    yield ((candidates[k - 1][2], column.reference_pos), n,
+                           count_column(column))
+    finally:
+        samfile.close()
+
+
+def call_column(section, position, ref, columns, n_samples):
+    """
+    Calls a SNP at a position the way VarScan mpileup2snp does.
+    :param section: the section of the position
+    :param position: the zero-based position
+    :param ref: the reference base
+    :param columns: a dict mapping each sample index to its counted column
+    :param n_samples: the number of samples
+    :return: the VCF line or None if no sample has a variant
+    """
+    if ref not in BASES:
+        return None
+    ref_index = BASES[ref]
+    empty = (0, numpy.zeros((2, 4), dtype=numpy.intp), numpy.zeros(4))
+    samples = [columns.get(n, empty) for n in range(n_samples)]
+
+    # the variant allele is the non-reference base seen most often
+    totals = sum(counts.sum(axis=0) for (_, counts, _) in samples)
+    totals[ref_index] = -1
+    var_index = int(numpy.argmax(totals))
+    if totals[var_index] <= 0:
+        return None
+
+    fields = []
+    calls = {"WT": 0, "HET": 0, "HOM": 0, "NC": 0}
+    depths = []
+    reads2_plus = 0
+    reads2_all = 0
+    variant = False
+    for (depth, counts, qual_sums) in samples:
+        (reads1_plus, reads1_minus) = counts[:, ref_index]
+        (reads2_plus_s, reads2_minus_s) = counts[:, var_index]
+        reads1 = int(reads1_plus + reads1_minus)
+        reads2 = int(reads2_plus_s + reads2_minus_s)
+        quality_depth = int(counts.sum())
+        if quality_depth < NATIVE["min_coverage"]:
+            calls["NC"] += 1
+            fields.append("./.:.:%d" % (depth))
+            continue
+        depths.append(quality_depth)
+        freq = reads2 / float(reads1 + reads2) if reads1 + reads2 else 0.0
+        p_value = variant_p_value(reads1, reads2)
+        if (reads2 >= NATIVE["min_reads2"] and
+                freq >= NATIVE["min_var_freq"] and
+                p_value <= NATIVE["p_value"]):
+            variant = True
+            reads2_plus += int(reads2_plus_s)
+            reads2_all += reads2
+            if freq >= NATIVE["min_freq_for_hom"]:
+                genotype = "1/1"
+                calls["HOM"] += 1
+            else:
+                genotype = "0/1"
+                calls["HET"] += 1
+        else:
+            genotype = "0/0"
+            calls["WT"] += 1
+        quality = 255 if p_value <= 0 else min(255, int(-10 *
+                                                       math.log10(p_value)))
+        average = lambda index, reads: (int(qual_sums[index] / reads)
+                                        if reads else 0)
+        fields.append(':'.join(str(field) for field in [
+            genotype, quality, depth, quality_depth, reads1, reads2,
+            ("%.2f" % (100 * freq)).rstrip('0').rstrip('.') + '%',
+            format_p_value(p_value), average(ref_index, reads1),
+            average(var_index, reads2), reads1_plus, reads1_minus,
+            reads2_plus_s, reads2_minus_s]))
+
+    if not variant:
+        return None
+    strand_bias = reads2_all and not (0.1 <= reads2_plus / float(reads2_all)
+                                      <= 0.9)
+    info = "ADP=%d;WT=%d;HET=%d;HOM=%d;NC=%d" % (
+        sum(depths) / len(depths) if depths else 0, calls["WT"],
+        calls["HET"], calls["HOM"], calls["NC"])
+    return '\t'.join([section, str(position + 1), '.', ref,
+                      "ACGT"[var_index], '.',
+                      "str10" if NATIVE["strand_filter"] and strand_bias
+                      else "PASS", info,
+                      "GT:GQ:SDP:DP:RD:AD:FREQ:PVAL:RBQ:ABQ:RDF:RDR:ADF:ADR"] +
+                     fields) + '\n'
+
+
+def call_native(region, bamfiles, vcf_file, indexed):
+    """
+    The native engine: piles up every sample with pysam, counts the bases with
+    NumPy, and calls SNPs with the same thresholds as VarScan mpileup2snp,
+    without starting samtools or a JVM.
+    :param region: the region to call
+    :param bamfiles: the names of the BAM files in sample order
+    :param vcf_file: the file to write the VCF to
+    :param indexed: whether the BAM files can be fetched from by region
+    """
+    started = time.time()
+    intervals = region_intervals(region)
+    sections = [parse_region(interval)[0] for interval in intervals]
+    reference = pysam.FastaFile(NATIVE["reference"])
+    try:
+        vcf_file.write(native_header(len(bamfiles)))
+        columns = heapq.merge(*[sample_columns(n, bamfile, intervals, indexed,
+                                               reference)
+                                for (n, bamfile) in enumerate(bamfiles)])
+        batch = []
+        current = None
+        samples = {}
+        for (key, n, column) in columns:
+            if key != current:
+                if current is not None:
+                    batch.append(call_column(section, current[1], ref,
+                                             samples, len(bamfiles)))
+                current = key
+                section = sections[key[0]]
+                ref = reference.fetch(section, key[1], key[1] + 1).upper()
+                samples = {}
+            samples[n] = column
+            if len(batch) >= 1024:
+                check_cancelled(region)
+                vcf_file.write(''.join(line for line in batch if line))
+                batch = []
+        if current is not None:
+            batch.append(call_column(section, current[1], ref, samples,
+                                     len(bamfiles)))
+        vcf_file.write(''.join(line for line in batch if line))
+    finally:
+        reference.close()
+    trace(region, "native", started, time.time())
+
+
+def read_records(vcf_name):
+    """
+    Reads the records of a VCF file one at a time, keyed by their position.
+    :param vcf_name: the name of the VCF file
+    :return: a generator of tuples of ((section order, position), fields)
+    """
+    with open(vcf_name, "r") as vcf_file:
+        for line in vcf_file:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            yield ((SECTION_ORDER.get(fields[0], -1), int(fields[1])), fields)
+
+
+def read_vcf_header(vcf_name):
+    """
+    Reads the header of a VCF file
+    :param vcf_name: the name of the VCF file
+    :return: a tuple of the meta lines and the fields of the '#CHROM' line
+    """
+    meta = []
+    with open(vcf_name, "r") as vcf_file:
+        for line in vcf_file:
+            if line.startswith('##'):
+                meta.append(line)
+            elif line.startswith('#'):
+                return (meta, line.rstrip('\n').split('\t'))
+            else:
+                break
+    return (meta, [])
+
+
+def merge_site(records, sizes):
+    """
+    Merges the records of the batches at one site into a single record. The ALT
+    alleles are combined and the genotypes renumbered to match; the samples of
+    batches without a record at the site are filled in as missing. WT, HET,
+    HOM, and NC are summed and ADP is recomputed from the DP of the called
+    samples, the way VarScan computes it.
+    :param records: a list with the fields of each batch's record, or None for
+    the batches without a record
+    :param sizes: the number of samples in each batch
+    :return: the fields of the merged record
+    """
+    first = next(record for record in records if record is not None)
+    alts = []
+    formats = []
+    for record in records:
+        if record is None:
+            continue
+        for alt in record[4].split(','):
+            if alt != '.' and alt not in alts:
+                alts.append(alt)
+        for key in record[8].split(':'):
+            if key not in formats:
+                formats.append(key)
+
+    samples = []
+    counts = {"WT": 0, "HET": 0, "HOM": 0, "NC": 0}
+    depths = []
+    filters = []
+    for (record, size) in zip(records, sizes):
+        if record is None:
+            samples.extend(["./."] * size)
+            counts["NC"] += size
+            continue
+        info = dict(item.split('=', 1) if '=' in item else (item, None)
+                    for item in record[7].split(';'))
+        for key in counts:
+            counts[key] += int(info.get(key) or 0)
+        for record_filter in record[6].split(';'):
+            if record_filter not in ["PASS", "."] + filters:
+                filters.append(record_filter)
+        # renumber the alleles to the merged ALT
+        numbers = {'0': '0', '.': '.'}
+        for (n, alt) in enumerate(record[4].split(',')):
+            if alt != '.':
+                numbers[str(n + 1)] = str(alts.index(alt) + 1)
+        keys = record[8].split(':')
+        for sample in record[9:]:
+            values = dict(zip(keys, sample.split(':')))
+            if "GT" in values:
+                values["GT"] = re.sub(
+                    r'[0-9.]+', lambda allele: numbers.get(allele.group(0),
+                                                           '.'), values["GT"])
+                if '.' not in values["GT"] and values.get("DP", "").isdigit():
+                    depths.append(int(values["DP"]))
+            # a sample that wasn't called keeps its trailing fields dropped
+            last = max([n + 1 for (n, key) in enumerate(formats)
+                        if key in values] or [1])
+            samples.append(':'.join(values.get(key, '.')
+                                    for key in formats[:last]))
+
+    info = [item for item in first[7].split(';')
+            if item.split('=')[0] not in counts and
+            item.split('=')[0] != "ADP"]
+    if "ADP=" in first[7]:
+        info.append("ADP=%d" % (sum(depths) / len(depths) if depths else 0))
+    info.extend("%s=%d" % (key, counts[key])
+                for key in ["WT", "HET", "HOM", "NC"]
+                if key + '=' in first[7])
+    return (first[:4] + [','.join(alts) or '.', first[5],
+                         ';'.join(filters) or first[6], ';'.join(info),
+                         ':'.join(formats)] + samples)
+
+
+def merge_batches(batch_names, out):
+    """
+    Merges the VCF files of the batches of a region column by column: a
+    streaming k-way merge on position, so only one record per batch is held in
+    memory. The samples are renamed Sample1 to SampleN across the batches.
+    :param batch_names: the names of the VCF files of the batches, in order
+    :param out: the file to write the merged VCF to
+    """
+    headers = [read_vcf_header(batch_name) for batch_name in batch_names]
+    sizes = [max(0, len(head) - 9) for (_, head) in headers]
+    (meta, head) = headers[0]
+    out.write(''.join(meta))
+    out.write('\t'.join(head[:9] + ["Sample%d" % (n + 1)
+                                    for n in range(sum(sizes))]) + '\n')
+
+    def tagged(n):
+        # tag each record with its batch so ties are broken by batch
+        for (key, fields) in read_records(batch_names[n]):
+            yield ((key, n), fields)
+
+    site = None
+    records = [None] * len(batch_names)
+    merged = heapq.merge(*[tagged(n) for n in range(len(batch_names))])
+    for ((key, n), fields) in merged:
+        if key != site:
+            if site is not None:
+                out.write('\t'.join(merge_site(records, sizes)) + '\n')
+            site = key
+            records = [None] * len(batch_names)
+        records[n] = fields
+    if site is not None:
+        out.write('\t'.join(merge_site(records, sizes)) + '\n')
+
+
+def reg2bin(beg, end):
+    """
+    The smallest bin of the UCSC binning scheme used by tabix that contains an
+    interval
+    :param beg: the 0-based start of the interval
+    :param end: the 0-based end of the interval, exclusive
+    :return: the bin
+    """
+    end -= 1
+    for (shift, offset) in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+    return 0
+
+
+class BgzfWriter(object):
+    """
+    Writes the merged VCF file as BGZF--the blocked gzip that bgzip writes--and
+    builds its tabix index in the same pass. The blocks are compressed in
+    parallel and written in order. Lines are written whole, one at a time, and
+    every line that isn't a header line is indexed.
+    """
+    # the most uncompressed data in a block; bgzip uses the same
+    block_size = 0xff00
+    eof = ("1f8b08040000000000ff0600424302001b0003000000000000000000"
+           .decode("hex"))
+
+    def __init__(self, out_name, threads):
+        """
+        :param out_name: the name of the BGZF file; the index is written to
+        out_name + '.tbi'
+        :param threads: the number of blocks to compress in parallel
+        """
+        self.name = out_name
+        self.out = open(out_name, "wb")
+        self.threads = threads
+        self.compressor = ThreadPoolExecutor(max_workers=threads)
+        self.pending = collections.deque()
+        self.buffer = []
+        self.buffered = 0
+        # the compressed offset of every block, once it has been written
+        self.blocks = []
+        self.n_blocks = 0
+        self.written = 0
+        # tabix works with virtual offsets--the offset of the block and the
+        # offset within it--which are kept as (block, offset) until the
+        # offsets of the blocks are known
+        self.names = []
+        self.bins = {}
+        self.linear = {}
+        self.section = None
+
+    def position(self):
+        """
+        :return: the position that the next line will be written at, as
+        (block, offset)
+        """
+        return (self.n_blocks, self.buffered)
+
+    def write(self, line):
+        """
+        Writes a line and indexes it if it's a VCF record
+        :param line: the line, with its newline
+        """
+        if self.buffered + len(line) > self.block_size and self.buffered:
+            self.emit()
+        begin = self.position()
+        self.written += len(line)
+        rest = line
+        while self.buffered + len(rest) > self.block_size:
+            # a line that is longer than a block
+            space = self.block_size - self.buffered
+            self.buffer.append(rest[:space])
+            self.buffered += space
+            rest = rest[space:]
+            self.emit()
+        self.buffer.append(rest)
+        self.buffered += len(rest)
+        if not line.startswith('#'):
+            self.index(line, begin, self.position())
+
+    def index(self, line, begin, end):
+        """
+        Adds a VCF record to the bins and the linear index of its section
+        :param line: the record
+        :param begin: the position of the start of the record
+        :param end: the position of the end of the record
+        """
+        fields = line.split('\t', 4)
+        section = fields[0]
+        if section != self.section:
+            self.section = section
+            self.names.append(section)
+            self.bins[section] = {}
+            self.linear[section] = []
+        start = int(fields[1]) - 1
+        stop = start + max(1, len(fields[3]))
+        chunks = self.bins[section].setdefault(reg2bin(start, stop), [])
+        if chunks and chunks[-1][1][0] == begin[0]:
+            # tabix merges the chunks of a bin that share a block
+            chunks[-1][1] = end
+        else:
+            chunks.append([begin, end])
+        linear = self.linear[section]
+        last_window = (stop - 1) >> 14
+        if len(linear) <= last_window:
+            linear.extend([None] * (last_window + 1 - len(linear)))
+        for window in xrange(start >> 14, last_window + 1):
+            if linear[window] is None:
+                linear[window] = begin
+
+    def emit(self):
+        """
+        Hands the buffered data to the compressors as a block
+        """
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.n_blocks += 1
+        self.pending.append(self.compressor.submit(self.compress, data))
+        while len(self.pending) > 2 * self.threads:
+            self.write_block(self.pending.popleft().result())
+
+    @staticmethod
+    def compress(data):
+        """
+        Compresses data into a BGZF block; zlib releases the GIL, so blocks
+        compress in parallel threads
+        :param data: at most block_size bytes
+        :return: the block
+        """
+        deflate = zlib.compressobj(6, zlib.DEFLATED, -15)
+        compressed = deflate.compress(data) + deflate.flush()
+        if len(compressed) > 0x10000 - 26:
+            # data that doesn't compress is stored instead
+            deflate = zlib.compressobj(0, zlib.DEFLATED, -15)
+            compressed = deflate.compress(data) + deflate.flush()
+        header = struct.pack("<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67,
+                             2, len(compressed) + 25)
+        return header + compressed + struct.pack(
+            "<2I", zlib.crc32(data) & 0xffffffff, len(data))
+
+    def write_block(self, block):
+        """
+        Writes a compressed block and records its offset
+        :param block: the block
+        """
+        self.blocks.append(self.out.tell())
+        self.out.write(block)
+
+    def tell(self):
+        """
+        :return: the number of uncompressed bytes written
+        """
+        return self.written
+
+    def flush(self):
+        """
+        Writes the blocks that have been compressed. The block that is being
+        filled is kept so that blocks stay full.
+        """
+        while self.pending and self.pending[0].done():
+            self.write_block(self.pending.popleft().result())
+        self.out.flush()
+
+    def close(self):
+        """
+        Writes the last block, the end of file marker, and the index
+        """
+        if self.buffered:
+            self.emit()
+        while self.pending:
+            self.write_block(self.pending.popleft().result())
+        self.out.write(self.eof)
+        self.out.close()
+        self.compressor.shutdown()
+        self.write_index()
+
+    def virtual_offset(self, position):
+        """
+        :param position: a position as (block, offset)
+        :return: the virtual offset of the position
+        """
+        (block, offset) = position
+        if block == len(self.blocks):
+            # the end of the file
+            return (self.out_size() << 16)
+        return (self.blocks[block] << 16) | offset
+
+    def out_size(self):
+        """
+        :return: the size of the BGZF file without the end of file marker
+        """
+        return os.path.getsize(self.name) - len(self.eof)
+
+    def write_index(self):
+        """
+        Writes the tabix index: the bins of each section with their chunks, and
+        the linear index of the first record in every 16kb window
+        """
+        names = ''.join(name + '\0' for name in self.names)
+        index = [struct.pack("<4s7i", "TBI\1", len(self.names), 2, 1, 2, 0,
+                             ord('#'), 0), struct.pack("<i", len(names)),
+                 names]
+        for name in self.names:
+            bins = self.bins[name]
+            index.append(struct.pack("<i", len(bins)))
+            for bin_number in sorted(bins):
+                chunks = bins[bin_number]
+                index.append(struct.pack("<Ii", bin_number, len(chunks)))
+                for (begin, end) in chunks:
+                    index.append(struct.pack("<2Q", self.virtual_offset(begin),
+                                             self.virtual_offset(end)))
+            offsets = []
+            for position in self.linear[name]:
+                # windows without a record start where the one before did
+                offsets.append(offsets[-1] if position is None and offsets
+                               else self.virtual_offset(position or (0, 0)))
+            index.append(struct.pack("<i%dQ" % len(offsets), len(offsets),
+                                     *offsets))
+        data = ''.join(index)
+        with open(self.name + ".tbi", "wb") as index_file:
+            for start in xrange(0, len(data), self.block_size):
+                index_file.write(self.compress(data[start:start +
+                                                     self.block_size]))
+            index_file.write(self.eof)
+
+
+class OrderedWriter(object):
+    """
+    Merges the VCF files of the regions into a single VCF file. Each region is
+    written as soon as it and every region before it has finished, so the file
+    is in the order of the regions and nearly complete by the time the last
+    region finishes. The header is only written once. A name ending in '.gz' is
+    written with BgzfWriter.
+    """
+
+    def __init__(self, out_name, regions):
+        """
+        :param out_name: the name of the merged VCF file
+        :param regions: the regions in the order to write them
+        """
+        if out_name.endswith(".gz"):
+            self.out = BgzfWriter(out_name, args.bgzip_threads)
+        else:
+            self.out = open(out_name, "w+")
+        self.regions = regions
+        self.finished = set()
+        self.position = 0
+        self.wrote_header = False
+        self.lock = threading.Lock()
+
+    def commit(self, region):
+        """
+        Marks a region as finished and writes every region that is now ready.
+        :param region: the region that finished
+        """
+        with self.lock:
+            self.finished.add(region)
+            while (self.position < len(self.regions) and
+                   self.regions[self.position] in self.finished):
+                self.append(self.regions[self.position])
+                self.position += 1
+            self.out.flush()
+
+    def append(self, region):
+        """
+        Appends the VCF file of a region to the merged VCF file, skipping the
+        header if it has already been written.
+        :param region: the region to append
+        """
+        started = time.time()
+        written = self.out.tell()
+        vcf_name = os.path.join(vcf_dir_name, region_dir(region) + ".vcf")
+        with open(vcf_name, "r") as vcf_file:
+            in_header = False
+            for line in vcf_file:
+                if line.startswith('#'):
+                    in_header = True
+                    if not self.wrote_header:
+                        self.out.write(line)
+                    continue
+                self.out.write(line)
+            if in_header:
+                self.wrote_header = True
+        trace(region, "merge", started, time.time(),
+              read_bytes=os.path.getsize(vcf_name),
+              write_bytes=self.out.tell() - written)
+        if args.verbose:
+            s_print("wrote %s to %s" % (region, self.out.name))
+
+    def close(self):
+        """
+        Closes the merged VCF file
+        :return: True if every region was written and False otherwise
+        """
+        self.out.close()
+        return self.position == len(self.regions)
+
+
+class MemoryBudget(object):
+    """
+    Only lets a region start while the resident memory of the running regions,
+    measured through /proc, plus an estimate for the new region stays under a
+    budget. The memory of a region is estimated from its cost and the most
+    memory per read that a finished region needed; until a region finishes each
+    region is assumed to need an equal share of the budget. Two huge regions are
+    never started together.
+    """
+
+    def __init__(self, budget, costs):
+        """
+        :param budget: the budget in bytes
+        :param costs: a dict with the estimated cost of each region
+        """
+        self.budget = budget
+        self.costs = costs
+        self.huge = 2 * sum(costs.values()) / float(len(costs))
+        self.per_read = None
+        self.running = set()
+        self.used = {}
+        self.peaks = {}
+        self.condition = threading.Condition()
+        monitor = threading.Thread(target=self.monitor)
+        monitor.daemon = True
+        monitor.start()
+
+    def estimate(self, region):
+        """
+        Estimates the memory a region needs
+        :param region: the region to estimate
+        :return: the estimate in bytes
+        """
+        if self.per_read is None:
+            return self.budget / args.n_region
+        return self.costs[region] * self.per_read
+
+    def admit(self, region):
+        """
+        Blocks until the region can start without going over the budget. A
+        region is always admitted if nothing else is running.
+        :param region: the region to start
+        """
+        with self.condition:
+            while self.running:
+                # regions that haven't grown into their estimate yet count
+                # for the estimate
+                used = sum(max(self.used.get(other, 0), self.estimate(other))
+                           for other in self.running)
+                too_big = used + self.estimate(region) > self.budget
+                both_huge = (self.costs[region] > self.huge and
+                             any(self.costs[other] > self.huge
+                                 for other in self.running))
+                if not too_big and not both_huge:
+                    break
+                self.condition.wait()
+            self.running.add(region)
+        if args.verbose:
+            s_print("admitted %s (estimated %d MB)" %
+                    (region, self.estimate(region) / 2 ** 20))
+
+    def release(self, region):
+        """
+        Releases a region once it has finished and learns from its peak memory.
+        :param region: the region that finished
+        """
+        with self.condition:
+            self.running.discard(region)
+            self.used.pop(region, None)
+            peak = self.peaks.pop(region, 0)
+            if self.costs[region] > 0 and peak > 0:
+                per_read = peak / self.costs[region]
+                self.per_read = max(self.per_read or 0, per_read)
+            self.condition.notify_all()
+
+    def monitor(self):
+        """
+        Measures the memory of the running regions every second.
+        """
+        while True:
+            used = region_memory()
+            with self.condition:
+                for region in self.running:
+                    self.used[region] = used.get(region, 0)
+                    self.peaks[region] = max(self.peaks.get(region, 0),
+                                             self.used[region])
+                self.condition.notify_all()
+            time.sleep(1)
+
+
+class Scratch(object):
+    """
+    Stages the BAM files extracted for each region in a fast scratch directory,
+    i.e. /dev/shm or a local SSD, instead of the working directory. The space a
+    region needs is estimated from its cost and the size per read of the source
+    BAM files; a region that would take the scratch directory over its budget
+    is staged in the working directory instead. Everything in the scratch
+    directory is removed when the program exits, however it exits.
+    """
+
+    def __init__(self, root, budget, per_read):
+        """
+        :param root: the scratch directory; the run gets its own directory in
+        it
+        :param budget: the most space the run can use in bytes
+        :param per_read: the estimated size of a read in bytes
+        """
+        self.root = tempfile.mkdtemp(prefix="chromoprocessor.", dir=root)
+        self.budget = budget
+        self.per_read = per_read
+        self.staged = {}
+        self.places = {}
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def estimate(self, region):
+        """
+        Estimates the space the BAM files of a region need
+        :param region: the region to estimate
+        :return: the estimate in bytes
+        """
+        return COSTS.get(region, 0) * self.per_read
+
+    def stage(self, region):
+        """
+        Picks where the BAM files of a region go and makes its directory there
+        :param region: the region to stage
+        """
+        need = self.estimate(region)
+        with self.lock:
+            if sum(self.staged.values()) + need <= self.budget:
+                self.staged[region] = need
+                self.places[region] = self.root
+            else:
+                self.places[region] = ''
+        if args.verbose:
+            s_print("staging %s in %s (estimated %d MB)" %
+                    (region, self.places[region] or "the working directory",
+                     need / 2 ** 20))
+        path = self.path(region)
+        if os.path.isdir(path):
+            # left behind by a run or a worker that died
+            shutil.rmtree(path)
+        os.mkdir(path)
+
+    def path(self, region):
+        """
+        :param region: a region that was staged
+        :return: the directory for the BAM files of the region
+        """
+        return os.path.join(self.places.get(region, ''), region_file(region))
+
+    def unstage(self, region):
+        """
+        Removes whatever is left of a region's directory, i.e. after it failed,
+        and gives back its space
+        :param region: the region that finished
+        """
+        shutil.rmtree(self.path(region), ignore_errors=True)
+        with self.lock:
+            self.staged.pop(region, None)
+            self.places.pop(region, None)
+
+    def close(self):
+        """
+        Removes the run's scratch directory
+        """
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def make_scratch(bamfiles):
+    """
+    Sets up --scratch
+    :param bamfiles: the source BAM files
+    :return: a Scratch or None if there's nothing to stage
+    """
+    if not args.scratch:
+        return None
+    if args.no_intermediate:
+        s_print("--no-intermediate doesn't write intermediate files; ignoring "
+                "--scratch", pro=ERR)
+        return None
+    if args.scratch_size:
+        budget = parse_size(args.scratch_size, binary=True)
+    else:
+        stats = os.statvfs(args.scratch)
+        budget = stats.f_bavail * stats.f_frsize
+    # the BAM files of a region take about the share of the source BAM files
+    # that its reads do
+    reads = sum(COSTS.values())
+    size = sum(os.path.getsize(bamfile) for bamfile in bamfiles)
+    return Scratch(args.scratch, budget, size / reads if reads else 0.0)
+
+
+class Tracer(object):
+    """
+    Records how long every stage of every region took. Each event is written to
+    a JSON-lines log as it happens; when the run is over the events are also
+    written as a Chrome trace, which can be opened in chrome://tracing or
+    Perfetto, and a summary is printed.
+    """
+
+    def __init__(self, prefix):
+        """
+        :param prefix: the prefix of the log and the trace, i.e. 'run' for
+        'run.jsonl' and 'run.trace.json'
+        """
+        self.prefix = prefix
+        self.started = time.time()
+        self.events = []
+        self.threads = {}
+        self.lock = threading.Lock()
+        self.log = open(prefix + ".jsonl", "w+")
+
+    def event(self, region, stage, start, end, **info):
+        """
+        Records a stage of a region
+        :param region: the region
+        :param stage: the name of the stage
+        :param start: when the stage started, in seconds since the epoch
+        :param end: when the stage ended, in seconds since the epoch
+        :param info: anything else to record, i.e. the exit code
+        """
+        event = {"region": region, "stage": stage, "start": start,
+                 "end": end, "seconds": end - start}
+        event.update(info)
+        with self.lock:
+            ident = threading.current_thread().ident
+            event["thread"] = self.threads.setdefault(ident, len(self.threads))
+            self.events.append(event)
+            self.log.write(json.dumps(event, sort_keys=True) + '\n')
+            self.log.flush()
+
+    def close(self):
+        """
+        Writes the Chrome trace and prints the summary
+        """
+        self.log.close()
+        with open(self.prefix + ".trace.json", "w+") as trace_file:
+            json.dump({"traceEvents": [self.chrome_event(event)
+                                       for event in self.events],
+                       "displayTimeUnit": "ms"}, trace_file)
+        self.summary()
+
+    def chrome_event(self, event):
+        """
+        Converts an event to a complete event of the Chrome trace format
+        :param event: the event to convert
+        :return: the Chrome trace event
+        """
+        skip = ["region", "stage", "start", "end", "seconds", "thread"]
+        info = dict((k, v) for (k, v) in event.items() if k not in skip)
+        info["region"] = event["region"]
+        return {"name": "%s %s" % (event["stage"], event["region"]),
+                "cat": event["stage"], "ph": "X", "pid": os.getpid(),
+                "tid": event["thread"],
+                "ts": int((event["start"] - self.started) * 1e6),
+                "dur": int(event["seconds"] * 1e6), "args": info}
+
+    def summary(self):
+        """
+        Prints the time spent in each stage, the slowest regions, and the
+        critical path: the region that finished last and where its time went.
+        """
+        if not self.events:
+            return
+        wall = max(event["end"] for event in self.events) - self.started
+        s_print("trace: %.1fs wall time; events in %s.jsonl and %s.trace.json"
+                % (wall, self.prefix, self.prefix))
+
+        stages = {}
+        regions = {}
+        for event in self.events:
+            stages[event["stage"]] = (stages.get(event["stage"], 0) +
+                                      event["seconds"])
+            regions.setdefault(event["region"], []).append(event)
+        for (stage, seconds) in sorted(stages.items(), key=lambda x: -x[1]):
+            s_print("  %-10s %10.1fs total" % (stage, seconds), pro=' ')
+
+        span = lambda events: (max(e["end"] for e in events) -
+                               min(e["start"] for e in events))
+        slowest = sorted(regions.items(), key=lambda x: -span(x[1]))[:5]
+        s_print("slowest regions:", pro=' ')
+        for (region, events) in slowest:
+            s_print("  %-30s %10.1fs" % (region, span(events)), pro=' ')
+
+        (region, events) = max(regions.items(),
+                               key=lambda x: max(e["end"] for e in x[1]))
+        start = min(e["start"] for e in events)
+        s_print("critical path: %s started at %.1fs and took %.1fs" %
+                (region, start - self.started, span(events)), pro=' ')
+        for event in sorted(events, key=lambda e: e["start"]):
+            s_print("  %-10s %10.1fs (exit code %s, peak %d MB)" %
+                    (event["stage"], event["seconds"],
+                     event.get("returncode", '-'),
+                     event.get("peak_rss", 0) / 2 ** 20), pro=' ')
+
+
+def trace(region, stage, start, end, **info):
+    """
+    Records a stage of a region if `--trace` was passed.
+    :param region: the region
+    :param stage: the name of the stage
+    :param start: when the stage started, in seconds since the epoch
+    :param end: when the stage ended, in seconds since the epoch
+    :param info: anything else to record, i.e. the exit code
+    """
+    if TRACER is not None:
+        TRACER.event(region, stage, start, end, **info)
+
+
+def admit(region):
+    """
+    Waits for enough memory to start a region if there is a memory budget.
+    :param region: the region to start
+    """
+    if BUDGET is not None:
+        BUDGET.admit(region)
 
-    with open(args.out, "w+") as vcf_file:
-        subprocess.call(arglist, stdout=vcf_file)
 
-    # clean up
+def release(region):
+    """
+    Gives back the memory of a region once it has finished.
+    :param region: the region that finished
+    """
+    forget_processes(region)
+    if BUDGET is not None:
+        BUDGET.release(region)
+
+
+def stage(region):
+    """
+    Makes the directory for the BAM files of a region in the scratch directory,
+    or the working directory if it's full, with --scratch. A worker makes its
+    own directory for each region it claims.
+    :param region: the region to start
+    """
+    if SCRATCH is not None:
+        SCRATCH.stage(region)
+    elif region in CLAIMS:
+        os.mkdir(work_dir(region))
+
+
+def unstage(region):
+    """
+    Removes what is left of the directory of a region and gives back its space
+    in the scratch directory.
+    :param region: the region that finished
+    """
+    if SCRATCH is not None:
+        SCRATCH.unstage(region)
+
+
+def clean_vcfs(vcf_dir):
+    """
+    Removes the VCF files of the regions once they have been merged
+    :param vcf_dir: the directory with the VCF files
+    """
     for vcf in os.listdir(vcf_dir):
         os.remove(os.path.join(vcf_dir, vcf))
     try:
@@ -339,6 +2373,34 @@ def concat_vcfs(vcf_dir):
         s_print("%s not empty" % vcf_dir, pro=ERR)
 
 
+def finish_region(region):
+    """
+    Verifies the VCF file of a region that finished, then records the region in
+    the manifest and the cache and hands it to the writer. A worker marks the
+    region as done in the queue instead, and the coordinator records and writes
+    it. Only verified VCF files are cached.
+    :param region: the region that finished
+    """
+    vcf_name = os.path.join(vcf_dir_name, region_file(region) + ".vcf")
+    if WRITER is None:
+        verified = verify_vcf(vcf_name)
+    else:
+        verified = record_region(region)
+    if not verified:
+        raise IncompleteVCF(vcf_name)
+    if args.cache_dir:
+        store_cached(region)
+    if WRITER is None:
+        # put the VCF file in place only while this worker still holds the
+        # region
+        if not QUEUE.finish(region, OWNER, CLAIMS[region],
+                            rename=(vcf_name, os.path.join(
+                                vcf_dir_name, region_dir(region) + ".vcf"))):
+            raise LeaseLost(region)
+        return
+    WRITER.commit(region)
+
+
 def run(region, bamfiles):
     """
     Super generic name, but this function does the bulk of the work. It creates
@@ -346,26 +2408,542 @@ def run(region, bamfiles):
     :param region: the region to process
     :param bamfile: a list of BAM files to process
     """
+    admit(region)
     if args.verbose:
         s_print("starting region %s" % (region))
-    for bamfile in bamfiles:
-        create_bam(bamfile, region)
-    create_vcf(region)
+    try:
+        check_cancelled(region)
+        if args.no_intermediate:
+            call_batches(region, sorted_filenames(bamfiles))
+        else:
+            stage(region)
+            for bamfile in bamfiles:
+                create_bam(bamfile, region)
+            region_files = region_bamfiles(region)
+            call_batches(region, region_files)
+            clean_region(region, region_files)
+    finally:
+        unstage(region)
+        release(region)
+    finish_region(region)
+
+
+def call_region(region):
+    """
+    The second stage of run_staged: creates the VCF file from the BAM files that
+    were extracted for the region.
+    :param region: the region to call
+    """
+    admit(region)
+    if args.verbose:
+        s_print("calling region %s" % (region))
+    try:
+        check_cancelled(region)
+        region_files = region_bamfiles(region)
+        call_batches(region, region_files)
+        clean_region(region, region_files)
+    finally:
+        unstage(region)
+        release(region)
+    finish_region(region)
+
+
+class CommandFailed(Exception):
+    """
+    Raised when a command of a region exits with an error or is killed
+    """
+
+    def __init__(self, process):
+        """
+        :param process: the subprocess.Popen object of the command
+        """
+        if process.returncode < 0:
+            reason = "was killed by signal %d" % (-process.returncode)
+        else:
+            reason = "exited with %d" % (process.returncode)
+        Exception.__init__(self, "%s %s" % (process.stage, reason))
+        self.region = process.region
+        self.stage = process.stage
+        self.returncode = process.returncode
+
+
+class IncompleteVCF(Exception):
+    """
+    Raised when every command of a region succeeded but its VCF file is
+    incomplete
+    """
+
+    def __init__(self, vcf_name):
+        """
+        :param vcf_name: the name of the VCF file
+        """
+        Exception.__init__(self, "%s is incomplete" % (vcf_name))
+
+
+class LeaseLost(Exception):
+    """
+    Raised in a worker's region after its lease ran out and another worker
+    claimed it
+    """
+
+    def __init__(self, region):
+        """
+        :param region: the region
+        """
+        Exception.__init__(self, "lost the lease on %s" % (region))
+
+
+class Cancelled(Exception):
+    """
+    Raised in a region that was started, or is still running, after the run
+    was cancelled
+    """
+    pass
+
+
+def check_cancelled(region):
+    """
+    Stops a region if the run was cancelled or, in a worker, the lease on the
+    region was lost
+    :param region: the region
+    """
+    if ABORTED.is_set():
+        raise Cancelled(region)
+    if (region, CLAIMS.get(region)) in LOST:
+        raise LeaseLost(region)
+
+
+def lose_region(region, attempt):
+    """
+    Stops a worker's region whose lease was lost: kills the process groups of
+    its commands, and it won't start any more.
+    :param region: the region
+    :param attempt: the worker's claim on the region
+    """
+    with process_lock:
+        LOST.add((region, attempt))
+        for process in PROCESSES.get(region, []):
+            if process.returncode is None:
+                terminate(process)
+
+
+def cancel():
+    """
+    Cancels the run: kills the process groups of every running command, and
+    the regions that haven't started won't.
+    """
+    ABORTED.set()
+    with process_lock:
+        for processes in PROCESSES.values():
+            for process in processes:
+                if process.returncode is None:
+                    terminate(process)
+
+
+def region_failed(region, error):
+    """
+    Records a region that failed in `vcf/failed.txt` and, unless --keep-going
+    was given, cancels the run. Regions that fail because the run was
+    cancelled aren't recorded.
+    :param region: the region that failed
+    :param error: the exception it failed with
+    """
+    if ABORTED.is_set():
+        if args.verbose:
+            s_print("cancelled %s" % (region))
+        return
+    FAILED[region] = error
+    s_print("%s failed: %s" % (region, error), pro=ERR)
+    with open(failed_name, "a") as failed_file:
+        failed_file.write("%s\t%s\n" % (region, error))
+    if not args.keep_going:
+        s_print("cancelling the run; use --keep-going to process the other "
+                "regions", pro=ERR)
+        cancel()
+
+
+def interrupt(signum, frame):
+    """
+    Handles SIGTERM like Ctrl-C
+    """
+    raise KeyboardInterrupt()
+
+
+class WorkQueue(object):
+    """
+    A queue of regions in a SQLite database on a shared filesystem. The
+    coordinator publishes the plan and the regions; workers on any node claim
+    regions, renew the lease on them while they run, and mark them done. A
+    region whose lease runs out--its worker died--is claimed again by the next
+    worker that asks. A region that was claimed `max_attempts` times without
+    finishing has failed. Each claim is numbered by its attempt; a worker only
+    renews or finishes the claim it holds, so a worker whose lease ran out
+    can't finish a region another worker claimed after it.
+    """
+    max_attempts = 3
+
+    def __init__(self, path):
+        """
+        :param path: the path of the database
+        """
+        self.path = path
+
+    def connect(self):
+        """
+        Opens a connection to the database; every thread needs its own
+        """
+        return sqlite3.connect(self.path, timeout=600, isolation_level=None)
+
+    def publish(self, plan, regions):
+        """
+        Replaces the plan and the regions in the queue
+        :param plan: a dict with everything a worker needs to run a region
+        :param regions: the regions to run, in the order to claim them
+        """
+        db = self.connect()
+        db.execute("BEGIN IMMEDIATE")
+        db.execute("DROP TABLE IF EXISTS plan")
+        db.execute("DROP TABLE IF EXISTS regions")
+        db.execute("CREATE TABLE plan (value TEXT)")
+        db.execute("CREATE TABLE regions (name TEXT PRIMARY KEY, rank INTEGER,"
+                   " state TEXT, owner TEXT, lease REAL, attempts INTEGER)")
+        db.execute("INSERT INTO plan VALUES (?)", (json.dumps(plan),))
+        db.executemany("INSERT INTO regions VALUES (?, ?, 'pending', NULL, 0,"
+                       " 0)", [(region, n) for (n, region) in
+                               enumerate(regions)])
+        db.execute("COMMIT")
+        db.close()
+
+    def plan(self):
+        """
+        :return: the plan published by the coordinator
+        """
+        db = self.connect()
+        (plan,) = db.execute("SELECT value FROM plan").fetchone()
+        db.close()
+        return json.loads(plan)
+
+    def claim(self, owner, lease):
+        """
+        Claims the next region that is pending or whose lease has run out. A
+        worker doesn't claim a region it is still running itself.
+        :param owner: the name of the worker
+        :param lease: how long the lease lasts, in seconds
+        :return: a tuple of the region and the attempt, which identifies the
+        claim, or None if there is nothing to claim
+        """
+        db = self.connect()
+        db.execute("BEGIN IMMEDIATE")
+        db.execute("UPDATE regions SET state = 'failed', owner = NULL WHERE "
+                   "state = 'running' AND lease < ? AND attempts >= ?",
+                   (time.time(), self.max_attempts))
+        row = db.execute("SELECT name, attempts FROM regions WHERE "
+                         "state = 'pending' OR (state = 'running' AND "
+                         "lease < ? AND owner != ?) ORDER BY rank LIMIT 1",
+                         (time.time(), owner)).fetchone()
+        if row is not None:
+            db.execute("UPDATE regions SET state = 'running', owner = ?, "
+                       "lease = ?, attempts = attempts + 1 WHERE name = ?",
+                       (owner, time.time() + lease, row[0]))
+        db.execute("COMMIT")
+        db.close()
+        return (row[0], row[1] + 1) if row is not None else None
+
+    def heartbeat(self, owner, claims, lease):
+        """
+        Renews the leases on the regions a worker is running
+        :param owner: the name of the worker
+        :param claims: a dict mapping each region to the attempt it was
+        claimed with
+        :param lease: how long the lease lasts, in seconds
+        :return: the regions that couldn't be renewed: their lease ran out and
+        another worker claimed them
+        """
+        db = self.connect()
+        lost = []
+        for (region, attempt) in claims.items():
+            cursor = db.execute("UPDATE regions SET lease = ? WHERE name = ? "
+                                "AND owner = ? AND attempts = ? AND "
+                                "state = 'running'",
+                                (time.time() + lease, region, owner, attempt))
+            if cursor.rowcount == 0:
+                lost.append(region)
+        db.close()
+        return lost
+
+    def finish(self, region, owner, attempt, state="done", rename=None):
+        """
+        Marks a region as done, or gives it back to the queue; a region given
+        back too many times has failed. Only the claim that holds the region
+        can finish it.
+        :param region: the region
+        :param owner: the name of the worker
+        :param attempt: the attempt the region was claimed with
+        :param state: 'done', or 'pending' to give the region back
+        :param rename: a tuple of the worker's own name for the VCF file of the
+        region and its name; the file is renamed while the database is locked,
+        so it's only put in place if the claim still holds the region
+        :return: True if the claim still held the region and False otherwise
+        """
+        db = self.connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            held = db.execute("SELECT 1 FROM regions WHERE name = ? AND "
+                              "owner = ? AND attempts = ? AND "
+                              "state = 'running'",
+                              (region, owner, attempt)).fetchone() is not None
+            if held:
+                if rename is not None:
+                    os.rename(*rename)
+                if state == "pending" and attempt >= self.max_attempts:
+                    state = "failed"
+                db.execute("UPDATE regions SET state = ?, owner = NULL WHERE "
+                           "name = ?", (state, region))
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+        return held
+
+    def states(self):
+        """
+        :return: a dict mapping each region to its state
+        """
+        db = self.connect()
+        states = dict(db.execute("SELECT name, state FROM regions").fetchall())
+        db.close()
+        return states
+
+
+def run_worker(bamfiles, lease):
+    """
+    Claims regions from the queue and runs them, --n-region at a time, until
+    every region in the queue is done.
+    :param bamfiles: a list of BAM files to process
+    :param lease: how long the lease on a region lasts, in seconds
+    """
+    stopped = threading.Event()
+    heartbeat = threading.Thread(target=renew_leases, args=(lease, stopped))
+    heartbeat.daemon = True
+    heartbeat.start()
+
+    def work():
+        while not ABORTED.is_set():
+            claim = QUEUE.claim(OWNER, lease)
+            if claim is None:
+                if all(state in ("done", "failed")
+                       for state in QUEUE.states().values()):
+                    return
+                # wait for a lease to run out or the last regions to finish
+                time.sleep(lease / 4.0)
+                continue
+            (region, attempt) = claim
+            CLAIMS[region] = attempt
+            try:
+                run(region, bamfiles)
+            except Exception as e:
+                if QUEUE.finish(region, OWNER, attempt, state="pending"):
+                    s_print("%s failed: %s" % (region, e), pro=ERR)
+                else:
+                    s_print("gave up %s: lost the lease on it" % (region),
+                            pro=ERR)
+                discard_region(region)
+            finally:
+                del CLAIMS[region]
+                LOST.discard((region, attempt))
+
+    workers = [threading.Thread(target=work) for _ in range(args.n_region)]
+    for worker in workers:
+        worker.start()
+    try:
+        while any(worker.is_alive() for worker in workers):
+            # join with a timeout so Ctrl-C isn't held until the end
+            time.sleep(1)
+    except KeyboardInterrupt:
+        # the regions that were running are given back to the queue
+        s_print("interrupted; stopping every region", pro=ERR)
+        cancel()
+        for worker in workers:
+            worker.join()
+        raise
+    finally:
+        stopped.set()
+        heartbeat.join()
+
+
+def renew_leases(lease, stopped):
+    """
+    Renews the leases of this worker's regions until it stops, and stops the
+    regions whose lease was lost
+    :param lease: how long the lease on a region lasts, in seconds
+    :param stopped: the threading.Event set when the worker stops
+    """
+    while not stopped.wait(lease / 3.0):
+        claims = dict(CLAIMS)
+        for region in QUEUE.heartbeat(OWNER, claims, lease):
+            if CLAIMS.get(region) != claims[region]:
+                # finished in the meantime
+                continue
+            s_print("lost the lease on %s; stopping it" % (region), pro=ERR)
+            lose_region(region, claims[region])
+
+
+def discard_region(region):
+    """
+    Removes the files a worker wrote for a region it didn't finish; they're
+    named after its claim, so they're only its own.
+    :param region: the region
+    """
+    prefix = region_file(region) + "."
+    try:
+        names = os.listdir(vcf_dir_name)
+    except OSError:
+        # the run finished and removed it
+        names = []
+    for name in names:
+        if name.startswith(prefix):
+            os.remove(os.path.join(vcf_dir_name, name))
+    if SCRATCH is None:
+        shutil.rmtree(work_dir(region), ignore_errors=True)
 
 
-def create_threads(bamfiles):
+def coordinate(regions):
+    """
+    Waits for the workers to finish the regions in the queue and writes each
+    one as it finishes.
+    :param regions: the regions that were published to the queue
+    """
+    waiting = set(regions)
+    s_print("waiting for workers: chromoprocessor worker %s" % (args.queue))
+    while waiting:
+        states = QUEUE.states()
+        for region in [r for r in waiting if states.get(r) == "done"]:
+            waiting.discard(region)
+            if record_region(region):
+                WRITER.commit(region)
+        for region in [r for r in waiting if states.get(r) == "failed"]:
+            waiting.discard(region)
+            s_print("%s failed on every worker that ran it" % (region),
+                    pro=ERR)
+        if args.verbose:
+            s_print("%d of %d regions left" % (len(waiting), len(regions)))
+        if waiting:
+            time.sleep(5)
+
+
+def create_threads(bamfiles, regions):
     """
-    Creates the threads to handle the individual regions.
+    Processes the regions in parallel, `--n-region` at a time, and checks how
+    each one finished.
     :param bamfiles: a list of BAM files to process
+    :param regions: the regions to process
     """
     with ThreadPoolExecutor(max_workers=args.n_region) as executor:
-        for region in HEADER:
-            executor.submit(run, region, bamfiles)
+        jobs = dict((executor.submit(run, region, bamfiles), region)
+                    for region in regions)
+        try:
+            while jobs:
+                # wait with a timeout so Ctrl-C isn't held until the end
+                (done, _) = wait_futures(list(jobs), timeout=1,
+                                         return_when=FIRST_COMPLETED)
+                for job in done:
+                    region = jobs.pop(job)
+                    if not job.cancelled() and job.exception() is not None:
+                        region_failed(region, job.exception())
+                if ABORTED.is_set():
+                    for job in jobs:
+                        job.cancel()
+        except KeyboardInterrupt:
+            s_print("interrupted; stopping every region", pro=ERR)
+            cancel()
+            raise
+
+
+def run_staged(bamfiles, regions):
+    """
+    Runs the extraction and the calling of the regions in separate pools so that
+    the BAM files for the next regions are extracted--every sample in parallel--
+    while the current regions are called. At most `--queue-size` extracted
+    regions wait for a caller; the extraction stalls until one is free. A region
+    whose extraction fails isn't called.
+    :param bamfiles: a list of BAM files to process
+    :param regions: the regions to process
+    """
+    slots = args.n_region + args.queue_size
+    active = 0
+    waiting = list(regions)
+    remaining = {}
+    broken = set()
+    jobs = {}
+
+    with ThreadPoolExecutor(max_workers=args.n_region) as caller, \
+            ThreadPoolExecutor(max_workers=args.n_extract) as extractor:
+        try:
+            while waiting or jobs:
+                while waiting and active < slots and not ABORTED.is_set():
+                    region = waiting.pop(0)
+                    active += 1
+                    remaining[region] = len(bamfiles)
+                    stage(region)
+                    if args.verbose:
+                        s_print("extracting region %s" % (region))
+                    for bamfile in bamfiles:
+                        job = extractor.submit(create_bam, bamfile, region)
+                        jobs[job] = ("extract", region)
+                if ABORTED.is_set():
+                    del waiting[:]
+                    for job in jobs:
+                        job.cancel()
+
+                # wait with a timeout so Ctrl-C isn't held until the end
+                (done, _) = wait_futures(list(jobs), timeout=1,
+                                         return_when=FIRST_COMPLETED)
+                for job in done:
+                    (step, region) = jobs.pop(job)
+                    if job.cancelled() or job.exception() is not None:
+                        if not job.cancelled() and region not in broken:
+                            region_failed(region, job.exception())
+                        broken.add(region)
+                    if step == "extract":
+                        # hand the region over once the last of its samples
+                        # is extracted
+                        remaining[region] -= 1
+                        if remaining[region] > 0:
+                            continue
+                        if region not in broken:
+                            jobs[caller.submit(call_region, region)] = \
+                                ("call", region)
+                            continue
+                    if region in broken:
+                        unstage(region)
+                    active -= 1
+        except KeyboardInterrupt:
+            s_print("interrupted; stopping every region", pro=ERR)
+            cancel()
+            raise
 
 if __name__ == "__main__":
     ERR = '!'   # default value for s_print
     lock = multiprocessing.Lock()
+    process_lock = threading.Lock()
+    cache_lock = threading.Lock()
+    PROCESSES = {}
+    ABORTED = threading.Event()
+    # a worker's claims on the regions it's running and the ones it lost
+    CLAIMS = {}
+    LOST = set()
+    FAILED = {}
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
     vcf_dir_name = "vcf"
+    manifest_name = os.path.join(vcf_dir_name, "manifest.txt")
+    failed_name = os.path.join(vcf_dir_name, "failed.txt")
+
+    QUEUE = None
+    WRITER = None
+    SCRATCH = None
+    signal.signal(signal.SIGTERM, interrupt)
 
     parser = ArgumentParser()
     # arguments
@@ -389,12 +2967,148 @@ if __name__ == "__main__":
     # options
     parser.add_argument(
         "--out", dest="out", default="run.vcf",
-        help="the name of the output VCF file")
+        help="the name of the output VCF file; a name ending in .gz is "
+             "compressed with BGZF and indexed with tabix")
+    parser.add_argument(
+        "--bgzip-threads", type=int, dest="bgzip_threads",
+        default=multiprocessing.cpu_count(),
+        help="the number of threads compressing the output with --out *.gz")
     parser.add_argument(
         "--n-region", type=int, dest="n_region", default=2,
         help="the number of regions to process in parallel")
+    parser.add_argument(
+        "--mem-budget", dest="mem_budget", default=None,
+        help="only start regions while the memory they use stays under this "
+             "budget, i.e. 64G")
+    parser.add_argument(
+        "--n-extract", type=int, dest="n_extract", default=0,
+        help="the number of BAM files to extract regions from in parallel, "
+             "separately from the regions being called")
+    parser.add_argument(
+        "--queue-size", type=int, dest="queue_size", default=2,
+        help="the number of extracted regions that can wait to be called "
+             "when using --n-extract")
+    parser.add_argument(
+        "--window", dest="window", default=None,
+        help="split each region into windows of this size, i.e. 5M")
+    parser.add_argument(
+        "--bin-size", dest="bin_size", default=None,
+        help="pack regions shorter than this, i.e. 1M, into bins of up to this "
+             "many bases that are called together")
+    parser.add_argument(
+        "--bin-reads", type=int, dest="bin_reads", default=None,
+        help="pack regions with fewer reads than this into bins of up to this "
+             "many reads that are called together")
+    parser.add_argument(
+        "--targets", dest="targets", default=None,
+        help="only process the intervals of this BED file, i.e. the targets "
+             "of an exome or a panel, instead of whole regions")
+    parser.add_argument(
+        "--target-gap", dest="target_gap", default="100",
+        help="merge targets that are at most this many bases apart. The "
+             "default is 100")
+    parser.add_argument(
+        "--target-units", type=int, dest="target_units", default=None,
+        help="pack the targets into this many work units with about the same "
+             "number of reads; the default is four for each --n-region")
+    parser.add_argument(
+        "--no-intermediate", action="store_true", dest="no_intermediate",
+        help="call the regions directly on the indexed BAM files instead of "
+             "creating a BAM file for each region")
+    parser.add_argument(
+        "--plan", action="store_true", dest="plan",
+        help="print the order of the regions with their estimated costs and "
+             "exit")
+    parser.add_argument(
+        "--resume", action="store_true", dest="resume",
+        help="resume a previous run, skipping the regions it completed")
+    parser.add_argument(
+        "--batch-size", type=int, dest="batch_size", default=None,
+        help="call the samples in batches of this many BAM files and merge "
+             "the batches")
+    parser.add_argument(
+        "--engine", dest="engine", default="varscan",
+        choices=["varscan", "native"],
+        help="call SNPs with VarScan or with the native engine, which "
+             "implements mpileup2snp in-process")
+    parser.add_argument(
+        "--cache-dir", dest="cache_dir", default=None,
+        help="reuse the VCF files of regions whose inputs haven't changed "
+             "from this directory")
+    parser.add_argument(
+        "--cache-size", dest="cache_size", default="20G",
+        help="the most the cache can hold before the least recently used "
+             "regions are removed. The default is 20G")
+    parser.add_argument(
+        "--trace", dest="trace", default=None,
+        help="write a timing trace of every stage of every region to "
+             "TRACE.jsonl and TRACE.trace.json")
+    parser.add_argument(
+        "--scratch", dest="scratch", default=None,
+        help="stage the BAM files extracted for each region in this fast "
+             "directory, i.e. /dev/shm or a local SSD")
+    parser.add_argument(
+        "--scratch-size", dest="scratch_size", default=None,
+        help="the most space to use in the scratch directory, i.e. 32G; the "
+             "default is its free space")
+    parser.add_argument(
+        "--keep-going", action="store_true", dest="keep_going",
+        help="keep processing the other regions when one fails instead of "
+             "cancelling the run")
+    parser.add_argument(
+        "--queue", dest="queue", default=None,
+        help="publish the regions to this SQLite database on a shared "
+             "filesystem for `chromoprocessor worker` processes to run")
     parser.add_argument(
         "--verbose", "-v", action="store_true")
+
+    if sys.argv[1:2] == ["worker"]:
+        worker_parser = ArgumentParser(prog="chromoprocessor worker")
+        worker_parser.add_argument(
+            "queue",
+            help="the SQLite database the coordinator published to")
+        worker_parser.add_argument(
+            "--n-region", type=int, dest="n_region", default=2,
+            help="the number of regions to process in parallel")
+        worker_parser.add_argument(
+            "--lease", type=int, dest="lease", default=120,
+            help="the seconds without a heartbeat before another worker can "
+                 "claim this worker's regions")
+        worker_args = worker_parser.parse_args(sys.argv[2:])
+
+        # rebuild the coordinator's state from the plan
+        QUEUE = WorkQueue(os.path.abspath(worker_args.queue))
+        OWNER = "%s:%d" % (socket.gethostname(), os.getpid())
+        plan = QUEUE.plan()
+        os.chdir(plan["cwd"])
+        args = parser.parse_args(plan["argv"])
+        args.n_region = worker_args.n_region
+        args.trace = None
+        SAMTOOLS_CONF = plan["samtools_conf"]
+        VARSCAN_CONF = plan["varscan_conf"]
+        BASES = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+        NATIVE = native_settings()
+        HEADER = plan["header"]
+        SECTION_ORDER = dict((section, n) for (n, section)
+                             in enumerate(HEADER))
+        LENGTHS = plan["lengths"]
+        BINS = plan["bins"]
+        COSTS = plan["costs"]
+        FINGERPRINT = plan["fingerprint"]
+        TRACER = None
+        SCRATCH = make_scratch(plan["bamfiles"])
+        BUDGET = None
+        if args.mem_budget:
+            BUDGET = MemoryBudget(parse_size(args.mem_budget, binary=True),
+                                  COSTS)
+        s_print("worker %s started" % (OWNER))
+        try:
+            run_worker(plan["bamfiles"], worker_args.lease)
+        except KeyboardInterrupt:
+            sys.exit(1)
+        s_print("worker %s finished" % (OWNER))
+        sys.exit()
+
     args = parser.parse_args()
 
     check_input(args)
@@ -402,7 +3116,17 @@ if __name__ == "__main__":
 
     SAMTOOLS_CONF = read_conf_file("samtools.conf")
     VARSCAN_CONF = read_conf_file("varscan.conf")
-    bamfiles = []
+    BASES = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+    NATIVE = native_settings()
+    # the native engine extracts the regions with the samtools built into
+    # pysam, so it doesn't need samtools in the path
+    SAMTOOLS = ["samtools"]
+    if args.engine == "native":
+        SAMTOOLS = [sys.executable, "-c",
+                    "import sys, pysam; getattr(pysam, sys.argv[1])"
+                    "(*sys.argv[2:], catch_stdout=False)"]
+    if args.engine == "native":
+        check_native_engine()
     to_process = parse_input(args)
 
     # check if the files are valid
@@ -412,8 +3136,11 @@ if __name__ == "__main__":
     if args.verbose:
         s_print("found the following files: %s" % (', '.join(to_process)))
 
-    # create the BAM files
-    bamfiles = [pysam.Samfile(bam, "rb") for bam in to_process]
+    # the regions are read straight from the BAM files so they need an index
+    if args.no_intermediate:
+        check_indexes(to_process)
+
+    bamfiles = to_process
 
     # make sure all the files have the same header and regions
     (valid, HEADER) = check_headers(bamfiles)
@@ -422,7 +3149,123 @@ if __name__ == "__main__":
         sys.exit()
 
     natural_sort(HEADER)
+    SECTION_ORDER = dict((section, n) for (n, section) in enumerate(HEADER))
+
+    # split the regions into windows so the longest regions don't dominate
+    LENGTHS = extract_lengths(bamfiles[0])
+    window = parse_size(args.window) if args.window else None
+    REGIONS = split_regions(HEADER, LENGTHS, window)
+    if args.verbose and window is not None and not args.targets:
+        s_print("split %d regions into %d windows" % (len(HEADER),
+                len(REGIONS)))
+
+    # pack the small regions into bins so each bin only starts one VarScan
+    counts = count_reads(bamfiles)
+    BINS = {}
+    TARGET_BASES = {}
+    if args.targets:
+        # the targets take the place of the windows and the bins
+        if args.window or args.bin_size or args.bin_reads:
+            s_print("--window, --bin-size and --bin-reads are ignored with "
+                    "--targets", pro=ERR)
+        targets = merge_targets(read_targets(args.targets),
+                                parse_size(args.target_gap))
+        for target in targets:
+            (section, start, end) = parse_region(target)
+            TARGET_BASES[section] = (TARGET_BASES.get(section, 0) + end -
+                                     start + 1)
+        (REGIONS, BINS) = pack_targets(
+            targets, counts, args.target_units or 4 * args.n_region)
+        s_print("packed %d targets (%d bases) into %d units" %
+                (len(targets), sum(TARGET_BASES.values()), len(REGIONS)))
+    elif args.bin_size or args.bin_reads:
+        (REGIONS, BINS) = bin_regions(
+            REGIONS, counts, parse_size(args.bin_size) if args.bin_size
+            else None, args.bin_reads)
+        if args.verbose:
+            s_print("packed %d small regions into %d bins" %
+                    (sum(len(b) for b in BINS.values()), len(BINS)))
+
+    # regions without any reads have nothing to call, and the rest are started
+    # most expensive first so that they don't hold up the end of the run
+    COSTS = estimate_costs(REGIONS, counts)
+    REGIONS = [region for region in REGIONS if COSTS[region] > 0]
+    if REGIONS == []:
+        s_print("no mapped reads found; exiting", pro=ERR)
+        sys.exit()
+    SCHEDULE = sorted(REGIONS, key=lambda region: COSTS[region], reverse=True)
+    if args.plan:
+        print_plan(SCHEDULE, COSTS)
+        sys.exit()
 
-    make_dirs(HEADER)
-    create_threads(bamfiles)
-    concat_vcfs(vcf_dir_name)
+    # skip the regions that were completed by a previous run
+    completed = set()
+    if args.resume:
+        completed = read_manifest(manifest_name)
+        s_print("resuming; %d of %d regions already completed" %
+                (len(completed), len(REGIONS)))
+    to_run = [region for region in SCHEDULE if region not in completed]
+
+    # and the regions whose inputs haven't changed since they were cached
+    cached = []
+    FINGERPRINT = None
+    if args.cache_dir:
+        FINGERPRINT = inputs_fingerprint(bamfiles)
+        cached = [region for region in to_run
+                  if os.path.exists(cache_entry(region))]
+        to_run = [region for region in to_run if region not in cached]
+        s_print("%d of %d regions found in %s" % (len(cached), len(REGIONS),
+                args.cache_dir))
+
+    SCRATCH = None if args.queue else make_scratch(bamfiles)
+    make_dirs(to_run)
+    for region in cached:
+        restore_cached(region)
+        record_region(region)
+        completed.add(region)
+    if args.cache_dir:
+        # a run where every region is cached never stores an entry, so the
+        # cache is also fit into --cache-size here
+        with cache_lock:
+            evict_cached(parse_size(args.cache_size, binary=True))
+    TRACER = Tracer(args.trace) if args.trace else None
+    BUDGET = None
+    if args.mem_budget:
+        BUDGET = MemoryBudget(parse_size(args.mem_budget, binary=True),
+                              COSTS)
+    WRITER = OrderedWriter(args.out, REGIONS)
+    for region in REGIONS:
+        if region in completed:
+            WRITER.commit(region)
+    if args.queue:
+        QUEUE = WorkQueue(args.queue)
+        QUEUE.publish({"cwd": os.getcwd(), "argv": sys.argv[1:],
+                       "samtools_conf": SAMTOOLS_CONF,
+                       "varscan_conf": VARSCAN_CONF,
+                       "bamfiles": [os.path.abspath(bam) for bam in bamfiles],
+                       "header": HEADER, "lengths": LENGTHS, "bins": BINS,
+                       "costs": COSTS, "fingerprint": FINGERPRINT}, to_run)
+
+    # the failures of an earlier run were either resumed or are run again
+    if os.path.exists(failed_name):
+        os.remove(failed_name)
+    try:
+        if args.queue:
+            coordinate(to_run)
+        elif args.n_extract and not args.no_intermediate:
+            run_staged(bamfiles, to_run)
+        else:
+            create_threads(bamfiles, to_run)
+    except KeyboardInterrupt:
+        pass
+    finished = WRITER.close()
+    if TRACER is not None:
+        TRACER.close()
+    if not finished:
+        if FAILED:
+            s_print("%d regions failed; see %s" % (len(FAILED), failed_name),
+                    pro=ERR)
+        s_print("not every region finished; keeping %s" % (vcf_dir_name),
+                pro=ERR)
+        sys.exit(1)
+    clean_vcfs(vcf_dir_name)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""
+Writes the fixture of test_native.py: a 60 base reference, ref.fa, and two
+samples, s1.bam and s2.bam, with their indexes. Every read covers positions 11
+to 40. Sample 1 has twelve reads, six on each strand:
+
+    20  a heterozygous SNP on both strands; one reference base has a quality
+        of 14, under VarScan's --min-avg-qual
+    25  a homozygous SNP
+    30  a SNP only on the forward strand, filtered with str10
+    35  a single variant read, too few to call
+
+Sample 2 has five reads with the SNP at 25, too few to be covered.
+
+Samples 3 and 4, s3.bam and s4.bam, are only used by test_batches.py. They
+have ten and eleven reads with the same SNPs at 20, 25, and 30, so that every
+batch of --batch-size 2 has a record at each site, and the depths of the two
+samples don't divide evenly.
+"""
+
+import os
+import pysam
+
+REFERENCE = "GATTACACGTTGCAATCGGACTTAGCCATGCAAGTCCGATATGGCTACCATGGTCAATCG"
+FIRST = 10
+LENGTH = 30
+ALT = {'A': 'G', 'C': 'T', 'G': 'A', 'T': 'C'}
+
+
+def write_sample(name, reads):
+    """
+    :param name: the name of the BAM file
+    :param reads: a list of (is_reverse, {position: (alt?, quality)}) tuples
+    """
+    header = {"HD": {"VN": "1.4", "SO": "coordinate"},
+              "SQ": [{"SN": "chrT", "LN": len(REFERENCE)}],
+              "RG": [{"ID": name, "SM": name}]}
+    with pysam.AlignmentFile(name + ".bam", "wb", header=header) as bam:
+        for (n, (is_reverse, changes)) in enumerate(reads):
+            sequence = list(REFERENCE[FIRST:FIRST + LENGTH])
+            qualities = [40] * LENGTH
+            for (position, (alt, quality)) in changes.items():
+                offset = position - 1 - FIRST
+                if alt:
+                    sequence[offset] = ALT[sequence[offset]]
+                qualities[offset] = quality
+            read = pysam.AlignedSegment()
+            read.query_name = "%s.%d" % (name, n + 1)
+            read.flag = 16 if is_reverse else 0
+            read.reference_id = 0
+            read.reference_start = FIRST
+            read.mapping_quality = 60
+            read.cigarstring = "%dM" % (LENGTH)
+            read.query_sequence = ''.join(sequence)
+            read.query_qualities = pysam.qualitystring_to_array(
+                ''.join(chr(quality + 33) for quality in qualities))
+            read.set_tag("RG", name)
+            bam.write(read)
+    pysam.index(name + ".bam")
+
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    with open("ref.fa", "w") as fasta:
+        fasta.write(">chrT\n%s\n" % (REFERENCE))
+    pysam.faidx("ref.fa")
+    # reads 1-6 are forward and 7-12 reverse
+    reads = []
+    for n in range(1, 13):
+        changes = {25: (True, 40)}
+        if n in (1, 2, 3, 7, 8, 9):
+            changes[20] = (True, 40)
+        elif n == 12:
+            changes[20] = (False, 14)
+        if n <= 6:
+            changes[30] = (True, 40)
+        if n == 5:
+            changes[35] = (True, 40)
+        reads.append((n > 6, changes))
+    write_sample("s1", reads)
+    write_sample("s2", [(n > 3, {25: (True, 40)}) for n in range(1, 6)])
+    for (name, forward, count) in [("s3", 5, 10), ("s4", 6, 11)]:
+        reads = []
+        for n in range(1, count + 1):
+            changes = {25: (True, 40)}
+            if n <= 3 or forward < n <= forward + 3:
+                changes[20] = (True, 40)
+            if n <= forward:
+                changes[30] = (True, 40)
+            reads.append((n > forward, changes))
+        write_sample(name, reads)
@@ -0,0 +1,60 @@
+"""
+Checks that calling the samples in batches with --batch-size writes the same
+VCF file as calling them all at once, on four samples of the fixture in data/
+that every batch has a record for at each site.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from test_native import DATA, SCRIPT, SAMTOOLS_OPTIONS, VARSCAN_OPTIONS, \
+    numpy, records
+
+SAMPLES = ["s1.bam", "s2.bam", "s3.bam", "s4.bam"]
+
+
+@unittest.skipIf(numpy is None, "the native engine needs NumPy and pysam")
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirs = []
+
+    def tearDown(self):
+        for name in self.dirs:
+            shutil.rmtree(name)
+
+    def call(self, *options):
+        """
+        Runs chromoprocessor with the native engine on the samples in a
+        directory of its own
+        :return: the records it wrote
+        """
+        cwd = tempfile.mkdtemp()
+        self.dirs.append(cwd)
+        for (name, conf_options) in [("samtools.conf", SAMTOOLS_OPTIONS),
+                                     ("varscan.conf", VARSCAN_OPTIONS)]:
+            with open(os.path.join(cwd, name), "w") as conf:
+                conf.write(''.join(option + "\n" for option in conf_options))
+        cmd = [sys.executable, SCRIPT, "VarScan.jar", "mpileup2snp",
+               "--engine", "native", "--list"] + \
+              [os.path.join(DATA, sample) for sample in SAMPLES]
+        with open(os.devnull, "w") as devnull:
+            code = subprocess.call(cmd + list(options), cwd=cwd,
+                                   stdout=devnull, stderr=devnull)
+        self.assertEqual(code, 0)
+        return records(os.path.join(cwd, "run.vcf"))
+
+    def test_batches_match_one_call(self):
+        self.assertEqual(self.call("--batch-size", "2"), self.call())
+
+    def test_batches_match_one_call_without_intermediate(self):
+        self.assertEqual(self.call("--batch-size", "2", "--no-intermediate"),
+                         self.call("--no-intermediate"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+"""
+Checks that --cache-size is applied on a run where every region is found in
+the cache, which never adds an entry to it.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from test_native import DATA, SCRIPT, SAMTOOLS_OPTIONS, VARSCAN_OPTIONS, \
+    numpy, records
+
+
+def cache_sizes(cache_dir):
+    """
+    :return: the size of every entry in the cache
+    """
+    return [os.path.getsize(os.path.join(root, name))
+            for (root, _, files) in os.walk(cache_dir)
+            for name in files if name.endswith(".vcf")]
+
+
+@unittest.skipIf(numpy is None, "the native engine needs NumPy and pysam")
+class CacheSizeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.cwd, "cache")
+        for (name, options) in [("samtools.conf", SAMTOOLS_OPTIONS),
+                                ("varscan.conf", VARSCAN_OPTIONS)]:
+            with open(os.path.join(self.cwd, name), "w") as conf:
+                conf.write(''.join(option + "\n" for option in options))
+
+    def tearDown(self):
+        shutil.rmtree(self.cwd)
+
+    def call(self, *options):
+        """
+        Runs chromoprocessor with the native engine and the cache on the
+        fixture, split into windows so there is more than one region
+        :return: the output of the run
+        """
+        cmd = [sys.executable, SCRIPT, "VarScan.jar", "mpileup2snp",
+               "--engine", "native", "--window", "20",
+               "--cache-dir", self.cache_dir, "--list",
+               os.path.join(DATA, "s1.bam"), os.path.join(DATA, "s2.bam")]
+        process = subprocess.Popen(cmd + list(options), cwd=self.cwd,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0)
+        return output
+
+    def test_limit_applies_when_every_region_is_cached(self):
+        self.call()
+        expected = records(os.path.join(self.cwd, "run.vcf"))
+        sizes = cache_sizes(self.cache_dir)
+        self.assertTrue(len(sizes) > 1)
+        limit = sum(sizes) - 1
+        output = self.call("--cache-size", str(limit))
+        self.assertIn("%d of %d regions found" % (len(sizes), len(sizes)),
+                      output)
+        self.assertEqual(records(os.path.join(self.cwd, "run.vcf")), expected)
+        self.assertTrue(sum(cache_sizes(self.cache_dir)) <= limit)
+        self.assertTrue(len(cache_sizes(self.cache_dir)) < len(sizes))
+
+
+if __name__ == '__main__':
+    unittest.main()
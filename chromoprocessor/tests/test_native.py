@@ -0,0 +1,74 @@
+"""
+Checks that the native engine calls the same SNPs as VarScan mpileup2snp on the
+fixture in data/; see data/README.md for how expected.vcf is recorded. The
+native engine doesn't need samtools or VarScan, so neither is run.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+try:
+    import numpy
+    import pysam
+except ImportError:
+    numpy = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DATA = os.path.join(HERE, "data")
+SCRIPT = os.path.join(os.path.dirname(HERE), "chromoprocessor.py")
+# the options expected.vcf is recorded with
+SAMTOOLS_OPTIONS = ["-f", os.path.join(DATA, "ref.fa"), "-B"]
+VARSCAN_OPTIONS = ["--p-value", "0.05"]
+
+
+def records(vcf_name):
+    """
+    :return: the lines of a VCF file after the meta-information lines, which
+    depend on the version of VarScan
+    """
+    with open(vcf_name, "r") as vcf_file:
+        return [line for line in vcf_file if not line.startswith("##")]
+
+
+@unittest.skipIf(numpy is None, "the native engine needs NumPy and pysam")
+class NativeEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = tempfile.mkdtemp()
+        for (name, options) in [("samtools.conf", SAMTOOLS_OPTIONS),
+                                ("varscan.conf", VARSCAN_OPTIONS)]:
+            with open(os.path.join(self.cwd, name), "w") as conf:
+                conf.write(''.join(option + "\n" for option in options))
+
+    def tearDown(self):
+        shutil.rmtree(self.cwd)
+
+    def call(self, *options):
+        """
+        Runs chromoprocessor with the native engine on the fixture
+        :return: the records it wrote
+        """
+        cmd = [sys.executable, SCRIPT, "VarScan.jar", "mpileup2snp",
+               "--engine", "native", "--list",
+               os.path.join(DATA, "s1.bam"), os.path.join(DATA, "s2.bam")]
+        with open(os.devnull, "w") as devnull:
+            code = subprocess.call(cmd + list(options), cwd=self.cwd,
+                                   stdout=devnull, stderr=devnull)
+        self.assertEqual(code, 0)
+        return records(os.path.join(self.cwd, "run.vcf"))
+
+    def test_matches_varscan(self):
+        self.assertEqual(self.call("--no-intermediate"),
+                         records(os.path.join(DATA, "expected.vcf")))
+
+    def test_matches_varscan_on_extracted_regions(self):
+        self.assertEqual(self.call(),
+                         records(os.path.join(DATA, "expected.vcf")))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -31,14 +31,25 @@ arguments to `samtools mpileup` and another to VarScan. I tried to make this
 program as modular as possible, the only function that I can think of that is
 too monolithic is run_with_pipe, but that's just my opinion.
 
+Each region that finishes is recorded in a manifest in the vcf directory, so a
+run that was interrupted can be picked back up with `--resume`. With
+`--scratch`, the bam and mpileup files of each region are written to a fast
+directory instead of the working directory, as long as they fit.
+
 TODO
 * allow for stderr of programs to go to /dev/null
-* add a 'restart' option
 """
 
 import subprocess
 import os
 import sys
+import time
+import atexit
+import shutil
+import signal
+import tempfile
+import threading
+from itertools import islice
 from time import strftime
 from multiprocessing import Lock
 try:
@@ -89,12 +100,184 @@ def safe_mkdir(dirname):
     exists with that name, the program exits gracefully with a nice message.
     :param dirname: the name of the directory to make
     """
+    if args.resume and os.path.isdir(dirname):
+        return
     try:
         os.mkdir(dirname)
     except OSError:
-        print "please remove/rename/move %s" % (dirname)
+        print "please remove/rename/move %s or pass --resume" % (dirname)
+        sys.exit()
+
+def verify_vcf(vcf_name):
+    """
+    Checks that a vcf file was completely written: it has a header line and ends
+    with a newline.
+    :param vcf_name: the name of the vcf file
+    :return: True if the vcf file is complete and False otherwise
+    """
+    try:
+        with open(vcf_name, "rb") as vcf_file:
+            found_header = False
+            last = ''
+            for line in vcf_file:
+                if line.startswith('#CHROM'):
+                    found_header = True
+                last = line
+            return found_header and last.endswith('\n')
+    except IOError:
+        return False
+
+def read_manifest():
+    """
+    Reads the manifest of a previous run and returns the regions whose vcf files
+    are still complete and unchanged.
+    :return: a set of the completed regions
+    """
+    completed = set()
+    try:
+        with open(manifest_name, "r") as manifest:
+            for line in manifest:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 2:
+                    # a partially written line
+                    continue
+                (region, size) = fields
+                vcf_name = os.path.join(vcf_dir, region + ".vcf")
+                if (os.path.exists(vcf_name) and
+                        os.path.getsize(vcf_name) == int(size) and
+                        verify_vcf(vcf_name)):
+                    completed.add(region)
+    except IOError:
+        pass
+    return completed
+
+def record_region(region):
+    """
+    Records a region in the manifest once its vcf file has been verified.
+    :param region: the region that finished
+    """
+    vcf_name = os.path.join(vcf_dir, region + ".vcf")
+    if not verify_vcf(vcf_name):
+        l_print("> %s is incomplete" % (vcf_name))
+        return
+    LOCK.acquire()
+    with open(manifest_name, "a") as manifest:
+        manifest.write("%s\t%d\n" % (region, os.path.getsize(vcf_name)))
+        manifest.flush()
+        os.fsync(manifest.fileno())
+    LOCK.release()
+
+def parse_size(size):
+    """
+    Parses a size such as '32G' or '500M' into a number of bytes
+    :param size: the size to parse
+    :return: the size as an int
+    """
+    units = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+    size = size.strip().upper()
+    try:
+        if size[-1] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(size)
+    except (ValueError, IndexError):
+        print "> invalid size: %s" % (size)
         sys.exit()
 
+def count_reads(samfile):
+    """
+    Counts the mapped reads in each region from the index, i.e. `samtools
+    idxstats`
+    :param samfile: the bam file to process
+    :return: a dict mapping each region to its number of mapped reads
+    """
+    reads = {}
+    stats = pysam.idxstats(samfile.filename)
+    # older versions of pysam return a list of lines
+    if not isinstance(stats, basestring):
+        stats = ''.join(stats)
+    for line in stats.splitlines():
+        fields = line.split('\t')
+        if len(fields) >= 4 and fields[0] != '*':
+            reads[fields[0]] = int(fields[2])
+    return reads
+
+def estimate_scratch(samfile):
+    """
+    Estimates the size of the bam and mpileup files of each region from the
+    index. The bam file of a region takes its share of the bam file; the
+    mpileup file has a line for every covered base with a base and a quality
+    for every read over it.
+    :param samfile: the bam file to process
+    :return: a dict mapping each region to its estimate in bytes
+    """
+    lengths = dict((SQ['SN'], SQ['LN']) for SQ in samfile.header['SQ'])
+    reads = count_reads(samfile)
+    total = sum(reads.values())
+    per_read = os.path.getsize(samfile.filename) / float(total or 1)
+    sample = [read.query_length or 0
+              for read in islice(samfile.fetch(until_eof=True), 1000)]
+    read_length = sum(sample) / float(len(sample) or 1)
+
+    estimates = {}
+    for (region, length) in lengths.items():
+        bases = reads.get(region, 0) * read_length
+        estimates[region] = int(reads.get(region, 0) * per_read + 2 * bases +
+                                20 * min(length, bases))
+    return estimates
+
+def stage(region):
+    """
+    Picks where the intermediate files of a region go: the scratch directory if
+    they fit in what is left of the budget and the working directory otherwise
+    :param region: the region to stage
+    """
+    LOCK.acquire()
+    need = SCRATCH_ESTIMATES.get(region, 0)
+    if sum(STAGED.values()) + need <= scratch_size:
+        STAGED[region] = need
+        PLACES[region] = scratch_dir
+    else:
+        PLACES[region] = ''
+    LOCK.release()
+    if args.verbose:
+        l_print("> %s staging %s in %s (estimated %d MB)" %
+            (strftime(t_format), region, PLACES[region] or "the working "
+             "directory", need / 2 ** 20))
+
+def staged_name(region, directory, extension):
+    """
+    Returns the name of an intermediate file of a region
+    :param region: the region
+    :param directory: bam_dir or mpileup_dir
+    :param extension: 'bam' or 'mpileup'
+    :return: the name of the file
+    """
+    return os.path.join(PLACES.get(region, ''), directory,
+                        region + "." + extension)
+
+def unstage(region):
+    """
+    Moves the intermediate files of a region that are kept out of the scratch
+    directory, removes the rest, and gives back the space
+    :param region: the region that finished or failed
+    """
+    if PLACES.get(region):
+        for (directory, extension, keep) in \
+                ((bam_dir, "bam", args.keep_bam),
+                 (mpileup_dir, "mpileup", args.keep_mpileup)):
+            name = staged_name(region, directory, extension)
+            if not os.path.exists(name):
+                continue
+            if keep:
+                shutil.move(name, os.path.join(directory,
+                                               region + "." + extension))
+            else:
+                os.remove(name)
+    LOCK.acquire()
+    STAGED.pop(region, None)
+    PLACES.pop(region, None)
+    LOCK.release()
+
 def parse_header(samfile):
     """
     Returns the sections from 'samfile'
@@ -125,6 +308,25 @@ def build_varscan_args(mpileup_file_name):
 
     return args
 
+def build_view_args(region):
+    """
+    Returns the `samtools view` command that extracts a region from the bam
+    file. With --targets, a read that overlaps more than one of the targets of
+    a unit is only extracted once (-M).
+    :param region: the region to extract
+    :return: a list of arguments for subprocess
+    """
+    multi = ["-M"] if TARGETS else []
+    return ["samtools", "view", "-b"] + multi + [BAM_FILE.filename] + \
+        region_intervals(region)
+
+def target_args():
+    """
+    :return: the arguments that restrict `samtools mpileup` to the targets with
+    --targets
+    """
+    return ["-l", targets_name] if TARGETS else []
+
 def build_samtools_args(bam_file_name):
     """
     Parses a file containing the arguments for `samtools mpileup` and returns a
@@ -138,6 +340,7 @@ def build_samtools_args(bam_file_name):
         args.append(bam_file_name)
     else:
         args.extend(["-", "-o", "-"])
+    args.extend(target_args())
 
     LOCK.acquire()
     for line in SAMTOOLS_CONF:
@@ -147,6 +350,226 @@ def build_samtools_args(bam_file_name):
 
     return args
 
+################################################################################
+#                           preparing the bam file
+################################################################################
+def is_sorted(bam_name):
+    """
+    Checks the `SO` tag of the header of a bam file
+    :param bam_name: the name of the bam file
+    :return: True if the bam file is sorted by coordinate
+    """
+    samfile = pysam.Samfile(bam_name, "rb")
+    try:
+        return samfile.header.get('HD', {}).get('SO') == 'coordinate'
+    finally:
+        samfile.close()
+
+def has_fresh_index(bam_name):
+    """
+    Checks for an index of a bam file (i.e. `your.bam.bai` or `your.bai`) that
+    is at least as new as the bam file itself
+    :param bam_name: the name of the bam file
+    :return: True if the bam file doesn't need to be indexed
+    """
+    indexes = [bam_name + ".bai", bam_name + ".csi",
+               os.path.splitext(bam_name)[0] + ".bai"]
+    modified = os.path.getmtime(bam_name)
+    return any(os.path.exists(index) and os.path.getmtime(index) >= modified
+               for index in indexes)
+
+def sort_bam(bam_name):
+    """
+    Sorts a bam file by coordinate with `samtools sort`, using `--threads`
+    threads with `--sort-memory` each. A sorted file left by an earlier run is
+    reused as long as it is newer than the bam file. The sorted file is only
+    renamed into place once it's complete.
+    :param bam_name: the name of the bam file
+    :return: the name of the sorted bam file, i.e. your.sorted.bam
+    """
+    sorted_name = os.path.splitext(bam_name)[0] + ".sorted.bam"
+    if os.path.exists(sorted_name) and \
+            os.path.getmtime(sorted_name) >= os.path.getmtime(bam_name) and \
+            is_sorted(sorted_name):
+        if args.verbose:
+            print "> reusing %s" % (sorted_name)
+        return sorted_name
+    if args.verbose:
+        print "> sorting %s into %s" % (bam_name, sorted_name)
+    partial_name = sorted_name + ".part"
+    code = subprocess.call(["samtools", "sort", "-@", str(args.threads),
+                            "-m", args.sort_memory, "-O", "bam",
+                            "-T", sorted_name + ".tmp",
+                            "-o", partial_name, bam_name])
+    if code != 0:
+        if os.path.exists(partial_name):
+            os.remove(partial_name)
+        print "> samtools sort failed on %s" % (bam_name)
+        sys.exit(1)
+    os.rename(partial_name, sorted_name)
+    return sorted_name
+
+def index_bam(bam_name):
+    """
+    Indexes a bam file with `samtools index` using `--threads` threads
+    :param bam_name: the name of the bam file
+    """
+    if args.verbose:
+        print "> indexing %s for viewing" % (bam_name)
+    code = subprocess.call(["samtools", "index", "-@", str(args.threads),
+                            bam_name])
+    if code != 0:
+        print "> samtools index failed on %s" % (bam_name)
+        sys.exit(1)
+
+def prepare_bam(bam_name):
+    """
+    Gets the bam file ready for processing by region, skipping the work that
+    isn't needed: a bam file whose header says it's sorted by coordinate isn't
+    sorted again, and one with an index newer than itself isn't indexed again.
+    A missing index is always created since viewing a region needs one.
+    :param bam_name: the name of the bam file
+    :return: the name of the bam file to process, which is the sorted file if
+    the bam file had to be sorted
+    """
+    if args.sort:
+        if is_sorted(bam_name):
+            if args.verbose:
+                print "> %s is already sorted" % (bam_name)
+        else:
+            bam_name = sort_bam(bam_name)
+    if has_fresh_index(bam_name):
+        if args.verbose:
+            print "> %s is already indexed" % (bam_name)
+    else:
+        index_bam(bam_name)
+    return bam_name
+
+################################################################################
+#                         restricting work to targets
+################################################################################
+def read_targets(bed_name, lengths):
+    """
+    Reads the intervals of a BED file, skipping its header lines and the
+    intervals on sections that aren't in the bam file
+    :param bed_name: the name of the BED file
+    :param lengths: a dict with the length of each section
+    :return: a list of (section, start, end) tuples with one-based, inclusive
+    coordinates
+    """
+    targets = []
+    missing = set()
+    with open(bed_name, "r") as bed:
+        for line in bed:
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            fields = line.split()
+            try:
+                (section, start, end) = (fields[0], int(fields[1]),
+                                         int(fields[2]))
+            except (IndexError, ValueError):
+                print "> invalid BED line: %s" % (line.rstrip('\n'))
+                sys.exit()
+            if section not in lengths:
+                missing.add(section)
+                continue
+            end = min(end, lengths[section])
+            if end > start:
+                targets.append((section, start + 1, end))
+    if missing:
+        print "> skipping the targets on sections that aren't in the bam " \
+            "file: %s" % (', '.join(sorted(missing)))
+    return targets
+
+def merge_targets(targets, gap, sections):
+    """
+    Sorts the targets into the order of the sections and merges the ones that
+    overlap or are at most `gap` bases apart
+    :param targets: a list of (section, start, end) tuples
+    :param gap: the most bases between two targets that are merged
+    :param sections: the sections in the order of the header
+    :return: a list of the merged targets as [section, start, end] lists
+    """
+    order = dict((section, n) for (n, section) in enumerate(sections))
+    merged = []
+    for (section, start, end) in sorted(
+            targets, key=lambda target: (order[target[0]], target[1])):
+        if merged and merged[-1][0] == section and \
+                start - merged[-1][2] - 1 <= gap:
+            merged[-1][2] = max(merged[-1][2], end)
+        else:
+            merged.append([section, start, end])
+    return merged
+
+def pack_targets(targets, reads, units):
+    """
+    Packs the merged targets into about `units` work units with the same
+    estimated number of reads. The reads of a section are assumed to be spread
+    evenly over its targets. A unit only holds the neighbouring targets of one
+    section and is named after the span of its targets, i.e. chr1:1001-90300,
+    which is also the samtools region of the span.
+    :param targets: the merged targets in order
+    :param reads: a dict with the number of mapped reads in each section
+    :param units: the number of work units to aim for
+    :return: a list of the units in order, and a dict mapping each unit to its
+    targets as samtools regions
+    """
+    bases = {}
+    for (section, start, end) in targets:
+        bases[section] = bases.get(section, 0) + end - start + 1
+    cost = lambda target: (reads.get(target[0], 0) *
+                           (target[2] - target[1] + 1) / float(bases[target[0]]))
+    share = sum(cost(target) for target in targets) / float(max(1, units))
+    packed = []
+    intervals = {}
+    current = []
+    total = 0.0
+    for (n, target) in enumerate(targets):
+        current.append(target)
+        total += cost(target)
+        # close the unit once the reads so far reach its share of the total,
+        # and at the end of every section
+        if total >= share * (len(packed) + 1) or n + 1 == len(targets) or \
+                targets[n + 1][0] != target[0]:
+            unit = "%s:%d-%d" % (target[0], current[0][1], current[-1][2])
+            packed.append(unit)
+            intervals[unit] = ["%s:%d-%d" % tuple(t) for t in current]
+            current = []
+    return (packed, intervals)
+
+def region_intervals(region):
+    """
+    Returns the samtools regions to extract for a region: the targets of a unit
+    with --targets, or the region itself
+    :param region: the region
+    :return: a list of samtools regions
+    """
+    return TARGETS.get(region, [region])
+
+def region_span(region):
+    """
+    Returns the section and the one-based, inclusive coordinates that a region
+    or a samtools region spans, i.e. chr1:1001-1200 -> ('chr1', 1001, 1200)
+    :param region: the region
+    :return: a tuple of the section, the start, and the end of the region
+    """
+    if region in LENGTHS:
+        return (region, 1, LENGTHS[region])
+    (section, span) = region.rsplit(':', 1)
+    (start, end) = span.split('-')
+    return (section, int(start), int(end))
+
+def target_share(region):
+    """
+    Returns the share of its section's targets that a unit holds
+    :param region: the unit
+    :return: a tuple of the section and the share
+    """
+    section = region_span(region)[0]
+    bases = sum(region_span(interval)[2] - region_span(interval)[1] + 1
+                for interval in TARGETS[region])
+    return (section, bases / float(TARGET_BASES[section]))
+
 ################################################################################
 #                     functions that do the heavy lifting
 ################################################################################
@@ -156,12 +579,32 @@ def run(region):
     region, in turn this mpileup file is used to create a vcf file.
     :param region: the region to process
     """
-    region_bam = create_bam(region)
-    region_mpileup = create_mpileup(region, region_bam)
-    create_vcf(region, region_mpileup)
+    STARTED[region] = time.time()
+    if scratch_dir is not None:
+        stage(region)
+    try:
+        region_bam = create_bam(region)
+        region_mpileup = create_mpileup(region, region_bam)
+        create_vcf(region, region_mpileup)
 
-    region_bam.close()
-    region_mpileup.close()
+        region_bam.close()
+        region_mpileup.close()
+    except (Superseded, Cancelled, CommandFailed) as error:
+        # the speculative copy of the region finished first, the run was
+        # interrupted, or a command failed, so the partial intermediate files
+        # aren't worth keeping
+        for name in (staged_name(region, bam_dir, "bam"),
+                     staged_name(region, mpileup_dir, "mpileup")):
+            if os.path.exists(name):
+                os.remove(name)
+        if isinstance(error, CommandFailed):
+            region_failed(region, "original", error)
+        return
+    finally:
+        if scratch_dir is not None:
+            unstage(region)
+    if claim(region, "original"):
+        record_region(region)
 
 def create_bam(region):
     """
@@ -169,11 +612,10 @@ def create_bam(region):
     :param region: the region to make a bam file from
     :return: a file object for the bam file
     """
-    bam_f = open(os.path.join(bam_dir, region + ".bam"), "w+b")
+    bam_f = open(staged_name(region, bam_dir, "bam"), "w+b")
     if args.verbose:
         l_print("> %s creating %s" % (strftime(t_format), bam_f.name))
-    subprocess.call(["samtools", "view", "-b", BAM_FILE.filename, region],
-        stdout=bam_f)
+    call(region, "original", build_view_args(region), stdout=bam_f)
     if args.verbose:
         l_print("> %s FINISHED bam file for %s" % (strftime(t_format), region))
 
@@ -186,10 +628,11 @@ def create_mpileup(region, bam_f):
     :param bam_f: the bam file to make the mpileup file from
     :return: a file object for the mpileup file
     """
-    mpileup_f = open(os.path.join(mpileup_dir, region + ".mpileup"), "w+b")
+    mpileup_f = open(staged_name(region, mpileup_dir, "mpileup"), "w+b")
     if args.verbose:
         l_print("> %s creating %s" % (strftime(t_format), mpileup_f.name))
-    subprocess.call(build_samtools_args(bam_f.name), stdout=mpileup_f)
+    call(region, "original", build_samtools_args(bam_f.name),
+        stdout=mpileup_f)
     if not args.keep_bam:
         os.remove(bam_f.name)
     if args.verbose:
@@ -204,49 +647,74 @@ def create_vcf(region, mpileup_f):
     :param region: the region to process
     :mpileup_f: the mpileup file to make the vcf file from
     """
-    vcf_f = open(os.path.join(vcf_dir, region + ".vcf"), "w+")
+    vcf_f = open_vcf(region)
     if args.verbose:
         l_print("> %s creating vcf for %s" % (strftime(t_format), region))
-    subprocess.call(build_varscan_args(mpileup_f.name), stdout=vcf_f)
+    try:
+        call(region, "original", build_varscan_args(mpileup_f.name),
+            stdout=vcf_f)
+    finally:
+        vcf_f.close()
     if not args.keep_mpileup:
         os.remove(mpileup_f.name)
     if args.verbose:
         l_print("> %s FINISHED vcf file for %s" % (strftime(t_format), region))
 
-    vcf_f.close()
-
 def run_with_pipe(region):
     """
     Runs the same commands as `run` but in a true pipeline
     :param region: the region to process
     """
-    # it's important that the last command in the pipeline is evoked with
-    # `subprocess.call`. If it's not, the program will terminate without waiting
-    # for the processes to finish and you'll have to manually kill them.
+    # it's important to wait for every command in the pipeline. If the program
+    # doesn't, it will terminate without waiting for the processes to finish
+    # and you'll have to manually kill them.
     if args.verbose:
         l_print("> %s starting region %s" % (strftime(t_format), region))
-    bam = subprocess.Popen(["samtools", "view", "-b", BAM_FILE.filename, region],
-        stdout=subprocess.PIPE)
-    mpileup = subprocess.Popen(build_samtools_args(""), stdin=bam.stdout,
-        stdout=subprocess.PIPE)
-    vcf_f = open(os.path.join(vcf_dir, region + ".vcf"), "w+")
-    subprocess.call(build_varscan_args(""), stdin=mpileup.stdout, stdout=vcf_f)
+    STARTED[region] = time.time()
+    try:
+        bam = start(region, "original", build_view_args(region),
+            stdout=subprocess.PIPE)
+        mpileup = start(region, "original", build_samtools_args(""),
+            stdin=bam.stdout, stdout=subprocess.PIPE)
+        # close the ends of the pipes this process doesn't need, so a command
+        # sees its neighbour die
+        bam.stdout.close()
+        vcf_f = open_vcf(region)
+        try:
+            varscan = start(region, "original", build_varscan_args(""),
+                stdin=mpileup.stdout, stdout=vcf_f)
+            mpileup.stdout.close()
+            varscan.wait()
+        finally:
+            vcf_f.close()
+        # the first command that failed is the one to blame
+        for process in (bam, mpileup, varscan):
+            check(region, "original", process)
+    except (Superseded, Cancelled):
+        # the speculative copy of the region finished first or the run was
+        # interrupted
+        return
+    except CommandFailed as error:
+        region_failed(region, "original", error)
+        return
 
-    # close the pipes
-    bam.stdout.close()
-    mpileup.stdout.close()
+    if not claim(region, "original"):
+        return
+    record_region(region)
 
     if args.verbose:
         l_print("> %s FINISHED region %s" % (strftime(t_format), region))
 
-def concat_vcfs(vcf_dir):
+def concat_vcfs(vcf_dir, regions):
     """
     Concats all the vcf files created into a new file in the same directory.
     :param vcf_dir: the directory with the vcf files to concat
+    :param regions: the regions in the order to concat them
+    :return: True if vcf-concat exited 0 and False otherwise
     """
     arg_list = ["vcf-concat"]
-    for vcf in os.listdir(vcf_dir):
-        arg_list.append(os.path.join(vcf_dir, vcf))
+    for region in regions:
+        arg_list.append(os.path.join(vcf_dir, region + ".vcf"))
     if args.verbose:
         print "%s running vcf_concat on the files in %s" %\
             (strftime(t_format), vcf_dir)
@@ -254,26 +722,401 @@ def concat_vcfs(vcf_dir):
     # added to the list; if it's created before very bad things happen
     vcf_file = open(os.path.join(vcf_dir,
         get_file_prefix(BAM_FILE.filename) + ".vcf"), "w+")
-    subprocess.call(arg_list, stdout=vcf_file)
+    code = subprocess.call(arg_list, stdout=vcf_file)
 
     vcf_file.close()
+    if code != 0:
+        print "> vcf-concat failed on the files in %s" % (vcf_dir)
+    return code == 0
+
+################################################################################
+#                       speculating on straggler regions
+################################################################################
+class Superseded(Exception):
+    """
+    Raised when one side of a region--the original run or its speculative
+    copy--tries to start a command after the other side has already won
+    """
+    pass
+
+class Cancelled(Exception):
+    """
+    Raised when a region tries to start a command, or a command was killed,
+    after the run was interrupted
+    """
+    pass
+
+class CommandFailed(Exception):
+    """
+    Raised when a command of a region exits with an error or is killed
+    """
+
+    def __init__(self, process):
+        """
+        :param process: the subprocess.Popen object of the command
+        """
+        if process.returncode < 0:
+            reason = "was killed by signal %d" % (-process.returncode)
+        else:
+            reason = "exited with %d" % (process.returncode)
+        Exception.__init__(self, "%s %s" % (process.name, reason))
+
+def start(region, side, cmd, **kwargs):
+    """
+    Starts a command for one side of a region and keeps track of it so it can
+    be killed if the other side wins
+    :param region: the region the command is run for
+    :param side: 'original' or 'speculative'
+    :param cmd: the command list
+    :param kwargs: the keyword arguments for subprocess.Popen
+    :return: the subprocess.Popen object
+    """
+    # the commands of other regions must not inherit the ends of this region's
+    # pipes, or they won't see the end of their input until those exit
+    kwargs.setdefault("close_fds", True)
+    # each command gets its own process group so that it can be killed along
+    # with anything it started, i.e. the JVM's children
+    kwargs.setdefault("preexec_fn", os.setpgrp)
+    with STATE_LOCK:
+        if ABORTED.is_set():
+            raise Cancelled(region)
+        if WON.get(region, side) != side:
+            raise Superseded(region)
+        process = subprocess.Popen(cmd, **kwargs)
+        process.name = "VarScan" if cmd[0] == "java" else " ".join(cmd[:2])
+        PROCS.setdefault((region, side), []).append(process)
+    return process
+
+def check(region, side, process):
+    """
+    Waits for a command of one side of a region and checks its exit code
+    :param region: the region the command is run for
+    :param side: 'original' or 'speculative'
+    :param process: the subprocess.Popen object of the command
+    :raises Superseded: if the command was killed because the other side won
+    :raises Cancelled: if the command was killed because the run was
+    interrupted
+    :raises CommandFailed: if the command exited with an error or was killed
+    """
+    if process.wait() == 0:
+        return
+    with STATE_LOCK:
+        if ABORTED.is_set():
+            raise Cancelled(region)
+        if WON.get(region, side) != side:
+            raise Superseded(region)
+    raise CommandFailed(process)
+
+def call(region, side, cmd, **kwargs):
+    """
+    Runs a command for one side of a region and waits for it
+    :param region: the region the command is run for
+    :param side: 'original' or 'speculative'
+    :param cmd: the command list
+    :param kwargs: the keyword arguments for subprocess.Popen
+    :raises CommandFailed: if the command exited with an error or was killed
+    """
+    check(region, side, start(region, side, cmd, **kwargs))
+
+def region_failed(region, side, error):
+    """
+    Records a region that failed in the failed file of the vcf directory. It
+    isn't recorded in the manifest, so `--resume` runs it again. When the
+    original run of a straggler fails while its speculative copy can still
+    finish, the speculative copy decides, and the other way around.
+    :param region: the region that failed
+    :param side: 'original' or 'speculative'
+    :param error: the exception it failed with
+    """
+    with STATE_LOCK:
+        if WON.get(region, side) != side:
+            return
+        speculation = SPECULATING.get(region)
+        if side == "original" and speculation is not None:
+            if (speculation["ok"] or
+                    speculation["finished"] < len(speculation["parts"])):
+                speculation["original_failed"] = error
+                l_print("> %s original run of %s failed (%s); waiting for "
+                    "the speculative run" % (strftime(t_format), region, error))
+                return
+        FAILED[region] = error
+    l_print("> %s %s failed: %s" % (strftime(t_format), region, error))
+    LOCK.acquire()
+    with open(failed_name, "a") as failed_file:
+        failed_file.write("%s\t%s\n" % (region, error))
+    LOCK.release()
+
+def open_vcf(region):
+    """
+    Opens the vcf file of a region for its original run, unless the region's
+    speculative copy has already replaced it
+    :param region: the region
+    :return: the vcf file object
+    """
+    with STATE_LOCK:
+        if WON.get(region, "original") != "original":
+            raise Superseded(region)
+        WRITING.add(region)
+        return open(os.path.join(vcf_dir, region + ".vcf"), "w+")
+
+def kill(region, side):
+    """
+    Kills the process groups of the running commands of one side of a region.
+    Must be called with STATE_LOCK held.
+    :param region: the region
+    :param side: 'original' or 'speculative'
+    """
+    for process in PROCS.pop((region, side), []):
+        if process.poll() is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                # already exited
+                pass
+
+def abort():
+    """
+    Stops the run after Ctrl-C or SIGTERM, which don't reach the commands in
+    their own process groups: kills every running command, and no command
+    starts after.
+    """
+    with STATE_LOCK:
+        ABORTED.set()
+        for (region, side) in list(PROCS):
+            kill(region, side)
 
-def run_processes(infile):
+def interrupt(signum, frame):
+    """
+    Handles SIGTERM like Ctrl-C
+    """
+    raise KeyboardInterrupt()
+
+def claim(region, side):
+    """
+    Claims a region for the side that finished it first and kills the other
+    side
+    :param region: the region that finished
+    :param side: 'original' or 'speculative'
+    :return: True if this side won and False if the other side already had
+    """
+    with STATE_LOCK:
+        if WON.get(region, side) != side:
+            return False
+        WON[region] = side
+        kill(region, "speculative" if side == "original" else "original")
+        PROCS.pop((region, side), None)
+        if side == "original":
+            DURATIONS[region] = time.time() - STARTED[region]
+    if region in SPECULATING:
+        l_print("> %s %s run of %s finished first" %
+            (strftime(t_format), side, region))
+    return True
+
+def last_position(vcf_name):
+    """
+    Finds the position of the last complete record of a vcf file that is still
+    being written
+    :param vcf_name: the name of the vcf file
+    :return: a tuple of the position, 0 if there are no records, and the
+    complete lines up to and including that record
+    """
+    lines = []
+    position = 0
+    try:
+        with open(vcf_name, "r") as vcf_f:
+            for line in vcf_f:
+                if not line.endswith('\n'):
+                    # still being written
+                    break
+                lines.append(line)
+                if not line.startswith('#'):
+                    position = int(line.split('\t')[1])
+    except IOError:
+        pass
+    return (position, lines)
+
+def split_remaining(region, parts):
+    """
+    Splits what is left of a straggler into intervals, each run by its own
+    `samtools mpileup -r` on the bam file, while the original keeps running.
+    The records the original already wrote are kept.
+    :param region: the straggler
+    :param parts: the number of intervals to split it into
+    :return: a list of (interval, part file name) tuples
+    """
+    vcf_name = os.path.join(vcf_dir, region + ".vcf")
+    # a vcf file the original hasn't opened yet is left over from an earlier
+    # run
+    (done, lines) = last_position(vcf_name) if region in WRITING else (0, [])
+    with open(os.path.join(vcf_dir, region + ".spec0.vcf"), "w") as kept:
+        kept.writelines(lines)
+    (section, first, length) = region_span(region)
+    done = max(done, first - 1)
+    step = max(1, (length - done + parts - 1) // parts)
+    intervals = []
+    for (n, begin) in enumerate(xrange(done + 1, length + 1, step)):
+        intervals.append(("%s:%d-%d" % (section, begin,
+                                        min(length, begin + step - 1)),
+                          os.path.join(vcf_dir, "%s.spec%d.vcf" %
+                                       (region, n + 1))))
+    return intervals
+
+def run_part(region, interval, part_name):
+    """
+    Runs one interval of a straggler's speculative copy. The part that finishes
+    last puts the region's vcf file together, if the original hasn't finished
+    by then.
+    :param region: the straggler
+    :param interval: the interval to run, i.e. chr1:1000001-2000000
+    :param part_name: the name of the vcf file of the interval
+    """
+    ok = False
+    try:
+        with open(part_name, "w+") as part_f:
+            mpileup = start(region, "speculative",
+                ["samtools", "mpileup", "-r", interval, BAM_FILE.filename] +
+                target_args() + [line.strip('\n') for line in SAMTOOLS_CONF],
+                stdout=subprocess.PIPE)
+            # VarScan reads the pileup from stdin whether or not --with-pipe
+            # was given
+            varscan = start(region, "speculative",
+                ["java", "-jar", varscan_location, action] +
+                [line.strip('\n') for line in VARSCAN_CONF],
+                stdin=mpileup.stdout, stdout=part_f)
+            mpileup.stdout.close()
+            ok = varscan.wait() == 0 and mpileup.wait() == 0
+    except (Superseded, Cancelled):
+        pass
+    with STATE_LOCK:
+        speculation = SPECULATING[region]
+        speculation["finished"] += 1
+        speculation["ok"] = speculation["ok"] and ok
+        last = speculation["finished"] == len(speculation["parts"])
+        original_failed = speculation["original_failed"]
+    if not last:
+        return
+    if speculation["ok"] and claim(region, "speculative"):
+        assemble(region, speculation["parts"])
+        record_region(region)
+    elif not speculation["ok"] and original_failed is not None:
+        # both sides failed
+        region_failed(region, "speculative", original_failed)
+    elif not speculation["ok"] and WON.get(region) != "original":
+        l_print("> %s speculative run of %s failed; waiting for the original"
+            % (strftime(t_format), region))
+    for name in [os.path.join(vcf_dir, region + ".spec0.vcf")] + \
+            [name for (_, name) in speculation["parts"]]:
+        if os.path.exists(name):
+            os.remove(name)
+
+def assemble(region, parts):
+    """
+    Puts a region's vcf file together from the records its original run wrote
+    before it was split and the vcf files of the intervals, then replaces the
+    original's vcf file with it
+    :param region: the region
+    :param parts: the intervals, as returned by split_remaining
+    """
+    vcf_name = os.path.join(vcf_dir, region + ".vcf")
+    kept_name = os.path.join(vcf_dir, region + ".spec0.vcf")
+    with open(vcf_name + ".tmp", "w") as vcf_f:
+        with open(kept_name, "r") as kept:
+            wrote_header = False
+            for line in kept:
+                wrote_header = wrote_header or line.startswith('#')
+                vcf_f.write(line)
+        for (_, part_name) in parts:
+            with open(part_name, "r") as part_f:
+                for line in part_f:
+                    if line.startswith('#'):
+                        if not wrote_header:
+                            vcf_f.write(line)
+                        continue
+                    vcf_f.write(line)
+            wrote_header = True
+    # the original may still be writing to its file until it dies
+    os.rename(vcf_name + ".tmp", vcf_name)
+
+def find_straggler(running):
+    """
+    Finds the region that has run longest past its predicted time. The time is
+    predicted from its number of reads and the seconds per read of the regions
+    that have finished.
+    :param running: the regions that are running
+    :return: the straggler or None if no region is running longer than
+    `--speculate` times its prediction
+    """
+    rates = sorted(DURATIONS[region] / READS[region] for region in DURATIONS
+                   if READS.get(region))
+    if not rates:
+        return None
+    rate = rates[len(rates) // 2]
+    straggler = None
+    worst = args.speculate
+    for region in running:
+        if region in SPECULATING or region in WON:
+            continue
+        predicted = max(1.0, READS.get(region, 0) * rate)
+        late = (time.time() - STARTED[region]) / predicted
+        if late > worst:
+            (straggler, worst) = (region, late)
+    return straggler
+
+def speculate(executor, futures):
+    """
+    Once every region has started, splits a straggler over the idle workers
+    :param executor: the ThreadPoolExecutor running the regions
+    :param futures: a dict mapping each future to its region
+    """
+    if any(not (f.running() or f.done()) for f in futures):
+        # there is still work waiting for a worker
+        return
+    idle = args.n_procs - sum(1 for f in futures if f.running())
+    if idle < 1:
+        return
+    running = [futures[f] for f in futures if f.running() and
+               futures[f] in STARTED]
+    straggler = find_straggler(running)
+    if straggler is None:
+        return
+    parts = split_remaining(straggler, idle)
+    l_print("> %s %s is a straggler; running the rest of it as %d intervals"
+        % (strftime(t_format), straggler, len(parts)))
+    SPECULATING[straggler] = {"parts": parts, "finished": 0, "ok": True,
+                              "original_failed": None}
+    for (interval, part_name) in parts:
+        futures[executor.submit(run_part, straggler, interval, part_name)] = \
+            straggler
+
+def run_processes(regions):
     """
     Function to spawn and join the processes
-    :param infile: the initial bam file to process
+    :param regions: the regions to process
     """
     # awesome ThreadPoolExecutor from Python 3. Allows you to control how many
     # concurrent processes are running at once. Useful in this program since
     # each region can use a lot of memory.
-    if args.verbose:
-        print "> parsing header sections"
     with ThreadPoolExecutor(max_workers=args.n_procs) as executor:
-        for region in parse_header(infile):
+        futures = {}
+        for region in regions:
             if not with_pipe:
-                executor.submit(run, region)
+                futures[executor.submit(run, region)] = region
             else:
-                executor.submit(run_with_pipe, region)
+                futures[executor.submit(run_with_pipe, region)] = region
+        originals = list(futures)
+        try:
+            while not all(future.done() for future in futures):
+                time.sleep(1)
+                if args.speculate:
+                    speculate(executor, futures)
+        except KeyboardInterrupt:
+            # the regions that are still waiting are cancelled as they start
+            abort()
+            raise
+    # i.e. a command that couldn't be started at all
+    for future in originals:
+        if future.exception() is not None:
+            region_failed(futures[future], "original", future.exception())
 
 if __name__ == '__main__':
     # parse the command line arguments
@@ -292,9 +1135,15 @@ if __name__ == '__main__':
         help="the location of samtools.conf (defaults to the working directory")
     # options related to bam files
     parser.add_argument("--sort", action="store_true", dest="sort",
-        help="use if the file needs to be sorted (implies --index)")
+        help="sort the file unless its header says it's sorted")
     parser.add_argument("--index", action="store_true", dest="index",
-        help="use if the file needs to be indexed")
+        help="no longer needed; the file is indexed whenever its index is "
+             "missing or older than the file")
+    parser.add_argument("--threads", dest="threads", default=None, type=int,
+        help="the number of threads to sort and index with (defaults to "
+             "--n-procs)")
+    parser.add_argument("--sort-memory", dest="sort_memory", default="768M",
+        help="the memory for each thread to sort with, i.e. 2G")
     # options
     parser.add_argument("--with-pipe", action="store_true", dest="with_pipe",
         help="instead of writing to disk, the commands are piped")
@@ -306,13 +1155,43 @@ if __name__ == '__main__':
         dest="keep_mpileup", help="keeps the intermediate mpileup files")
     parser.add_argument("--keep-all", action="store_true", dest="keep_all",
         help="keeps bam and mpileup files")
+    parser.add_argument("--scratch", dest="scratch", default=None,
+        help="write the bam and mpileup files to this fast directory, i.e. "
+             "/dev/shm or a local SSD")
+    parser.add_argument("--scratch-size", dest="scratch_size", default=None,
+        help="the most space to use in the scratch directory, i.e. 32G "
+             "(defaults to its free space)")
+    parser.add_argument("--speculate", type=float, nargs='?', const=2.0,
+        default=None, dest="speculate", metavar="FACTOR",
+        help="once every region has started, split a region that has run "
+             "FACTOR (default 2) times longer than predicted over the idle "
+             "processes")
+    parser.add_argument("--targets", dest="targets", default=None,
+        help="only process the intervals of this BED file, i.e. the targets "
+             "of an exome or a panel, instead of whole regions")
+    parser.add_argument("--target-gap", dest="target_gap", default=100,
+        type=int, help="merge targets that are at most this many bases apart "
+                       "(defaults to 100)")
+    parser.add_argument("--target-units", dest="target_units", default=None,
+        type=int, help="pack the targets into this many units with about the "
+                       "same number of reads (defaults to four per --n-procs)")
+    parser.add_argument("--resume", action="store_true", dest="resume",
+        help="resume a previous run, skipping the regions it completed")
     parser.add_argument('-v', "--verbose", action="store_true", dest="verbose",
         help="output additional information")
     args = parser.parse_args()
 
     LOCK = Lock()
-
-    BAM_FILE = pysam.Samfile(args.infile, "rb")
+    # the state of the regions for --speculate
+    STATE_LOCK = threading.Lock()
+    STARTED = {}
+    DURATIONS = {}
+    PROCS = {}
+    WON = {}
+    WRITING = set()
+    SPECULATING = {}
+    # set once the run is interrupted
+    ABORTED = threading.Event()
 
     # global variables just to save some typing
     action = args.action
@@ -346,32 +1225,107 @@ if __name__ == '__main__':
         args.keep_bam = False
         args.keep_mpileup = False
 
+    # the regions whose commands failed
+    FAILED = {}
+
+    # get the file ready for processing (if necessary)
+    if args.threads is None:
+        args.threads = args.n_procs
+    BAM_FILE = pysam.Samfile(prepare_bam(args.infile), "rb")
+
     # append the name of the file to the dirs to avoid name conflicts
     bam_dir = "bam_" + get_file_prefix(BAM_FILE.filename)
     mpileup_dir = "mpileup_" + get_file_prefix(BAM_FILE.filename)
     vcf_dir = "vcf_" + get_file_prefix(BAM_FILE.filename)
+    manifest_name = os.path.join(vcf_dir, "manifest.txt")
+    failed_name = os.path.join(vcf_dir, "failed.txt")
     t_format = '%H:%M:%S'
 
-    # get the file ready for processing (if necessary)
-    if args.sort:
-        args.index = True
-        sorted_file = append_file_name(BAM_FILE.filename, "sorted")
-        if args.verbose:
-            print "> sorting %s for indexing" % (BAM_FILE.filename)
-            print "> creating %s" % (sorted_file)
-        subprocess.call(["samtools", "sort", BAM_FILE.filename, sorted_file])
-    if args.index:
-        if args.verbose:
-            print "> indexing %s for viewing" % (BAM_FILE.filename)
-        subprocess.call(["samtools", "index", BAM_FILE.filename])
-
     # create directories to avoid a messy working directory
     if not with_pipe:
         safe_mkdir(bam_dir)
         safe_mkdir(mpileup_dir)
     safe_mkdir(vcf_dir)
 
-    run_processes(BAM_FILE)
+    # stage the intermediate files in the scratch directory; it's removed
+    # however the program exits
+    scratch_dir = None
+    STAGED = {}
+    PLACES = {}
+    if args.scratch and not with_pipe:
+        if args.scratch_size:
+            scratch_size = parse_size(args.scratch_size)
+        else:
+            stats = os.statvfs(args.scratch)
+            scratch_size = stats.f_bavail * stats.f_frsize
+        SCRATCH_ESTIMATES = estimate_scratch(BAM_FILE)
+        scratch_dir = tempfile.mkdtemp(prefix="chromosplit.", dir=args.scratch)
+        atexit.register(shutil.rmtree, scratch_dir, True)
+        os.mkdir(os.path.join(scratch_dir, bam_dir))
+        os.mkdir(os.path.join(scratch_dir, mpileup_dir))
+
+    if args.verbose:
+        print "> parsing header sections"
+    regions = parse_header(BAM_FILE)
+    LENGTHS = dict((SQ['SN'], SQ['LN']) for SQ in BAM_FILE.header['SQ'])
+    # the predicted time of a region is proportional to its reads
+    READS = count_reads(BAM_FILE) if args.speculate else {}
+
+    # restrict the work to the targets, packed into units with about the same
+    # number of reads that take the place of the regions
+    TARGETS = {}
+    TARGET_BASES = {}
+    targets_name = os.path.join(vcf_dir, "targets.bed")
+    if args.targets:
+        targets = merge_targets(read_targets(args.targets, LENGTHS),
+                                args.target_gap, regions)
+        if not targets:
+            print "> no targets found; exiting"
+            sys.exit()
+        for (section, first, last) in targets:
+            TARGET_BASES[section] = (TARGET_BASES.get(section, 0) + last -
+                                     first + 1)
+        (regions, TARGETS) = pack_targets(targets, count_reads(BAM_FILE),
+            args.target_units or 4 * args.n_procs)
+        with open(targets_name, "w") as bed:
+            for (section, first, last) in targets:
+                bed.write("%s\t%d\t%d\n" % (section, first - 1, last))
+        print "> packed %d targets (%d bases) into %d units" %\
+            (len(targets), sum(TARGET_BASES.values()), len(regions))
+        # the reads and the scratch space of a unit are its share of its
+        # section's
+        shares = dict((unit, target_share(unit)) for unit in regions)
+        if READS:
+            READS = dict((unit, int(READS.get(section, 0) * share))
+                         for (unit, (section, share)) in shares.items())
+        if scratch_dir is not None:
+            SCRATCH_ESTIMATES = dict(
+                (unit, int(SCRATCH_ESTIMATES.get(section, 0) * share))
+                for (unit, (section, share)) in shares.items())
+
+    # skip the regions that were completed by a previous run
+    completed = set()
+    if args.resume:
+        completed = read_manifest()
+        print "> resuming; %d of %d regions already completed" %\
+            (len(completed), len(regions))
+
+    if os.path.exists(failed_name):
+        os.remove(failed_name)
+    signal.signal(signal.SIGTERM, interrupt)
+    try:
+        run_processes([region for region in regions
+                       if region not in completed])
+    except KeyboardInterrupt:
+        BAM_FILE.close()
+        print "> interrupted; killed every running command, run again with " \
+            "--resume"
+        sys.exit(1)
+    if FAILED:
+        BAM_FILE.close()
+        print "> %d regions failed; see %s and run again with --resume" %\
+            (len(FAILED), failed_name)
+        sys.exit(1)
 
     # clean up (if necessary)
     if not args.keep_bam and not with_pipe:
@@ -380,4 +1334,5 @@ if __name__ == '__main__':
         os.rmdir(mpileup_dir)
     BAM_FILE.close()
 
-    concat_vcfs(vcf_dir)
+    if not concat_vcfs(vcf_dir, regions):
+        sys.exit(1)
@@ -0,0 +1,75 @@
+"""
+Checks that the raw engine writes byte for byte what the PyVCF engine writes
+on data/edge.vcf, which has missing and truncated subfields, fields with
+Number=A and Number=., an Integer that has to be read as a Float, a '.'
+genotype and fields that aren't in the header.
+"""
+
+import os
+import imp
+import shutil
+import tempfile
+import unittest
+
+try:
+    import vcf
+except ImportError:
+    vcf = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+VCF_NAME = os.path.join(HERE, "data", "edge.vcf")
+FIELDS = ["GT", "AD", "FREQ", "AF", "Q", "FL", "DP", "XX", "NM", "GQ", "PL"]
+
+
+@unittest.skipIf(vcf is None, "vcfparse needs PyVCF")
+class RawEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.vcfparse = imp.load_source(
+            "vcfparse", os.path.join(os.path.dirname(HERE), "vcfparse.py"))
+        # set by the main block of vcfparse.py
+        self.vcfparse.NA = './.'
+        self.vcfparse.BUFFER_SIZE = 1 << 20
+        # small enough for the raw engine to write more than one batch
+        self.vcfparse.BATCH_SIZE = 2
+        self.cwd = os.getcwd()
+        self.dirs = []
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        for name in self.dirs:
+            shutil.rmtree(name)
+
+    def run_engine(self, engine):
+        """
+        Runs an engine on the fixture in a directory of its own
+        :param engine: a function of the vcf.Reader that runs the engine
+        :return: a dictionary of the name of each output file to its contents
+        """
+        name = tempfile.mkdtemp()
+        self.dirs.append(name)
+        os.chdir(name)
+        with open(VCF_NAME, "r") as vcf_f:
+            engine(vcf.Reader(vcf_f))
+        os.chdir(self.cwd)
+        outputs = {}
+        for output in os.listdir(name):
+            with open(os.path.join(name, output), "rb") as out:
+                outputs[output] = out.read()
+        return outputs
+
+    def test_matches_pyvcf(self):
+        parsed = self.run_engine(
+            lambda reader: self.vcfparse.parse(reader, FIELDS))
+        parsed_raw = self.run_engine(
+            lambda reader: self.vcfparse.parse_raw(
+                reader, self.vcfparse.lines(reader, None), FIELDS))
+        self.assertEqual(sorted(parsed),
+                         sorted(field + ".txt" for field in FIELDS))
+        for field in FIELDS:
+            self.assertEqual(parsed_raw[field + ".txt"],
+                             parsed[field + ".txt"], field)
+
+
+if __name__ == '__main__':
+    unittest.main()
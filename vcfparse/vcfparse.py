@@ -16,8 +16,32 @@
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import re
+import sys
+import json
+import gzip
+import mmap
+import zlib
+import bisect
+import shutil
+import struct
+import multiprocessing
 import vcf
 import argparse
+from itertools import izip, dropwhile
+from vcf.parser import RESERVED_FORMAT
+try:
+    # only needed for --columnar
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    # only needed for --columnar parquet
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 def header():
     """
@@ -30,37 +54,866 @@ def header():
 
     return head
 
-def parse(vcf_file, field):
+def parse_region(region):
     """
-    Parses and prints specified fields from a vcf file.
-    :param vcf_file: the vcf file to parse
-    :param fields: the fields to parse and print from the vcf file.
+    Parses a region into its contig and its one-based, inclusive coordinates,
+    i.e. 'chr1:1,000-2,000' -> ('chr1', 1000, 2000). A region with one position
+    is just that position and a region that is only a contig is all of it.
+    :param region: the region to parse
+    :return: a tuple of the contig, the start, and the end of the region
+    """
+    (chrom, _, span) = region.rpartition(':')
+    span = span.replace(',', '')
+    try:
+        if '-' in span:
+            (start, end) = span.split('-', 1)
+            return (chrom, int(start), int(end) if end else sys.maxint)
+        return (chrom, int(span), int(span))
+    except ValueError:
+        # a contig name, which can have a ':' of its own
+        return (region, 1, sys.maxint)
+
+def read_regions_file(regions_name):
+    """
+    Reads the regions of a file with either a region, i.e. chr1:1000-2000, or
+    the tab separated contig, start and (optional) end of a region on each
+    line. The coordinates are one-based and inclusive, unless the file is a
+    BED file (it ends in .bed).
+    :param regions_name: the name of the file
+    :return: a list of (contig, start, end) tuples
+    """
+    shift = 1 if regions_name.endswith(".bed") else 0
+    regions = []
+    with open(regions_name, "r") as regions_file:
+        for line in regions_file:
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == 1:
+                regions.append(parse_region(fields[0]))
+                continue
+            start = int(fields[1]) + shift
+            end = int(fields[2]) if len(fields) > 2 else start - shift
+            regions.append((fields[0], start, end))
+    return regions
+
+def merge_regions(regions):
+    """
+    Sorts the regions of each contig and merges the ones that overlap, so no
+    record is parsed twice. The contigs stay in the order they were given in.
+    :param regions: a list of (contig, start, end) tuples
+    :return: the merged list of (contig, start, end) tuples
+    """
+    contigs = []
+    for (chrom, _, _) in regions:
+        if chrom not in contigs:
+            contigs.append(chrom)
+    merged = []
+    for (chrom, start, end) in sorted(regions,
+            key=lambda region: (contigs.index(region[0]), region[1])):
+        if merged and merged[-1][0] == chrom and start <= merged[-1][2] + 1:
+            merged[-1][2] = max(merged[-1][2], end)
+        else:
+            merged.append([chrom, start, end])
+    return [tuple(region) for region in merged]
+
+def build_index(vcf_name):
+    """
+    Builds the index of a plain text vcf file: for every contig, the positions
+    of a record every INDEX_SPACING bytes and the offsets of those records in
+    the file, along with the longest REF of the contig. The records of each
+    contig have to be together and sorted by position.
+    :param vcf_name: the name of the vcf file
+    :return: the index
+    """
+    stat = os.stat(vcf_name)
+    contigs = {}
+    (chrom, last_position, checkpoint) = (None, 0, 0)
+    offset = 0
+    with open(vcf_name, "rb") as vcf_f:
+        for line in vcf_f:
+            if not line.startswith('#') and line.strip():
+                fields = line.split('\t', 4)
+                position = int(fields[1])
+                if fields[0] != chrom:
+                    if fields[0] in contigs:
+                        sys.exit("%s isn't sorted; the records of %s aren't "
+                                 "together" % (vcf_name, fields[0]))
+                    chrom = fields[0]
+                    contigs[chrom] = {"positions": [], "offsets": [],
+                                      "max_ref": 1}
+                    checkpoint = None
+                elif position < last_position:
+                    sys.exit("%s isn't sorted; %s:%d comes after %s:%d" %
+                             (vcf_name, chrom, position, chrom, last_position))
+                contig = contigs[chrom]
+                if checkpoint is None or offset - checkpoint >= INDEX_SPACING:
+                    contig["positions"].append(position)
+                    contig["offsets"].append(offset)
+                    checkpoint = offset
+                contig["max_ref"] = max(contig["max_ref"], len(fields[3]))
+                last_position = position
+            offset += len(line)
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "contigs": contigs}
+
+def load_index(vcf_name):
+    """
+    Loads the index of a plain text vcf file, `<vcf_file>.vpi`. The index is
+    built, and saved next to the vcf file if possible, when there isn't one or
+    the vcf file has changed since it was built.
+    :param vcf_name: the name of the vcf file
+    :return: the index
+    """
+    index_name = vcf_name + ".vpi"
+    stat = os.stat(vcf_name)
+    try:
+        with open(index_name, "r") as index_f:
+            index = json.load(index_f)
+        if index["size"] == stat.st_size and index["mtime"] == stat.st_mtime:
+            return index
+    except (IOError, ValueError, KeyError):
+        pass
+    index = build_index(vcf_name)
+    try:
+        with open(index_name + ".tmp", "w") as index_f:
+            json.dump(index, index_f)
+        os.rename(index_name + ".tmp", index_name)
+    except (IOError, OSError):
+        sys.stderr.write("couldn't save the index to %s\n" % (index_name))
+    return index
+
+def fetch_plain(vcf_file, index, region):
+    """
+    Points a vcf.Reader of a plain text vcf file at the records that overlap a
+    region, the way vcf.Reader.fetch does with a tabix index. The records are
+    read from the last indexed record before any record that could overlap the
+    region.
+    :param vcf_file: the vcf.Reader
+    :param index: the index of the vcf file
+    :param region: a (contig, start, end) tuple
+    :return: the vcf.Reader
+    """
+    (chrom, start, end) = region
+
+    def lines():
+        contig = index["contigs"].get(chrom)
+        if contig is None:
+            return
+        n = bisect.bisect_left(contig["positions"],
+                               start - contig["max_ref"] + 1)
+        with open(vcf_file.filename, "rb") as vcf_f:
+            vcf_f.seek(contig["offsets"][max(0, n - 1)])
+            for line in vcf_f:
+                fields = line.split('\t', 4)
+                if fields[0] != chrom or int(fields[1]) > end:
+                    break
+                if int(fields[1]) + len(fields[3]) - 1 >= start:
+                    yield line
+
+    vcf_file.reader = lines()
+    return vcf_file
+
+def previous_ends(regions, before=None):
+    """
+    Pairs each of the merged regions with the end of the region before it on
+    the same contig. A record that overlaps a region but starts at or before
+    that end, i.e. a deletion with a long REF, also overlaps the region before
+    and was already returned for it.
+    :param regions: a list of (contig, start, end) tuples from merge_regions
+    :param before: the region before the first one, when the regions are a
+    group of a longer list
+    :return: a generator of (region, end) tuples, where end is 0 if no region
+    comes before it on its contig
+    """
+    for region in regions:
+        if before is not None and before[0] == region[0]:
+            yield (region, before[2])
+        else:
+            yield (region, 0)
+        before = region
+
+def records(vcf_file, regions, before=None):
+    """
+    Returns the records of a vcf file that overlap the regions, with the
+    tabix index of a bgzipped vcf file or the index of a plain text one. A
+    record that overlaps more than one region is only returned once.
+    :param vcf_file: the vcf.Reader
+    :param regions: a list of (contig, start, end) tuples or None for every
+    record
+    :param before: the region before the first one, see previous_ends
+    :return: an iterable of the records
+    """
+    if regions is None:
+        return vcf_file
+    return (record for (region, seen) in previous_ends(regions, before)
+            for record in dropwhile(lambda record: record.POS <= seen,
+                                    query(vcf_file, region)))
+
+def query(vcf_file, region):
+    """
+    :param vcf_file: the vcf.Reader
+    :param region: a (contig, start, end) tuple
+    :return: the vcf.Reader pointed at the records that overlap the region
     """
+    (chrom, start, end) = region
+    if not vcf_file.filename.endswith(".gz"):
+        return fetch_plain(vcf_file, load_index(vcf_file.filename), region)
+    try:
+        return vcf_file.fetch(chrom, start - 1,
+                              None if end == sys.maxint else end)
+    except ValueError:
+        # the contig isn't in the index
+        vcf_file.reader = iter([])
+        return vcf_file
 
-    # begin parsing (and printing)
-    with open(field + ".txt", "w+") as out:
+def lines(vcf_file, regions, before=None):
+    """
+    Returns the lines of the records of a vcf file that overlap the regions,
+    for the raw engine. A record that overlaps more than one region is only
+    returned once.
+    :param vcf_file: the vcf.Reader, which has already read the header
+    :param regions: a list of (contig, start, end) tuples or None for every
+    record
+    :param before: the region before the first one, see previous_ends
+    :return: an iterable of the lines
+    """
+    if regions is None:
+        return vcf_file.reader
+    return (line for (region, seen) in previous_ends(regions, before)
+            for line in dropwhile(
+                lambda line: int(line.split('\t', 2)[1]) <= seen,
+                query(vcf_file, region).reader))
+
+def part_name(field, part):
+    """
+    :param field: the field
+    :param part: the number of the part
+    :return: the name of the file of a part of the output of a field
+    """
+    return "%s.txt.part%d" % (field, part)
+
+def open_outputs(fields, part=None):
+    """
+    Opens the output file of every field, `<FIELD>.txt`, and writes its
+    header, or opens the file of a part of the output of every field, which
+    has no header, when a chunk is parsed by a worker with --jobs
+    :param fields: the fields
+    :param part: the number of the part or None for the output files
+    :return: a list of the open files
+    """
+    if part is not None:
+        return [open(part_name(field, part), "w", BUFFER_SIZE)
+                for field in fields]
+    outs = [open(field + ".txt", "w+", BUFFER_SIZE) for field in fields]
+    for out in outs:
         out.write(header())
+    return outs
+
+def parse(vcf_file, fields, part=None):
+    """
+    Parses and prints specified fields from a vcf file. Every field is written
+    to its own file, `<FIELD>.txt`, in a single pass over the records.
+    :param vcf_file: the records of the vcf file to parse
+    :param fields: the fields to parse and print from the vcf file.
+    :param part: the number of the part to write instead of the output files
+    """
+    outs = open_outputs(fields, part)
+    try:
+        # begin parsing (and printing)
         for record in vcf_file:
             for sample in record:
-                if sample[field] is None:
-                    out.write("{0}\t{1}\t{2}\t{3}\n".
-                              format(record.CHROM, record.POS, NA,
-                                     sample.sample))
-                else:
+                for (field, out) in zip(fields, outs):
+                    # a field that isn't in the FORMAT of a record is missing
+                    value = getattr(sample.data, field, None)
                     out.write("{0}\t{1}\t{2}\t{3}\n".
                               format(record.CHROM, record.POS,
-                                     str(sample[field]), sample.sample))
+                                     NA if value is None else str(value),
+                                     sample.sample))
+    finally:
+        for out in outs:
+            out.close()
+
+def format_type(vcf_file, field):
+    """
+    :param vcf_file: the vcf.Reader, which has already read the header
+    :param field: the field
+    :return: a tuple of the Type and the Number of the field in the header, or
+    of its type in the VCF specification and None if it isn't in the header
+    """
+    try:
+        return (vcf_file.formats[field].type, vcf_file.formats[field].num)
+    except KeyError:
+        return (RESERVED_FORMAT.get(field, 'String'), None)
+
+def converter(vcf_file, field):
+    """
+    Returns a function that converts the raw value of a field the way PyVCF
+    does, using the Type and Number of the field from the header, so that the
+    raw engine writes exactly what parse does
+    :param vcf_file: the vcf.Reader, which has already read the header
+    :param field: the field
+    :return: a function from the raw value to the value, which is None if the
+    value is missing
+    """
+    if field == 'GT':
+        return lambda raw: raw
+    (entry_type, entry_num) = format_type(vcf_file, field)
+
+    def convert(raw):
+        if not raw or raw == '.':
+            return None
+        if entry_num == 1 or ',' not in raw:
+            if entry_type == 'Integer':
+                try:
+                    return int(raw)
+                except ValueError:
+                    return float(raw)
+            elif entry_type == 'Float':
+                return float(raw)
+            return raw
+        values = raw.split(',')
+        if entry_type == 'Integer':
+            try:
+                return map(int, values)
+            except ValueError:
+                return map(float, values)
+        elif entry_type == 'Float' or entry_type == 'Numeric':
+            return map(float, values)
+        return values
+
+    return convert
+
+def parse_raw(vcf_file, vcf_lines, fields, part=None):
+    """
+    The raw engine: parses and prints the same output as parse, but splits the
+    lines itself instead of building PyVCF records. Only the requested fields
+    are converted, the position of each of them is looked up once for every
+    distinct FORMAT, and the output is written in batches.
+    :param vcf_file: the vcf.Reader, which has already read the header
+    :param vcf_lines: the lines of the records to parse
+    :param fields: the fields to parse and print from the vcf file.
+    :param part: the number of the part to write instead of the output files
+    """
+    converters = [converter(vcf_file, field) for field in fields]
+    # the tail of every line of each sample
+    tails = ["\t%s\n" % (sample) for sample in vcf_file.samples]
+    # FORMAT -> the position of each field in it, its converter and its batch
+    layouts = {}
+    whitespace = re.compile('\t| +')
+    outs = open_outputs(fields, part)
+    batches = [[] for field in fields]
+    try:
+        for line in vcf_lines:
+            line = line.rstrip()
+            # PyVCF splits on runs of spaces too
+            row = whitespace.split(line) if ' ' in line else line.split('\t')
+            if len(row) < 10 or row[8] == '.':
+                continue
+            layout = layouts.get(row[8])
+            if layout is None:
+                keys = row[8].split(':')
+                # a field that isn't in the FORMAT is always missing
+                layout = layouts[row[8]] = [
+                    (keys.index(field) if field in keys else len(keys) + 1,
+                     convert, batch.append)
+                    for (field, convert, batch) in
+                    zip(fields, converters, batches)]
+            head = "%s\t%d\t" % (row[0], int(row[1]))
+            for (sample, tail) in izip(row[9:], tails):
+                values = sample.split(':')
+                count = len(values)
+                for (position, convert, append) in layout:
+                    value = convert(values[position]) \
+                        if position < count else None
+                    append(head + (NA if value is None else str(value)) +
+                           tail)
+            if len(batches[0]) >= BATCH_SIZE:
+                for (out, batch) in zip(outs, batches):
+                    out.writelines(batch)
+                    del batch[:]
+        for (out, batch) in zip(outs, batches):
+            out.writelines(batch)
+    finally:
+        for out in outs:
+            out.close()
+
+def collect(vcf_file, vcf_lines, fields):
+    """
+    Collects the sites of the records and the raw value of every field of
+    every sample for the columnar output, splitting the lines the way the raw
+    engine does. The values are kept as byte strings until every record has
+    been read, so the type of a field can be chosen from all of its values.
+    :param vcf_file: the vcf.Reader, which has already read the header
+    :param vcf_lines: the lines of the records to collect
+    :param fields: the fields to collect
+    :return: a tuple of the CHROM, POS, REF and ALT arrays of the sites and a
+    list of the sites x samples matrix of the raw values of each field
+    """
+    n_samples = len(vcf_file.samples)
+    sites = ([], [], [], [])
+    # the rows of each field and the matrices of the rows already converted
+    rows = [[] for field in fields]
+    blocks = [[] for field in fields]
+    # FORMAT -> the position of each field in it
+    layouts = {}
+    whitespace = re.compile('\t| +')
+
+    def flush():
+        for (row, block) in zip(rows, blocks):
+            block.append(numpy.array(row, dtype=str).
+                         reshape((len(row), n_samples)))
+            del row[:]
+
+    for line in vcf_lines:
+        line = line.rstrip()
+        row = whitespace.split(line) if ' ' in line else line.split('\t')
+        if len(row) < 10 or row[8] == '.':
+            continue
+        layout = layouts.get(row[8])
+        if layout is None:
+            keys = row[8].split(':')
+            # a field that isn't in the FORMAT is always missing
+            layout = layouts[row[8]] = [
+                keys.index(field) if field in keys else len(keys) + 1
+                for field in fields]
+        for (column, value) in zip(sites, (row[0], int(row[1]), row[3],
+                                           row[4])):
+            column.append(value)
+        samples = [sample.split(':') for sample in row[9:9 + n_samples]]
+        samples.extend([[]] * (n_samples - len(samples)))
+        for (position, field_rows) in zip(layout, rows):
+            field_rows.append([values[position] if position < len(values)
+                               else '' for values in samples])
+        if len(rows[0]) >= BATCH_SIZE:
+            flush()
+    flush()
+    return ([numpy.array(column, dtype=dtype) for (column, dtype) in
+             zip(sites, (str, numpy.int64, str, str))],
+            [numpy.concatenate(block) for block in blocks])
+
+def typed(vcf_file, field, raw):
+    """
+    Converts the sites x samples matrix of the raw values of a field to the
+    type of the field. An Integer field is converted to integers, and any
+    field other than GT whose values are all numbers, i.e. a Float field or
+    the FREQ of VarScan, which is a String like '45.5%', to floats. The other
+    fields are kept as strings, and a GT that's a no call, i.e. './.', is
+    missing.
+    :param vcf_file: the vcf.Reader, which has already read the header
+    :param field: the field
+    :param raw: the matrix of the raw values
+    :return: a tuple of the matrix and the matrix of whether each value is
+    missing; a missing float is also NaN and a missing string is empty
+    """
+    missing = (raw == '') | (raw == '.')
+    if field == 'GT':
+        # a no call is missing too
+        missing |= (raw == './.') | (raw == '.|.')
+        return (numpy.where(missing, '', raw), missing)
+    if format_type(vcf_file, field)[0] == 'Integer':
+        try:
+            return (numpy.where(missing, '0', raw).astype(numpy.int64),
+                    missing)
+        except ValueError:
+            pass
+    try:
+        return (numpy.where(missing, 'nan', numpy.char.rstrip(raw, '%')).
+                astype(numpy.float64), missing)
+    except ValueError:
+        return (numpy.where(missing, '', raw), missing)
+
+def write_columnar(vcf_file, fields, collected, columnar):
+    """
+    Writes the columnar output: the sites to `sites.<ext>` and the sites x
+    samples matrix of every field to `<FIELD>.<ext>`, where the extension is
+    parquet for Parquet files, which have a column for each sample with its
+    missing values as nulls, or npz for NumPy files, with the matrix in
+    `data` and whether each value is missing in `mask`
+    :param vcf_file: the vcf.Reader, which has already read the header
+    :param fields: the fields
+    :param collected: the result of collect for each chunk, in order
+    :param columnar: 'parquet' or 'npz'
+    """
+    names = ["CHROM", "POS", "REF", "ALT"]
+    sites = [numpy.concatenate([chunk[0][n] for chunk in collected])
+             for n in range(len(names))]
+    if columnar == 'parquet':
+        pyarrow.parquet.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(numpy.char.decode(column, 'utf8')
+                           if column.dtype.kind == 'S' else column)
+             for column in sites], names=names), "sites.parquet")
+    else:
+        numpy.savez_compressed("sites.npz", samples=vcf_file.samples,
+                               **dict(zip(names, sites)))
+    for (n, field) in enumerate(fields):
+        (matrix, missing) = typed(vcf_file, field, numpy.concatenate(
+            [chunk[1][n] for chunk in collected]))
+        if columnar == 'npz':
+            numpy.savez_compressed(field + ".npz", data=matrix, mask=missing)
+            continue
+        if matrix.dtype.kind == 'S':
+            matrix = numpy.char.decode(matrix, 'utf8')
+        pyarrow.parquet.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(matrix[:, i], mask=missing[:, i])
+             for i in range(len(vcf_file.samples))],
+            names=vcf_file.samples), field + ".parquet")
+
+def plain_chunks(vcf_name, n):
+    """
+    Splits the records of a plain text vcf file into about n ranges of bytes
+    of the same size. The end of each range is moved to the end of the line it
+    falls in, which is found in the memory mapped file.
+    :param vcf_name: the name of the vcf file
+    :param n: the number of ranges
+    :return: a list of (start, end) offsets
+    """
+    with open(vcf_name, "rb") as vcf_f:
+        first = 0
+        for line in vcf_f:
+            if not line.startswith('#'):
+                break
+            first += len(line)
+        size = os.fstat(vcf_f.fileno()).st_size
+        if first >= size:
+            return []
+        vcf_map = mmap.mmap(vcf_f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            bounds = [first]
+            for i in range(1, n):
+                bound = vcf_map.find('\n', first + (size - first) * i / n - 1)
+                if bound == -1:
+                    break
+                if bounds[-1] < bound + 1 < size:
+                    bounds.append(bound + 1)
+        finally:
+            vcf_map.close()
+    bounds.append(size)
+    return zip(bounds, bounds[1:])
+
+def plain_lines(vcf_name, start, end):
+    """
+    :param vcf_name: the name of a plain text vcf file
+    :param start: the offset of the first line
+    :param end: the offset after the last line
+    :return: the lines between the offsets
+    """
+    with open(vcf_name, "rb") as vcf_f:
+        vcf_f.seek(start)
+        left = end - start
+        for line in vcf_f:
+            if left <= 0:
+                break
+            left -= len(line)
+            if line.strip():
+                yield line
+
+def read_block(vcf_f):
+    """
+    Reads and uncompresses the BGZF block at the current offset of a file
+    :param vcf_f: the file, opened in binary mode
+    :return: a tuple of the uncompressed data and the size of the block, or
+    None at the end of the file or if there isn't a BGZF block at the offset
+    """
+    head = vcf_f.read(12)
+    if len(head) < 12 or not head.startswith('\x1f\x8b\x08\x04'):
+        return None
+    xlen = struct.unpack('<H', head[10:12])[0]
+    extra = vcf_f.read(xlen)
+    (size, n) = (None, 0)
+    while n + 4 <= len(extra):
+        length = struct.unpack('<H', extra[n + 2:n + 4])[0]
+        if extra[n:n + 2] == 'BC' and length == 2:
+            size = struct.unpack('<H', extra[n + 4:n + 6])[0] + 1
+        n += 4 + length
+    if size is None:
+        return None
+    data = vcf_f.read(size - xlen - 12)
+    return (zlib.decompress(data[:-8], -15), size)
+
+def bgzf_chunks(vcf_name, n):
+    """
+    Splits the records of a bgzipped vcf file into about n ranges of BGZF
+    blocks of the same compressed size. Each range starts at the first line
+    that starts in its first block, which is the only block that's
+    uncompressed to find it, and the offsets are virtual offsets: tuples of the
+    offset of a block in the file and of a line in the uncompressed block.
+    :param vcf_name: the name of the vcf file
+    :param n: the number of ranges
+    :return: a list of (start, end) virtual offsets, or None if the file isn't
+    bgzipped
+    """
+    # the header of the blocks that bgzip writes
+    magic = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+    header_size = 0
+    with gzip.open(vcf_name, "rb") as vcf_f:
+        for line in vcf_f:
+            if not line.startswith('#'):
+                break
+            header_size += len(line)
+    with open(vcf_name, "rb") as vcf_f:
+        size = os.fstat(vcf_f.fileno()).st_size
+        # the block of the first record
+        offset = 0
+        while True:
+            block = read_block(vcf_f)
+            if block is None:
+                return None
+            if not block[0]:
+                return []
+            if header_size < len(block[0]):
+                break
+            header_size -= len(block[0])
+            offset += block[1]
+        bounds = [(offset, header_size)]
+        vcf_map = mmap.mmap(vcf_f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for i in range(1, n):
+                offset = vcf_map.find(magic, bounds[0][0] +
+                                      (size - bounds[0][0]) * i / n)
+                while offset != -1:
+                    vcf_f.seek(offset)
+                    try:
+                        block = read_block(vcf_f)
+                    except zlib.error:
+                        block = None
+                    if block is None:
+                        # the magic is in the data of a block
+                        offset = vcf_map.find(magic, offset + 1)
+                        continue
+                    line = block[0].find('\n')
+                    if not block[0] or 0 <= line < len(block[0]) - 1:
+                        break
+                    # the block has no line that starts in it
+                    offset += block[1]
+                if offset == -1 or not block[0]:
+                    break
+                if bounds[-1] < (offset, line + 1):
+                    bounds.append((offset, line + 1))
+        finally:
+            vcf_map.close()
+    bounds.append((size, 0))
+    return zip(bounds, bounds[1:])
+
+def bgzf_lines(vcf_name, start, end):
+    """
+    :param vcf_name: the name of a bgzipped vcf file
+    :param start: the virtual offset of the first line
+    :param end: the virtual offset after the last line
+    :return: the lines between the virtual offsets
+    """
+    ((offset, within), rest) = (start, '')
+    with open(vcf_name, "rb") as vcf_f:
+        vcf_f.seek(offset)
+        while (offset, 0) < end:
+            block = read_block(vcf_f)
+            if block is None:
+                break
+            data = block[0][within:end[1] if offset == end[0] else None]
+            text_lines = (rest + data).splitlines(True)
+            rest = text_lines.pop() if text_lines and \
+                not text_lines[-1].endswith('\n') else ''
+            for line in text_lines:
+                if line.strip():
+                    yield line
+            (offset, within) = (offset + block[1], 0)
+    if rest.strip():
+        yield rest
+
+def split(vcf_file, regions, n):
+    """
+    Splits the records of a vcf file into about n chunks for --jobs: groups of
+    the regions, ranges of the BGZF blocks of a bgzipped file or ranges of the
+    lines of a plain text one.
+    :param vcf_file: the vcf.Reader, which has already read the header
+    :param regions: a list of (contig, start, end) tuples or None for every
+    record
+    :param n: the number of chunks
+    :return: a list of chunks, (kind, span) tuples, or None if the file can't
+    be split because it's compressed but not bgzipped
+    """
+    compressed = vcf_file.filename.endswith(".gz")
+    if regions is not None:
+        if not compressed:
+            # build the index here, not once in each worker
+            load_index(vcf_file.filename)
+        # each group keeps the region before it, so a record that overlaps
+        # regions of two groups is only parsed by the first
+        bounds = [len(regions) * i / n for i in range(n + 1)]
+        return [("regions", (regions[first:last],
+                             regions[first - 1] if first else None))
+                for (first, last) in zip(bounds, bounds[1:]) if last > first]
+    if compressed:
+        spans = bgzf_chunks(vcf_file.filename, n)
+        return None if spans is None else [("bgzf", span) for span in spans]
+    return [("plain", span) for span in plain_chunks(vcf_file.filename, n)]
+
+def chunk_lines(vcf_file, chunk):
+    """
+    :param vcf_file: the vcf.Reader, which has already read the header
+    :param chunk: a chunk from split
+    :return: the lines of the records of the chunk
+    """
+    (kind, span) = chunk
+    if kind == "regions":
+        return lines(vcf_file, *span)
+    elif kind == "bgzf":
+        return bgzf_lines(vcf_file.filename, *span)
+    return plain_lines(vcf_file.filename, *span)
+
+def parse_chunk(job):
+    """
+    Parses a chunk of a vcf file in a worker of the pool of --jobs. Every
+    field is written to the file of the part of the chunk.
+    :param job: a tuple of the number of the part, the name of the vcf file,
+    the engine, the fields and the chunk
+    :return: the number of the part
+    """
+    (part, vcf_name, engine, fields, chunk) = job
+    vcf_file = vcf.Reader(open(vcf_name, 'r'))
+    vcf_lines = chunk_lines(vcf_file, chunk)
+    if engine == 'raw':
+        parse_raw(vcf_file, vcf_lines, fields, part)
+    else:
+        vcf_file.reader = vcf_lines
+        parse(vcf_file, fields, part)
+    return part
+
+def parse_parallel(vcf_name, chunks, engine, fields, jobs):
+    """
+    Parses the chunks of a vcf file in a pool of processes and appends the
+    parts of every field to its output file in the order of the chunks, as
+    they finish, so the output is the same as parsing the file in one process
+    :param vcf_name: the name of the vcf file
+    :param chunks: the chunks from split
+    :param engine: the engine to parse the records with
+    :param fields: the fields to parse and print from the vcf file.
+    :param jobs: the number of processes
+    """
+    outs = open_outputs(fields)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for part in pool.imap(parse_chunk,
+                [(part, vcf_name, engine, fields, chunk)
+                 for (part, chunk) in enumerate(chunks)]):
+            for (field, out) in zip(fields, outs):
+                with open(part_name(field, part), "rb") as part_f:
+                    shutil.copyfileobj(part_f, out, BUFFER_SIZE)
+                os.remove(part_name(field, part))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        for out in outs:
+            out.close()
+        # the parts of a run that failed
+        for part in range(len(chunks)):
+            for field in fields:
+                if os.path.exists(part_name(field, part)):
+                    os.remove(part_name(field, part))
+
+def collect_chunk(job):
+    """
+    Collects a chunk of a vcf file for the columnar output in a worker of the
+    pool of --jobs
+    :param job: a tuple of the name of the vcf file, the fields and the chunk
+    :return: the result of collect
+    """
+    (vcf_name, fields, chunk) = job
+    vcf_file = vcf.Reader(open(vcf_name, 'r'))
+    return collect(vcf_file, chunk_lines(vcf_file, chunk), fields)
+
+def collect_parallel(vcf_name, chunks, fields, jobs):
+    """
+    Collects the chunks of a vcf file for the columnar output in a pool of
+    processes
+    :param vcf_name: the name of the vcf file
+    :param chunks: the chunks from split
+    :param fields: the fields to collect
+    :param jobs: the number of processes
+    :return: the result of collect for each chunk, in order
+    """
+    pool = multiprocessing.Pool(jobs)
+    try:
+        collected = pool.map(collect_chunk,
+                             [(vcf_name, fields, chunk) for chunk in chunks])
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return collected
 
 if __name__ == '__main__':
     argparse = argparse.ArgumentParser()
     argparse.add_argument('vcf_file', help="the vcf file to parse")
     argparse.add_argument('fields', nargs='+', type=str,
         help="the sections to parse from the vcf file")
+    argparse.add_argument('--region', dest='regions', action='append',
+        default=[], help="only parse the records in this region, i.e. "
+                         "chr1:1000-2000; can be given more than once")
+    argparse.add_argument('--regions-file', dest='regions_file',
+        help="only parse the records in the regions of this file")
+    argparse.add_argument('--engine', dest='engine', default='pyvcf',
+        choices=['pyvcf', 'raw'],
+        help="parse the records with PyVCF or with the raw engine, which "
+             "splits the lines itself and is much faster")
+    argparse.add_argument('--columnar', dest='columnar', nargs='?',
+        const='auto', choices=['auto', 'parquet', 'npz'],
+        help="write the sites and a sites x samples matrix of each field as "
+             "Parquet files, if PyArrow is installed, or NumPy .npz files "
+             "instead of the text files")
+    argparse.add_argument('--jobs', dest='jobs', type=int, default=1,
+        help="split the vcf file into chunks and parse them in this many "
+             "processes")
     args = argparse.parse_args()
 
     # feel free to change this
     NA = './.'
+    # the size of the buffer of each output file
+    BUFFER_SIZE = 1 << 20
+    # the lines of each field the raw engine holds before writing them
+    BATCH_SIZE = 4096
+    # the bytes between the records in the index of a plain text vcf file
+    INDEX_SPACING = 1 << 16
+    # the chunks for each process with --jobs, so a slow one is balanced out
+    CHUNKS_PER_JOB = 4
+
+    columnar = args.columnar
+    if columnar == 'auto':
+        columnar = 'npz' if pyarrow is None else 'parquet'
+    if columnar and numpy is None:
+        sys.exit("--columnar needs NumPy: install it with `pip install numpy`")
+    if columnar == 'parquet' and pyarrow is None:
+        sys.exit("--columnar parquet needs PyArrow: install it with "
+                 "`pip install pyarrow`")
 
+    fields = []
     for field in [field.upper() for field in args.fields]:
-        vcf_file = vcf.Reader(open(args.vcf_file, 'r'))
-        parse(vcf_file, field)
+        if field not in fields:
+            fields.append(field)
+    regions = None
+    if args.regions or args.regions_file:
+        regions = [parse_region(region) for region in args.regions]
+        if args.regions_file:
+            regions.extend(read_regions_file(args.regions_file))
+        regions = merge_regions(regions)
+    vcf_file = vcf.Reader(open(args.vcf_file, 'r'))
+    chunks = None
+    if args.jobs > 1:
+        chunks = split(vcf_file, regions, args.jobs * CHUNKS_PER_JOB)
+        if chunks is None:
+            sys.stderr.write("%s is compressed but not bgzipped and can't be "
+                             "split; parsing it in one process\n" %
+                             (args.vcf_file))
+    if columnar:
+        if chunks is not None and len(chunks) > 1:
+            collected = collect_parallel(args.vcf_file, chunks, fields,
+                                         args.jobs)
+        else:
+            collected = [collect(vcf_file, lines(vcf_file, regions), fields)]
+        write_columnar(vcf_file, fields, collected, columnar)
+    elif chunks is not None and len(chunks) > 1:
+        parse_parallel(args.vcf_file, chunks, args.engine, fields, args.jobs)
+    elif args.engine == 'raw':
+        parse_raw(vcf_file, lines(vcf_file, regions), fields)
+    else:
+        parse(records(vcf_file, regions), fields)